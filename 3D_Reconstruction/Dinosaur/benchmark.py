@@ -0,0 +1,101 @@
+# Dependencies
+import os
+import time
+import numpy as np
+import processor
+import structure
+import transformers
+
+
+def best_of(func, repeat=3):
+    """ Run func *repeat* times and return its last result and
+        the fastest wall time in seconds """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        best = min(best, time.perf_counter() - start)
+    return res, best
+
+
+def synthetic_pair(num_points, noise=0.0, seed=0):
+    """ Random 3D points seen by two normalized cameras P1 = [I 0] and
+        P2 = [R t]. Returns p1, p2 (3 x n homogenous) and m1, m2 (3 x 4) """
+    rng = np.random.RandomState(seed)
+    X = np.vstack([rng.uniform(-1, 1, (2, num_points)),
+                   rng.uniform(4, 8, (1, num_points)),
+                   np.ones((1, num_points))])
+    m1 = np.hstack([np.eye(3), np.zeros((3, 1))])
+    m2 = np.hstack([transformers.rotation_3d_from_angles(0, -10, 0),
+                    np.array([[-1], [0], [0]])])
+
+    p1 = np.dot(m1, X)
+    p2 = np.dot(m2, X)
+    p1 = p1 / p1[2]
+    p2 = p2 / p2[2]
+    p1[:2] += rng.normal(0, noise, (2, num_points))
+    p2[:2] += rng.normal(0, noise, (2, num_points))
+
+    return p1, p2, m1, m2
+
+
+def triangulation(sizes=(1000, 10000, 50000)):
+    """ Compare per-point triangulation against the batched engine """
+    print('{0:>8} {1:>32} {2:>10} {3:>10} {4:>12}'.format(
+        'points', 'function', 'seconds', 'speedup', 'max diff'))
+    for n in sizes:
+        p1, p2, m1, m2 = synthetic_pair(n, noise=1e-3)
+        runs = [
+            ('linear_triangulation', structure.linear_triangulation,
+             structure.linear_triangulation_batch),
+            ('reconstruct_points', structure.reconstruct_points,
+             structure.reconstruct_points_batch),
+        ]
+        for name, loop_func, batch_func in runs:
+            ref, loop_time = best_of(lambda: loop_func(p1, p2, m1, m2), 1)
+            print('{0:>8} {1:>32} {2:>10.4f} {3:>10} {4:>12}'.format(
+                n, name, loop_time, '1.0x', '-'))
+            for method in ('svd', 'eigh'):
+                res, batch_time = best_of(
+                    lambda: batch_func(p1, p2, m1, m2, method))
+                print('{0:>8} {1:>32} {2:>10.4f} {3:>9.1f}x {4:>12.2e}'.format(
+                    n, name + '_batch/' + method, batch_time,
+                    loop_time / batch_time, np.abs(res - ref).max()))
+
+
+def matrix_loading(rows=200000, cols=9, path='benchmark_matrix.corners'):
+    """ Compare the line by line matrix parser against read_matrix and
+        the memory-mapped .npy cache of load_matrix """
+    def read_lines(path):
+        with open(path, 'r') as f:
+            return np.asarray([[(t if t != '*' else -1) for t in line.split()]
+                               for line in f]).astype(np.float64)
+
+    rng = np.random.RandomState(0)
+    data = np.round(rng.rand(rows, cols) * 1000, 3)
+    with open(path, 'w') as f:
+        for row in data:
+            f.write(' '.join('*' if v < 50 else '{0:.3f}'.format(v) for v in row) + '\n')
+
+    ref, loop_time = best_of(lambda: read_lines(path), 1)
+    processor.load_matrix(path)  # write the cache
+    runs = [
+        ('read_matrix', lambda: processor.read_matrix(path)),
+        ('load_matrix (cached)', lambda: np.array(processor.load_matrix(path))),
+    ]
+    print('{0:>8} {1:>32} {2:>10} {3:>10} {4:>12}'.format(
+        'rows', 'function', 'seconds', 'speedup', 'max diff'))
+    print('{0:>8} {1:>32} {2:>10.4f} {3:>10} {4:>12}'.format(
+        rows, 'line by line', loop_time, '1.0x', '-'))
+    for name, func in runs:
+        res, t = best_of(func)
+        print('{0:>8} {1:>32} {2:>10.4f} {3:>9.1f}x {4:>12.2e}'.format(
+            rows, name, t, loop_time / t, np.abs(res - ref).max()))
+
+    for f in (path, path + '.float64.npy'):
+        os.remove(f)
+
+
+if __name__ == '__main__':
+    triangulation()
+    matrix_loading()
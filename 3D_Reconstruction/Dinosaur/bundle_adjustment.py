@@ -0,0 +1,303 @@
+# Dependencies
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from scipy.sparse import bsr_matrix, csr_matrix, diags
+from scipy.sparse.linalg import spsolve
+from camera import Camera
+
+
+def rotations(rvecs):
+    """ Rodrigues rotation matrices and their derivatives for m cameras.
+    :param rvecs: rotation vectors (m x 3)
+    :returns: R (m x 3 x 3) and dR (m x 3 x 3 x 3), dR[i, k] = dR_i / dr_k
+    """
+    R = np.empty((len(rvecs), 3, 3))
+    dR = np.empty((len(rvecs), 3, 3, 3))
+    for i, r in enumerate(rvecs):
+        R[i], J = cv2.Rodrigues(r)
+        dR[i] = J.reshape(3, 3, 3)
+
+    return R, dR
+
+
+class Problem(object):
+    """ Bundle adjustment problem. Parameter vector layout:
+        [rvec, t] of every free camera (6 each), 3D points (3 each) and,
+        if K is refined, the shared intrinsics [fx, fy, cx, cy]. """
+
+    def __init__(self, cameras, points, cam_idx, point_idx, xy,
+                 refine_K=False, fixed_cameras=(0,)):
+        """
+        :param cameras: list of Camera with K, R and t
+        :param points: 3D points (n x 3)
+        :param cam_idx, point_idx: camera and point index of each observation
+        :param xy: observed pixel coordinates (2 x num_observations)
+        :param refine_K: also refine the intrinsics shared by all cameras
+        :param fixed_cameras: cameras kept constant to fix the gauge
+        """
+        self.cam_idx = np.asarray(cam_idx, dtype=np.int64)
+        self.point_idx = np.asarray(point_idx, dtype=np.int64)
+        self.xy = np.asarray(xy, dtype=np.float64)
+        self.refine_K = refine_K
+        self.K = np.asarray(cameras[0].K, dtype=np.float64)
+        self.num_cameras = len(cameras)
+        self.num_points = len(points)
+
+        self.rvecs = np.array([cv2.Rodrigues(np.asarray(c.R, np.float64))[0].ravel()
+                               for c in cameras]).reshape(-1, 3)
+        self.tvecs = np.array([np.ravel(c.t) for c in cameras],
+                              dtype=np.float64).reshape(-1, 3)
+
+        # column offset of each camera block, -1 for fixed cameras
+        free = np.ones(self.num_cameras, dtype=bool)
+        free[list(fixed_cameras)] = False
+        self.cam_col = np.full(self.num_cameras, -1, dtype=np.int64)
+        self.cam_col[free] = 6 * np.arange(free.sum())
+        self.point_col0 = 6 * free.sum()
+        self.K_col0 = self.point_col0 + 3 * self.num_points
+        self.num_params = self.K_col0 + (4 if refine_K else 0)
+
+        self.x0 = np.zeros(self.num_params)
+        self.x0[:self.point_col0] = np.hstack(
+            [self.rvecs[free], self.tvecs[free]]).ravel()
+        self.x0[self.point_col0:self.K_col0] = np.asarray(points).ravel()
+        if refine_K:
+            self.x0[self.K_col0:] = self.intrinsics(self.K)
+
+    @staticmethod
+    def intrinsics(K):
+        return np.array([K[0, 0], K[1, 1], K[0, 2], K[1, 2]])
+
+    def unpack(self, x):
+        """ Returns rvecs (m x 3), tvecs (m x 3), points (n x 3) and
+            intrinsics [fx, fy, cx, cy] """
+        rvecs, tvecs = self.rvecs.copy(), self.tvecs.copy()
+        free = self.cam_col >= 0
+        cams = x[:self.point_col0].reshape(-1, 6)
+        rvecs[free], tvecs[free] = cams[:, :3], cams[:, 3:]
+        points = x[self.point_col0:self.K_col0].reshape(-1, 3)
+        if self.refine_K:
+            f = x[self.K_col0:]
+        else:
+            f = self.intrinsics(self.K)
+
+        return rvecs, tvecs, points, f
+
+    def project(self, x):
+        """ Projects every observation.
+        :returns: projections (2 x k), camera points (3 x k) and the
+            rotations and their derivatives per camera
+        """
+        rvecs, tvecs, points, f = self.unpack(x)
+        R, dR = rotations(rvecs)
+        ci, pi = self.cam_idx, self.point_idx
+        Xc = np.einsum('kij,kj->ik', R[ci], points[pi]) + tvecs[ci].T
+        proj = np.vstack([f[0] * Xc[0] / Xc[2] + f[2],
+                          f[1] * Xc[1] / Xc[2] + f[3]])
+
+        return proj, Xc, R, dR, points, f
+
+    def residuals(self, x):
+        proj = self.project(x)[0]
+        return (proj - self.xy).T.ravel()
+
+    def jacobian(self, x):
+        """ Block-sparse Jacobian of the residuals. Each observation (2 rows)
+            only depends on its camera (6), its point (3) and K (4). """
+        proj, Xc, R, dR, points, f = self.project(x)
+        ci, pi = self.cam_idx, self.point_idx
+        k = len(ci)
+        inv_z = 1.0 / Xc[2]
+
+        # d(u, v) / d(camera point), k x 2 x 3
+        dp = np.zeros((k, 2, 3))
+        dp[:, 0, 0] = f[0] * inv_z
+        dp[:, 0, 2] = -f[0] * Xc[0] * inv_z ** 2
+        dp[:, 1, 1] = f[1] * inv_z
+        dp[:, 1, 2] = -f[1] * Xc[1] * inv_z ** 2
+
+        # d(camera point) / d rvec = dR/dr_k * X, k x 3 x 3
+        dXc_dr = np.einsum('oaij,oj->oia', dR[ci], points[pi])
+        blocks = [np.matmul(dp, dXc_dr), dp, np.matmul(dp, R[ci])]
+        cols = [self.cam_col[ci, None] + np.arange(3),
+                self.cam_col[ci, None] + np.arange(3, 6),
+                self.point_col0 + 3 * pi[:, None] + np.arange(3)]
+        valid = [self.cam_col[ci] >= 0, self.cam_col[ci] >= 0,
+                 np.ones(k, dtype=bool)]
+
+        if self.refine_K:
+            dK = np.zeros((k, 2, 4))
+            dK[:, 0, 0] = Xc[0] * inv_z
+            dK[:, 1, 1] = Xc[1] * inv_z
+            dK[:, 0, 2] = 1
+            dK[:, 1, 3] = 1
+            blocks.append(dK)
+            cols.append(np.broadcast_to(self.K_col0 + np.arange(4), (k, 4)))
+            valid.append(np.ones(k, dtype=bool))
+
+        rows, columns, values = [], [], []
+        obs_rows = 2 * np.arange(k)
+        for block, col, sel in zip(blocks, cols, valid):
+            width = block.shape[2]
+            for axis in range(2):
+                rows.append(np.repeat(obs_rows[sel] + axis, width))
+                columns.append(col[sel].ravel())
+                values.append(block[sel, axis].ravel())
+
+        return csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows),
+                                      np.concatenate(columns))),
+            shape=(2 * k, self.num_params))
+
+    def cameras(self, x):
+        rvecs, tvecs, _, f = self.unpack(x)
+        K = self.K.copy()
+        K[0, 0], K[1, 1], K[0, 2], K[1, 2] = f
+        return [Camera(K=K, R=cv2.Rodrigues(r)[0], t=t.reshape(3, 1))
+                for r, t in zip(rvecs, tvecs)]
+
+    def points(self, x):
+        return self.unpack(x)[2].copy()
+
+
+def robust_weights(r, loss, f_scale):
+    """ IRLS weights and robust cost of the residuals r (2 per observation)
+    :returns: weight per residual and the total cost 0.5 * sum(rho(e^2))
+    """
+    e = np.linalg.norm(r.reshape(-1, 2), axis=1)
+    if loss == 'huber':
+        inlier = e <= f_scale
+        w = np.where(inlier, 1.0, f_scale / np.maximum(e, 1e-12))
+        rho = np.where(inlier, e ** 2, 2 * f_scale * e - f_scale ** 2)
+    elif loss == 'linear':
+        w = np.ones_like(e)
+        rho = e ** 2
+    else:
+        raise ValueError('Unknown loss: {0}'.format(loss))
+
+    return np.repeat(w, 2), 0.5 * rho.sum()
+
+
+def point_blocks(Jp, num_points):
+    """ The block diagonal of Jp^T Jp as (n x 3 x 3) array """
+    V = (Jp.T @ Jp).tocoo()
+    blocks = np.zeros((num_points, 3, 3))
+    blocks[V.row // 3, V.row % 3, V.col % 3] = V.data
+    return blocks
+
+
+def schur_step(J, r, problem, lam):
+    """ Solve the damped normal equations (J^T J + lam diag(J^T J)) dx = -J^T r
+        by eliminating the points with the Schur complement, so only the
+        reduced camera system has to be factorized.
+    :returns: parameter update dx
+    """
+    point_cols = np.arange(problem.point_col0, problem.K_col0)
+    cam_cols = np.setdiff1d(np.arange(problem.num_params), point_cols)
+    J = J.tocsc()
+    Jc, Jp = J[:, cam_cols], J[:, point_cols]
+    gc, gp = Jc.T @ r, Jp.T @ r
+
+    U = (Jc.T @ Jc).tocsc()
+    U = U + diags(lam * U.diagonal() + 1e-12)
+    V = point_blocks(Jp, problem.num_points)
+    idx = np.arange(3)
+    V[:, idx, idx] = V[:, idx, idx] * (1 + lam) + 1e-12
+    V_inv = bsr_matrix((np.linalg.inv(V), np.arange(problem.num_points),
+                        np.arange(problem.num_points + 1)),
+                       shape=(len(point_cols), len(point_cols)))
+
+    W = Jc.T @ Jp
+    WV_inv = W @ V_inv
+    S = (U - WV_inv @ W.T).tocsc()
+    dc = spsolve(S, -(gc - WV_inv @ gp))
+    dp = V_inv @ (-gp - W.T @ dc)
+
+    dx = np.empty(problem.num_params)
+    dx[cam_cols] = dc
+    dx[point_cols] = dp
+    return dx
+
+
+def bundle_adjust(cameras, points, cam_idx, point_idx, xy, refine_K=False,
+                  fixed_cameras=(0,), loss='huber', f_scale=2.0,
+                  max_iterations=50, tolerance=1e-6, verbose=True, trace_memory=False):
+    """ Jointly refine camera extrinsics (and optionally the shared K) and
+        3D points by minimizing the reprojection error. Levenberg-Marquardt
+        on the sparse Jacobian, where each step eliminates the points with
+        the Schur complement and solves the sparse reduced camera system.
+    :param cameras: list of Camera with K, R and t
+    :param points: 3D points (n x 3)
+    :param cam_idx, point_idx: camera and point index of each observation
+    :param xy: observed pixel coordinates (2 x num_observations)
+    :param refine_K: also refine [fx, fy, cx, cy] shared by all cameras
+    :param fixed_cameras: cameras kept constant to fix the gauge
+    :param loss: 'huber' or 'linear'. Default: huber
+    :param f_scale: inlier scale of the robust loss in pixels
+    :param max_iterations: maximum number of iterations
+    :param tolerance: stop when the relative cost decrease is below this
+    :param verbose: print a line per iteration
+    :param trace_memory: also report the memory allocated by Python, with
+        tracemalloc. It slows every allocation down, so it is off by default
+    :returns: refined cameras, refined points (n x 3) and the report, a list
+        of dicts with per iteration cost, rms error, time and, if traced, memory
+    """
+    tracing = tracemalloc.is_tracing()
+    if trace_memory and not tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    problem = Problem(cameras, points, cam_idx, point_idx, xy,
+                      refine_K, fixed_cameras)
+    if verbose:
+        print('Bundle adjustment: {0} cameras, {1} points, {2} observations, '
+              '{3} parameters'.format(problem.num_cameras, problem.num_points,
+                                      len(problem.cam_idx), problem.num_params))
+
+    report = []
+
+    def log(r, cost, lam):
+        report.append(dict(
+            iteration=len(report), cost=cost, lam=lam,
+            rms=np.sqrt(np.mean(r ** 2) * 2), seconds=time.perf_counter() - start))
+        line = ('{iteration:>4} cost {cost:.6e}  rms {rms:.4f}px  '
+                'lambda {lam:.1e}  {seconds:.2f}s')
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            report[-1].update(memory_mb=current / 2 ** 20, peak_memory_mb=peak / 2 ** 20)
+            line += '  mem {memory_mb:.1f}MB (peak {peak_memory_mb:.1f}MB)'
+        if verbose:
+            print(line.format(**report[-1]))
+
+    x = problem.x0
+    lam = 1e-4
+    r = problem.residuals(x)
+    w, cost = robust_weights(r, loss, f_scale)
+    log(r, cost, lam)
+
+    for _ in range(max_iterations):
+        sqrt_w = np.sqrt(w)
+        J = diags(sqrt_w) @ problem.jacobian(x)
+        while lam < 1e10:
+            x_new = x + schur_step(J, sqrt_w * r, problem, lam)
+            r_new = problem.residuals(x_new)
+            w_new, cost_new = robust_weights(r_new, loss, f_scale)
+            if cost_new < cost:
+                lam = max(lam / 10, 1e-12)
+                break
+            lam *= 10
+        else:
+            break
+
+        decrease = (cost - cost_new) / cost
+        x, r, w, cost = x_new, r_new, w_new, cost_new
+        log(r, cost, lam)
+        if decrease < tolerance:
+            break
+
+    if trace_memory and not tracing:
+        tracemalloc.stop()
+
+    return problem.cameras(x), problem.points(x), report
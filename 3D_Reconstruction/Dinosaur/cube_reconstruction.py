@@ -122,23 +122,13 @@ print('True fundamental matrix:', true_F)
 print('Computed fundamental matrix:', (F * true_F[2][2]))
 
 # Given we are at camera 1, calculate the parameters for camera 2
-# Using the essential matrix returns 4 possible camera paramters
+# Using the essential matrix returns 4 possible camera paramters.
+# Pick the one with most points in front of both cameras
 P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
-P2s = structure.compute_P_from_essential(E)
-
-ind = -1
-for i, P2 in enumerate(P2s):
-    # Find the correct camera parameters
-    d1 = structure.reconstruct_one_point(
-        points1n[:, 0], points2n[:, 0], P1, P2)
-    P2_homogenous = extrinsic_from_camera_pose(P2)
-    d2 = np.dot(P2_homogenous[:3, :4], d1)
-
-    if d1[2] > 0 and d2[2] > 0:
-        ind = i
+ind, P2, _, in_front = structure.select_P_from_essential(E, points1n, points2n)
+print('Points in front of both cameras per candidate:', in_front.sum(axis=1))
 
 print('True pose of c2 wrt c1: ', H_c1_c2)
-P2 = np.linalg.inv(np.vstack([P2s[ind], [0, 0, 0, 1]]))[:3, :4]
 P2f = structure.compute_P_from_fundamental(F)
 print('Calculated camera 2 parameters:', P2, P2f)
 
@@ -14,16 +14,15 @@ import features
 
 def house():
     input_path = 'imgs/house/'
-    camera_filepath = 'imgs/house/3D/house.00{0}.P'
 
-    cameras = [Camera(processor.read_matrix(camera_filepath.format(i)))
-               for i in range(9)]
+    # every .P, .p3d, .corners and .nview-corners file, cached as .npy
+    arrays, _ = processor.load_directory(input_path)
+    cameras = [Camera(np.array(P)) for P in arrays['.P']]
     [c.factor() for c in cameras]
 
-    points3d = processor.read_matrix(input_path + '3D/house.p3d').T  # 3 x n
+    points3d = arrays['.p3d'][0].T  # 3 x n
     points4d = np.vstack((points3d, np.ones(points3d.shape[1])))  # 4 x n
-    points2d = [processor.read_matrix(
-        input_path + '2D/house.00' + str(i) + '.corners') for i in range(9)]
+    points2d = arrays['.corners']
 
     index1 = 2
     index2 = 4
@@ -44,8 +43,7 @@ def house():
     # plt.plot(x[0], x[1], 'b.')
     # plt.show()
 
-    corner_indexes = processor.read_matrix(
-        input_path + '2D/house.nview-corners', np.int)
+    corner_indexes = arrays['.nview-corners'][0].astype(np.int64)
     corner_indexes1 = corner_indexes[:, index1]
     corner_indexes2 = corner_indexes[:, index2]
     intersect_indexes = np.intersect1d(np.nonzero(
@@ -101,26 +99,14 @@ E = structure.compute_essential_normalized(points1n, points2n)
 print('Computed essential matrix:', (-E / E[0][1]))
 
 # Given we are at camera 1, calculate the parameters for camera 2
-# Using the essential matrix returns 4 possible camera paramters
+# Using the essential matrix returns 4 possible camera paramters.
+# Pick the one with most points in front of both cameras
 P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
-P2s = structure.compute_P_from_essential(E)
+ind, P2, _, in_front = structure.select_P_from_essential(E, points1n, points2n)
+print('Points in front of both cameras per candidate:', in_front.sum(axis=1))
 
-ind = -1
-for i, P2 in enumerate(P2s):
-    # Find the correct camera parameters
-    d1 = structure.reconstruct_one_point(
-        points1n[:, 0], points2n[:, 0], P1, P2)
-
-    # Convert P2 from camera view to world view
-    P2_homogenous = np.linalg.inv(np.vstack([P2, [0, 0, 0, 1]]))
-    d2 = np.dot(P2_homogenous[:3, :4], d1)
-
-    if d1[2] > 0 and d2[2] > 0:
-        ind = i
-
-P2 = np.linalg.inv(np.vstack([P2s[ind], [0, 0, 0, 1]]))[:3, :4]
 #tripoints3d = structure.reconstruct_points(points1n, points2n, P1, P2)
-tripoints3d = structure.linear_triangulation(points1n, points2n, P1, P2)
+tripoints3d = structure.linear_triangulation_batch(points1n, points2n, P1, P2)
 
 fig = plt.figure()
 fig.suptitle('3D reconstructed', fontsize=16)
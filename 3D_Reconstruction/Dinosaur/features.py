@@ -1,39 +1,206 @@
 # Dependencies
+import collections
+import hashlib
+import json
+import os
 import cv2
 import numpy as np
+import processor
+import structure
 
 
-def find_correspondence_points(img1, img2):
-    sift = cv2.xfeatures2d.SIFT_create()
+def detect_features(img, **sift_params):
+    """ Detect SIFT keypoints and compute their descriptors.
+    :param img: BGR image
+    :param sift_params: keyword arguments of SIFT_create, eg. nfeatures
+    :returns: keypoint coordinates (n x 2) and descriptors (n x 128)
+    """
+    sift = cv2.xfeatures2d.SIFT_create(**sift_params)
+    kp, des = sift.detectAndCompute(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), None)
+    pts = np.asarray([k.pt for k in kp], dtype=np.float64).reshape(-1, 2)
+    if des is None:
+        des = np.zeros((0, 128), dtype=np.float32)
 
-    # find the keypoints and descriptors with SIFT
-    kp1, des1 = sift.detectAndCompute(
-        cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY), None)
-    kp2, des2 = sift.detectAndCompute(
-        cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY), None)
+    return pts, des
 
-    # Find point matches
+
+def flann_matcher(des=None):
+    """ FLANN kd-tree matcher. If descriptors are given, the index is
+        built on them once and reused by every knnMatch(query, k) call. """
     FLANN_INDEX_KDTREE = 0
     index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
     search_params = dict(checks=50)
     flann = cv2.FlannBasedMatcher(index_params, search_params)
-    matches = flann.knnMatch(des1, des2, k=2)
+    if des is not None:
+        flann.add([np.ascontiguousarray(des, dtype=np.float32)])
+        flann.train()
+
+    return flann
+
+
+def match_descriptors(des1, des2, ratio=0.8, matcher=None):
+    """ Match descriptors with FLANN and Lowe's ratio test.
+    :param des1, des2: float32 descriptors (n1 x d), (n2 x d)
+    :param ratio: Lowe's SIFT matching ratio. Default: 0.8
+    :param matcher: optional matcher already trained on des2,
+        see flann_matcher. Skips building the index on des2
+    :returns: indices of matching descriptors into des1 and des2
+    """
+    if len(des1) < 2 or len(des2) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Find point matches
+    des1 = np.ascontiguousarray(des1, dtype=np.float32)
+    if matcher is None:
+        matches = flann_matcher().knnMatch(
+            des1, np.ascontiguousarray(des2, dtype=np.float32), k=2)
+    else:
+        matches = matcher.knnMatch(des1, k=2)
 
     # Apply Lowe's SIFT matching ratio test
-    good = []
-    for m, n in matches:
-        if m.distance < 0.8 * n.distance:
-            good.append(m)
+    good = [m for m, n in (pair for pair in matches if len(pair) == 2)
+            if m.distance < ratio * n.distance]
+
+    idx1 = np.asarray([m.queryIdx for m in good], dtype=np.int64)
+    idx2 = np.asarray([m.trainIdx for m in good], dtype=np.int64)
+
+    return idx1, idx2
+
+
+class FeatureStore(object):
+    """ Persistent SIFT feature cache.
+        Features are keyed by a hash of the image content and the detector
+        parameters and stored on disk as .npy files that are memory-mapped
+        on reload. The most recently used features, and their FLANN index,
+        are also kept in an in-memory LRU, so matching a pair of cached
+        images only pays for the match step. """
+
+    def __init__(self, cache_dir='features_cache', capacity=64, **sift_params):
+        """
+        :param cache_dir: directory of the on-disk cache
+        :param capacity: number of images kept in the in-memory LRU
+        :param sift_params: keyword arguments of SIFT_create
+        """
+        self.cache_dir = cache_dir
+        self.capacity = capacity
+        self.sift_params = sift_params
+        self.memory = collections.OrderedDict()  # key -> [kp, des, matcher]
+        self.path_keys = {}  # path -> ((mtime, size), key)
+        self.hits = self.disk_hits = self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, img):
+        """ Hash of the image content and the detector parameters.
+            Image paths are hashed by file content without decoding, once
+            per file modification time and size. """
+        if isinstance(img, str):
+            stat = os.stat(img)
+            version = (stat.st_mtime_ns, stat.st_size)
+            known = self.path_keys.get(img)
+            if known is not None and known[0] == version:
+                return known[1]
+
+        h = hashlib.sha1()
+        if isinstance(img, str):
+            with open(img, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        else:
+            img = np.ascontiguousarray(img)
+            h.update(str(img.shape).encode())
+            h.update(img.data)
+        h.update(json.dumps(self.sift_params, sort_keys=True).encode())
+
+        key = h.hexdigest()
+        if isinstance(img, str):
+            self.path_keys[img] = (version, key)
+        return key
+
+    def path(self, key, name):
+        return os.path.join(self.cache_dir, '{0}.{1}.npy'.format(key, name))
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def _entry(self, img):
+        key = self.key(img)
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        kp_path, des_path = self.path(key, 'kp'), self.path(key, 'des')
+        if os.path.exists(kp_path) and os.path.exists(des_path):
+            self.disk_hits += 1
+            kp = np.load(kp_path, mmap_mode='r')
+            des = np.load(des_path, mmap_mode='r')
+        else:
+            self.misses += 1
+            if isinstance(img, str):
+                img = cv2.imread(img)
+            kp, des = detect_features(img, **self.sift_params)
+            # write then rename so readers never see partial files
+            for path, arr in ((kp_path, kp), (des_path, des)):
+                tmp = path[:-len('.npy')] + '.tmp.npy'
+                np.save(tmp, arr)
+                os.replace(tmp, path)
+
+        entry = [kp, des, None]
+        self._remember(key, entry)
+        return entry
+
+    def features(self, img):
+        """ Keypoints (n x 2) and descriptors (n x 128) of an image path
+            or BGR image, computed only if not cached """
+        kp, des, _ = self._entry(img)
+        return kp, des
+
+    def matcher(self, img, entry=None):
+        """ FLANN matcher trained on the descriptors of *img* """
+        entry = self._entry(img) if entry is None else entry
+        if entry[2] is None:
+            entry[2] = flann_matcher(entry[1])
+        return entry[2]
+
+    def match(self, img1, img2, ratio=0.8):
+        """ Ratio test matches between two images.
+        :returns: keypoints of both images and the indices of the matches
+        """
+        kp1, des1, _ = self._entry(img1)
+        entry2 = self._entry(img2)
+        kp2, des2 = entry2[0], entry2[1]
+        idx1, idx2 = match_descriptors(des1, des2, ratio,
+                                       matcher=self.matcher(img2, entry2))
+
+        return kp1, kp2, idx1, idx2
+
+
+def find_correspondence_points(img1, img2, store=None):
+    """ Find inlier point correspondences between two images.
+    :param store: optional FeatureStore to reuse cached features
+    :returns: corresponding points (2 x n) in both images
+    """
+    if store is None:
+        # find the keypoints and descriptors with SIFT
+        kp1, des1 = detect_features(img1)
+        kp2, des2 = detect_features(img2)
+        idx1, idx2 = match_descriptors(des1, des2)
+    else:
+        kp1, kp2, idx1, idx2 = store.match(img1, img2)
 
-    src_pts = np.asarray([kp1[m.queryIdx].pt for m in good])
-    dst_pts = np.asarray([kp2[m.trainIdx].pt for m in good])
+    src_pts = kp1[idx1].T
+    dst_pts = kp2[idx2].T
 
-    # Constrain matches to fit homography
-    retval, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 100.0)
-    mask = mask.ravel()
+    # Constrain matches to fit the epipolar geometry
+    F, mask = structure.compute_fundamental_ransac(
+        processor.cart2hom(src_pts), processor.cart2hom(dst_pts), threshold=2.0)
 
     # We select only inlier points
-    pts1 = src_pts[mask == 1]
-    pts2 = dst_pts[mask == 1]
+    pts1 = src_pts[:, mask]
+    pts2 = dst_pts[:, mask]
 
-    return pts1.T, pts2.T
+    return pts1, pts2
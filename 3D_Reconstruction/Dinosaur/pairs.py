@@ -0,0 +1,190 @@
+# Dependencies
+import itertools
+import cv2
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class VocabularyTree(object):
+    """ Hierarchical k-means vocabulary tree (Nister & Stewenius 2006).
+        Every node has *branching* children and the leaves at *depth* are
+        the visual words. The tree is stored level by level, the children
+        of node n at a level are nodes n * branching ... (n + 1) * branching - 1
+        of the next level. """
+
+    def __init__(self, branching=10, depth=4):
+        self.branching = branching
+        self.depth = depth
+        self.levels = []  # centers per level, (branching^(l+1) x d)
+        self.idf = None   # idf weight per word
+
+    @property
+    def num_words(self):
+        return self.branching ** self.depth
+
+    def fit(self, descriptors, max_descriptors=200000, seed=0):
+        """ Build the tree with recursive k-means.
+        :param descriptors: list of descriptor arrays, one per image
+        :param max_descriptors: random subset used for clustering
+        :returns: self
+        """
+        # sample evenly from every image instead of stacking them all
+        rng = np.random.RandomState(seed)
+        total = sum(len(d) for d in descriptors)
+        fraction = min(1.0, max_descriptors / max(total, 1))
+        des = np.vstack([
+            d[rng.rand(len(d)) < fraction] if fraction < 1 else d
+            for d in descriptors]).astype(np.float32)
+        cv2.setRNGSeed(seed)
+
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+        assignment = np.zeros(len(des), dtype=np.int64)
+        self.levels = []
+        for level in range(self.depth):
+            num_nodes = self.branching ** level
+            centers = np.empty((num_nodes * self.branching, des.shape[1]),
+                               dtype=np.float32)
+            child = np.empty(len(des), dtype=np.int64)
+            for node in range(num_nodes):
+                sel = np.nonzero(assignment == node)[0]
+                children = slice(node * self.branching, (node + 1) * self.branching)
+                if len(sel) == 0:
+                    # empty branch, reuse the parent center
+                    centers[children] = self.levels[-1][node]
+                    continue
+                data = des[sel]
+                if len(sel) < self.branching:
+                    data = data[np.arange(self.branching) % len(sel)]
+                _, labels, c = cv2.kmeans(data, self.branching, None, criteria,
+                                          1, cv2.KMEANS_PP_CENTERS)
+                centers[children] = c
+                child[sel] = node * self.branching + labels.ravel()[:len(sel)]
+            self.levels.append(centers)
+            assignment = child
+
+        # idf weights from the images the words occur in
+        df = np.zeros(self.num_words)
+        for d in descriptors:
+            df[np.unique(self.words(d))] += 1
+        self.idf = np.log(len(descriptors) / np.maximum(df, 1))
+
+        return self
+
+    def words(self, des):
+        """ Quantize descriptors (n x d) into visual word ids by descending
+            the tree, all descriptors of an image at once. """
+        des = np.asarray(des, dtype=np.float32)
+        node = np.zeros(len(des), dtype=np.int64)
+        children = np.arange(self.branching)
+        for centers in self.levels:
+            candidates = node[:, None] * self.branching + children
+            diff = centers[candidates] - des[:, None, :]
+            dist = np.einsum('nbd,nbd->nb', diff, diff)
+            node = candidates[np.arange(len(des)), dist.argmin(axis=1)]
+
+        return node
+
+    def bow(self, descriptors):
+        """ L2 normalized tf-idf bag of words vectors, one row per image
+            (sparse, num_images x num_words) """
+        rows, cols, vals = [], [], []
+        for i, des in enumerate(descriptors):
+            words, counts = np.unique(self.words(des), return_counts=True)
+            weights = counts / max(counts.sum(), 1) * self.idf[words]
+            norm = np.linalg.norm(weights)
+            rows.append(np.full(len(words), i))
+            cols.append(words)
+            vals.append(weights / norm if norm > 0 else weights)
+
+        return csr_matrix((np.concatenate(vals), (np.concatenate(rows),
+                                                  np.concatenate(cols))),
+                          shape=(len(descriptors), self.num_words))
+
+    def save(self, path):
+        np.savez(path, *self.levels, branching=self.branching,
+                 depth=self.depth, idf=self.idf)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        tree = cls(int(data['branching']), int(data['depth']))
+        tree.levels = [data['arr_{0}'.format(i)] for i in range(tree.depth)]
+        tree.idf = data['idf']
+        return tree
+
+
+def exhaustive_pairs(num_images):
+    """ All n (n - 1) / 2 pairs """
+    return list(itertools.combinations(range(num_images), 2))
+
+
+def sequential_pairs(num_images, window=3, loop=False):
+    """ Pairs of each frame with its *window* following frames.
+        With *loop*, the sequence wraps around (eg. turntable sequences). """
+    pairs = set()
+    for i in range(num_images):
+        for j in range(i + 1, i + window + 1):
+            if j < num_images:
+                pairs.add((i, j))
+            elif loop and j % num_images != i:
+                pairs.add(tuple(sorted((i, j % num_images))))
+
+    return sorted(pairs)
+
+
+def retrieval_pairs(descriptors, tree, k=10):
+    """ The top *k* most similar images of each image by bag of words
+        cosine similarity.
+    :param descriptors: list of descriptor arrays, one per image
+    :param tree: fitted VocabularyTree
+    :returns: sorted list of pairs (i, j) with i < j
+    """
+    bow = tree.bow(descriptors)
+    scores = (bow @ bow.T).toarray()
+    np.fill_diagonal(scores, -np.inf)
+
+    k = min(k, len(descriptors) - 1)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k > 0 else \
+        np.zeros((len(descriptors), 0), dtype=np.int64)
+    pairs = {(min(i, j), max(i, j)) for i, row in enumerate(top) for j in row}
+
+    return sorted(pairs)
+
+
+def select_pairs(images, store, mode='retrieval', k=10, window=3, loop=False,
+                 tree=None):
+    """ Select the image pairs worth matching in a collection.
+    :param images: list of image paths or BGR images
+    :param store: features.FeatureStore with the SIFT features
+    :param mode: 'exhaustive', 'sequential' (window of following frames,
+        for videos) or 'retrieval' (top k by vocabulary tree, unioned with
+        a sequential window if window > 0)
+    :param tree: optional prebuilt VocabularyTree, otherwise one is fitted
+        on the descriptors of the collection
+    :returns: sorted list of pairs (i, j) with i < j
+    """
+    if mode == 'exhaustive':
+        return exhaustive_pairs(len(images))
+    if mode == 'sequential':
+        return sequential_pairs(len(images), window, loop)
+    if mode != 'retrieval':
+        raise ValueError('Unknown mode: {0}'.format(mode))
+
+    descriptors = [store.features(img)[1] for img in images]
+    if tree is None:
+        tree = VocabularyTree().fit(descriptors)
+    pairs = set(retrieval_pairs(descriptors, tree, k))
+    if window > 0:
+        pairs.update(sequential_pairs(len(images), window, loop))
+
+    return sorted(pairs)
+
+
+def pairs_to_dict(pairs):
+    """ Candidate views of each view, eg. for sfm.IncrementalSfM(pairs=...) """
+    candidates = {}
+    for i, j in pairs:
+        candidates.setdefault(i, []).append(j)
+        candidates.setdefault(j, []).append(i)
+
+    return candidates
@@ -1,20 +1,75 @@
 # Dependencies
+import io
+import os
 import numpy as np
 
 
 def read_matrix(path, astype=np.float64):
     """ Reads a file containing a matrix where each line represents a point
         and each point is tab or space separated. * are replaced with -1.
+        The whole file is parsed in one vectorized call.
     :param path: path to the file
     :parama astype: type to cast the numbers. Default: np.float64
     :returns: array of array of numbers
     """
-    with open(path, 'r') as f:
-        arr = []
-        for line in f:
-            arr.append([(token if token != '*' else -1)
-                        for token in line.strip().split()])
-        return np.asarray(arr).astype(astype)
+    with open(path, 'rb') as f:
+        data = f.read().replace(b'*', b'-1')
+    if not data.strip():
+        return np.zeros((0, 0), dtype=astype)
+
+    return np.loadtxt(io.BytesIO(data), ndmin=2).astype(astype)
+
+
+def load_matrix(path, astype=np.float64, cache=True):
+    """ read_matrix with a .npy cache next to the source file.
+        The cache is memory-mapped on reload and rebuilt whenever the
+        source file is newer.
+    :param path: path to the file
+    :param astype: type to cast the numbers. Default: np.float64
+    :param cache: read and write the cache. Default: True
+    :returns: (read-only if memory-mapped) array of array of numbers
+    """
+    cache_path = '{0}.{1}.npy'.format(path, np.dtype(astype).name)
+    if cache and os.path.exists(cache_path) and \
+            os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return np.load(cache_path, mmap_mode='r')
+
+    arr = read_matrix(path, astype)
+    if cache:
+        # write then rename so readers never see a partial file
+        tmp = cache_path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp, arr)
+        os.replace(tmp, cache_path)
+
+    return arr
+
+
+MATRIX_SUFFIXES = ('.P', '.p3d', '.corners', '.nview-corners')
+
+
+def load_directory(path, suffixes=MATRIX_SUFFIXES, astype=np.float64,
+                   cache=True):
+    """ Load every matrix file of a dataset directory in one call,
+        eg. the Oxford VGG multi-view datasets (house.000.P, house.p3d,
+        house.000.corners, house.nview-corners, ...).
+    :param path: dataset directory, searched recursively
+    :param suffixes: file suffixes to load
+    :returns: dict of suffix -> list of arrays sorted by file name, and
+        the matching dict of suffix -> list of file paths
+    """
+    files = {suffix: [] for suffix in suffixes}
+    for root, _, names in os.walk(path):
+        for name in names:
+            for suffix in suffixes:
+                if name.endswith(suffix):
+                    files[suffix].append(os.path.join(root, name))
+
+    arrays = {}
+    for suffix in suffixes:
+        files[suffix].sort(key=os.path.basename)
+        arrays[suffix] = [load_matrix(f, astype, cache) for f in files[suffix]]
+
+    return arrays, files
 
 
 def cart2hom(arr):
@@ -0,0 +1,492 @@
+# Dependencies
+import glob
+import cv2
+import numpy as np
+from camera import Camera
+import bundle_adjustment
+import features
+import processor
+import structure
+
+
+class TrackTable(object):
+    """ Track table of an incremental reconstruction. Maps every 3D point
+        to its 2D observations (view, keypoint index) and every keypoint of
+        a registered view back to its 3D point. """
+
+    def __init__(self):
+        self.points = np.zeros((0, 3))  # point cloud, one 3D point per row
+        self.observations = []          # point id -> [(view, keypoint), ...]
+        self.keypoint_to_point = {}     # view -> point id per keypoint or -1
+
+    def __len__(self):
+        return len(self.observations)
+
+    def add_view(self, view, num_keypoints):
+        self.keypoint_to_point[view] = np.full(num_keypoints, -1, dtype=np.int64)
+
+    def lookup(self, view, keypoints):
+        """ Returns the point ids of *keypoints* in *view*, -1 if untracked """
+        return self.keypoint_to_point[view][keypoints]
+
+    def add_points(self, points, view_keypoints):
+        """ Add new 3D points and their observations.
+        :param points: 3D points in catesian coordinates (3 x m)
+        :param view_keypoints: list of (view, keypoint indices of length m)
+        :returns: ids of the new points
+        """
+        ids = np.arange(len(self), len(self) + points.shape[1])
+        self.points = np.vstack([self.points, points.T])
+        self.observations.extend([] for _ in ids)
+        for view, keypoints in view_keypoints:
+            self.add_observations(ids, view, keypoints)
+
+        return ids
+
+    def add_observations(self, ids, view, keypoints):
+        """ Extend the tracks *ids* with *keypoints* of *view*.
+            Keypoints that already belong to a track are left untouched, and
+            a track gets at most one keypoint per view: the first one given,
+            and none if it is already observed in *view*. """
+        table = self.keypoint_to_point[view]
+        free = table[keypoints] == -1
+        ids, keypoints = ids[free], keypoints[free]
+        _, first = np.unique(ids, return_index=True)
+        first = np.sort(first)
+        ids, keypoints = ids[first], keypoints[first]
+        unseen = ~np.isin(ids, table[table >= 0])
+        ids, keypoints = ids[unseen], keypoints[unseen]
+        for pid, kp in zip(ids, keypoints):
+            self.observations[pid].append((view, kp))
+        table[keypoints] = ids
+
+    def observation_arrays(self):
+        """ Returns the flattened observations as arrays
+            (point ids, views, keypoint indices) """
+        lengths = [len(obs) for obs in self.observations]
+        point_ids = np.repeat(np.arange(len(self)), lengths)
+        flat = np.asarray([o for obs in self.observations for o in obs],
+                          dtype=np.int64).reshape(-1, 2)
+
+        return point_ids, flat[:, 0], flat[:, 1]
+
+
+def pose_from_projection(P):
+    """ Split a normalized camera matrix P ~ [R|t] estimated up to scale
+        into a proper rotation R and translation t (3 x 1) """
+    if np.linalg.det(P[:, :3]) < 0:
+        P = -P
+    U, S, V = np.linalg.svd(P[:, :3])
+    R = np.dot(U, V)
+    t = P[:, 3:] / S.mean()
+
+    return R, t
+
+
+def reprojection_errors(x, X, P):
+    """ Distance between 2D points x (3 x n) and the projection of
+        3D points X (4 x n) by camera P (3 x 4) """
+    proj = np.dot(P, X)
+    return np.linalg.norm(x[:2] / x[2] - proj[:2] / proj[2], axis=0)
+
+
+def solve_pnp(x, X, threshold, iterations=500, seed=0, refine_iterations=10):
+    """ Robust camera resectioning. RANSAC over minimal 6 point DLT
+        solutions from structure.compute_P_linear. The pose of the best
+        hypothesis is refined on its inliers by minimizing the
+        reprojection error, and refined again while the inliers grow.
+    :param x: normalized 2D points K^-1 p (3 x n)
+    :param X: 3D points in homog. coordinates (4 x n)
+    :param threshold: inlier threshold in normalized coordinates
+    :param refine_iterations: maximum number of refinements
+    :returns: R, t and the boolean inlier mask
+    """
+    n = x.shape[1]
+    rng = np.random.RandomState(seed)
+    best, best_P = np.zeros(n, dtype=bool), None
+    for _ in range(iterations):
+        sample = rng.choice(n, 6, replace=False)
+        P = structure.compute_P_linear(x[:, sample], X[:, sample])
+        P = np.hstack(pose_from_projection(P))
+        depth = np.dot(P[2], X)
+        inliers = (reprojection_errors(x, X, P) < threshold) & (depth > 0)
+        if inliers.sum() > best.sum():
+            best, best_P = inliers, P
+
+    if best.sum() < 6:
+        return None, None, best
+
+    # Refine on the inliers and rescore with the refined pose, as long as
+    # the inlier set grows: a minimal DLT hypothesis on noisy points often
+    # explains only a fraction of the inliers of the true pose
+    inliers, P = best, best_P
+    for _ in range(refine_iterations):
+        rvec, _ = cv2.Rodrigues(P[:, :3])
+        _, rvec, tvec = cv2.solvePnP(
+            processor.hom2cart(X[:, inliers]).T.copy(),
+            processor.hom2cart(x[:, inliers]).T.copy(),
+            np.eye(3), None, rvec, P[:, 3:].copy(),
+            useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+        R, _ = cv2.Rodrigues(rvec)
+        refined = np.hstack([R, tvec])
+        refined_inliers = ((reprojection_errors(x, X, refined) < threshold) &
+                           (np.dot(refined[2], X) > 0))
+        if refined_inliers.sum() < inliers.sum():
+            break
+        grown = refined_inliers.sum() > inliers.sum()
+        inliers, P = refined_inliers, refined
+        if not grown:
+            break
+
+    return P[:, :3], P[:, 3:], inliers
+
+
+class IncrementalSfM(object):
+    """ Incremental structure from motion over an image sequence or an
+        unordered collection. Starts from a two view reconstruction, then
+        repeatedly registers the view that sees the most reconstructed points
+        by PnP against the point cloud and triangulates its new tracks.
+        Features are computed once per view and every verified pair of
+        matches is cached, so no pair is ever matched twice. """
+
+    def __init__(self, images, K, pairs=None, window=3, min_inliers=30,
+                 reproj_threshold=2.0, store=None):
+        """
+        :param images: list of image paths or BGR images
+        :param K: 3 x 3 intrinsic matrix shared by all views
+        :param pairs: optional dict view -> candidate views to match against,
+            eg. from pairs.pairs_to_dict. Default: the *window* views before
+            and after each view in the sequence
+        :param window: number of views on each side matched with a view
+        :param min_inliers: minimum 2D-3D inliers to accept a registration
+        :param reproj_threshold: inlier threshold in pixels
+        :param store: optional features.FeatureStore that caches features
+            and FLANN indices across runs
+        """
+        self.images = images
+        self.pairs = pairs
+        self.window = window
+        self.min_inliers = min_inliers
+        self.reproj_threshold = reproj_threshold
+        self.set_intrinsics(K)
+        self.store = store
+
+        self.keypoints = {}    # view -> n x 2 keypoint coordinates
+        self.descriptors = {}  # view -> n x d descriptors
+        self.matches = {}      # (i, j), i < j -> verified keypoint indices
+        self.cameras = {}      # view -> Camera of registered views
+        self.failed = []       # views that could not be registered (yet)
+        self.tracks = TrackTable()
+
+    def set_intrinsics(self, K):
+        """ Set K and what depends on it: K^-1 for the normalized points and
+            the inlier threshold in normalized coordinates """
+        self.K = np.asarray(K, dtype=np.float64)
+        self.K_inv = np.linalg.inv(self.K)
+        self.threshold = self.reproj_threshold / self.K[0, 0]
+
+    def load_features(self, view):
+        if view not in self.keypoints:
+            img = self.images[view]
+            if self.store is not None:
+                kp, des = self.store.features(img)
+            else:
+                if isinstance(img, str):
+                    img = cv2.imread(img)
+                kp, des = features.detect_features(img)
+            self.keypoints[view] = kp
+            self.descriptors[view] = des
+            self.tracks.add_view(view, len(kp))
+
+        return self.keypoints[view], self.descriptors[view]
+
+    def normalized_points(self, view, keypoints):
+        """ Keypoints of *view* in normalized homog. coordinates (3 x n) """
+        pts = self.keypoints[view][keypoints].T
+        return np.dot(self.K_inv, processor.cart2hom(pts))
+
+    def match(self, i, j):
+        """ Ratio test matches between views i and j verified by the epipolar
+            constraint. Each pair is computed once and cached.
+        :returns: matching keypoint indices into view i and view j
+        """
+        key = (min(i, j), max(i, j))
+        if key not in self.matches:
+            kp1, des1 = self.load_features(key[0])
+            kp2, des2 = self.load_features(key[1])
+            matcher = None
+            if self.store is not None:
+                matcher = self.store.matcher(self.images[key[1]])
+            idx1, idx2 = features.match_descriptors(des1, des2,
+                                                    matcher=matcher)
+
+            # a keypoint can only be matched once in each view
+            _, first = np.unique(idx2, return_index=True)
+            idx1, idx2 = idx1[first], idx2[first]
+            _, first = np.unique(idx1, return_index=True)
+            idx1, idx2 = idx1[first], idx2[first]
+
+            if len(idx1) >= 8:
+                F, mask = structure.compute_fundamental_ransac(
+                    processor.cart2hom(kp1[idx1].T),
+                    processor.cart2hom(kp2[idx2].T), threshold=1.0)
+                idx1, idx2 = idx1[mask], idx2[mask]
+            else:
+                idx1, idx2 = idx1[:0], idx2[:0]
+            self.matches[key] = (idx1, idx2)
+
+        idx1, idx2 = self.matches[key]
+        return (idx1, idx2) if i < j else (idx2, idx1)
+
+    def candidates(self, view):
+        """ Registered views to match *view* against """
+        if self.pairs is not None:
+            others = self.pairs.get(view, [])
+        else:
+            others = range(max(0, view - self.window),
+                           min(len(self.images), view + self.window + 1))
+        return [u for u in others if u != view and u in self.cameras]
+
+    def correspondences(self, view):
+        """ 2D-3D correspondences of *view* through its matches with the
+            registered candidate views.
+        :returns: keypoint indices into *view* and their point ids
+        """
+        self.load_features(view)
+        kps, pids = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for u in self.candidates(view):
+            idx_u, idx_v = self.match(u, view)
+            tracked = self.tracks.lookup(u, idx_u)
+            kps.append(idx_v[tracked >= 0])
+            pids.append(tracked[tracked >= 0])
+
+        kps, first = np.unique(np.concatenate(kps), return_index=True)
+        return kps, np.concatenate(pids)[first]
+
+    def projection(self, view):
+        """ Normalized camera matrix [R|t] of a registered view """
+        cam = self.cameras[view]
+        return np.hstack([cam.R, cam.t])
+
+    def initial_pair(self, pairs):
+        """ The pair (i, j) of *pairs* with the most verified matches, eg. to
+            start the reconstruction of an unordered collection """
+        return max(pairs, key=lambda pair: len(self.match(*pair)[0]))
+
+    def initialize(self, i, j):
+        """ Two view reconstruction from the essential matrix of views i, j.
+            View i is placed at the origin. """
+        idx1, idx2 = self.match(i, j)
+        p1n = self.normalized_points(i, idx1)
+        p2n = self.normalized_points(j, idx2)
+        E, mask = structure.compute_essential_ransac(p1n, p2n, self.threshold)
+        idx1, idx2, p1n, p2n = idx1[mask], idx2[mask], p1n[:, mask], p2n[:, mask]
+
+        # Pick the camera with most points in front of both cameras
+        P1 = np.hstack([np.eye(3), np.zeros((3, 1))])
+        ind, P2, X, masks = structure.select_P_from_essential(E, p1n, p2n)
+        valid = masks[ind]
+
+        self.cameras[i] = Camera(K=self.K, R=P1[:, :3], t=P1[:, 3:])
+        self.cameras[j] = Camera(K=self.K, R=P2[:, :3], t=P2[:, 3:])
+        self.tracks.add_points(
+            processor.hom2cart(X[:, valid]),
+            [(i, idx1[valid]), (j, idx2[valid])])
+
+    def register(self, view):
+        """ Register *view* by PnP against the existing point cloud.
+        :returns: True if the view was registered
+        """
+        kps, pids = self.correspondences(view)
+        if len(kps) < self.min_inliers:
+            return False
+
+        x = self.normalized_points(view, kps)
+        X = processor.cart2hom(self.tracks.points[pids].T)
+        R, t, inliers = solve_pnp(x, X, self.threshold)
+        if R is None or inliers.sum() < self.min_inliers:
+            return False
+
+        self.cameras[view] = Camera(K=self.K, R=R, t=t)
+        self.tracks.add_observations(pids[inliers], view, kps[inliers])
+        return True
+
+    def triangulate(self, view):
+        """ Extend existing tracks with the matches of *view* and triangulate
+            matches that are not part of any track yet.
+        :returns: number of new 3D points
+        """
+        P2 = self.projection(view)
+        num_points = len(self.tracks)
+        for u in self.candidates(view):
+            idx_u, idx_v = self.match(u, view)
+            pid_u = self.tracks.lookup(u, idx_u)
+            pid_v = self.tracks.lookup(view, idx_v)
+
+            # extend tracks with the matches consistent with their 3D point,
+            # best first, so a track keeps its closest keypoint in the view
+            extend = (pid_u >= 0) & (pid_v == -1)
+            if extend.any():
+                ids, kps = pid_u[extend], idx_v[extend]
+                X = processor.cart2hom(self.tracks.points[ids].T)
+                errors = reprojection_errors(self.normalized_points(view, kps), X, P2)
+                valid = (errors < self.threshold) & (np.dot(P2[2], X) > 0)
+                order = np.argsort(errors[valid])
+                self.tracks.add_observations(ids[valid][order], view, kps[valid][order])
+
+            new = (pid_u == -1) & (pid_v == -1)
+            if not new.any():
+                continue
+            idx_u, idx_v = idx_u[new], idx_v[new]
+            P1 = self.projection(u)
+            p1n = self.normalized_points(u, idx_u)
+            p2n = self.normalized_points(view, idx_v)
+            X = structure.linear_triangulation_batch(p1n, p2n, P1, P2)
+
+            valid = ((np.dot(P1[2], X) > 0) & (np.dot(P2[2], X) > 0) &
+                     (reprojection_errors(p1n, X, P1) < self.threshold) &
+                     (reprojection_errors(p2n, X, P2) < self.threshold))
+            self.tracks.add_points(
+                processor.hom2cart(X[:, valid]),
+                [(u, idx_u[valid]), (view, idx_v[valid])])
+
+        return len(self.tracks) - num_points
+
+    def next_view(self, tried):
+        """ Unregistered view with the most 2D-3D correspondences, among the
+            views not tried since the last registration, or None if no view
+            has at least min_inliers of them """
+        best, best_count = None, self.min_inliers - 1
+        for view in range(len(self.images)):
+            if view in self.cameras or view in tried:
+                continue
+            count = len(self.correspondences(view)[0])
+            if count > best_count:
+                best, best_count = view, count
+
+        return best
+
+    def run(self, init_pair=(0, 1), ba_interval=5, refine_K=False):
+        """ Reconstruct all views. The next view registered is always the one
+            that sees the most reconstructed points, whatever its index, and
+            views that failed are retried once more views are registered.
+        :param init_pair: views of the initial two view reconstruction
+        :param ba_interval: bundle adjust after every *ba_interval*
+            registered views and at the end. 0 disables bundle adjustment
+        :param refine_K: also refine the intrinsics in bundle adjustment
+        """
+        i, j = init_pair
+        self.initialize(i, j)
+        print('Initialized with views {0} and {1}: {2} points'.format(
+            i, j, len(self.tracks)))
+
+        tried = set()  # views that failed since the last registration
+        while True:
+            view = self.next_view(tried)
+            if view is None:
+                break
+            if not self.register(view):
+                tried.add(view)
+                continue
+            tried.clear()
+            num_new = self.triangulate(view)
+            print('Registered view {0}: {1} new points, {2} total'.format(
+                view, num_new, len(self.tracks)))
+            if ba_interval and len(self.cameras) % ba_interval == 0:
+                self.bundle_adjust(refine_K=refine_K, verbose=False)
+
+        self.failed = [v for v in range(len(self.images)) if v not in self.cameras]
+        for view in self.failed:
+            print('Could not register view {0}'.format(view))
+
+        if ba_interval:
+            self.bundle_adjust(refine_K=refine_K)
+
+        return self
+
+    def bundle_adjust(self, **kwargs):
+        """ Refine all registered cameras and 3D points in place.
+            The first registered camera is held fixed.
+            Keyword arguments are passed to bundle_adjustment.bundle_adjust
+        :returns: the bundle adjustment report
+        """
+        views, point_ids, xy = self.observations()
+        registered = sorted(self.cameras)
+        cam_idx = np.searchsorted(registered, views)
+        cameras, points, report = bundle_adjustment.bundle_adjust(
+            [self.cameras[v] for v in registered], self.tracks.points,
+            cam_idx, point_ids, xy, **kwargs)
+
+        self.cameras = dict(zip(registered, cameras))
+        self.tracks.points = points
+        self.set_intrinsics(cameras[0].K)
+        return report
+
+    def observations(self):
+        """ Returns all observations as arrays (views, point ids, pixel
+            coordinates 2 x n), eg. as input to bundle adjustment """
+        point_ids, views, keypoints = self.tracks.observation_arrays()
+        xy = np.empty((2, len(views)))
+        for view in np.unique(views):
+            sel = views == view
+            xy[:, sel] = self.keypoints[view][keypoints[sel]].T
+
+        return views, point_ids, xy
+
+
+def dino_intrinsic(images):
+    height, width, ch = cv2.imread(images[0]).shape
+    return np.array([  # for dino
+        [2360, 0, width / 2],
+        [0, 2360, height / 2],
+        [0, 0, 1]])
+
+
+def dino():
+    images = sorted(glob.glob('imgs/dinos/viff.*.ppm'))
+    plot(IncrementalSfM(images, dino_intrinsic(images)).run())
+
+
+def dino_unordered(k=5, seed=0):
+    """ The dino sequence as an unordered collection: shuffled images, pairs
+        from vocabulary tree retrieval only, reconstruction started from the
+        retrieved pair with the most verified matches """
+    import pairs
+
+    images = sorted(glob.glob('imgs/dinos/viff.*.ppm'))
+    images = [images[i] for i in np.random.RandomState(seed).permutation(len(images))]
+    store = features.FeatureStore('features_cache')
+    selected = pairs.select_pairs(images, store, 'retrieval', k=k, window=0)
+
+    sfm = IncrementalSfM(images, dino_intrinsic(images),
+                         pairs=pairs.pairs_to_dict(selected), store=store)
+    sfm.run(init_pair=sfm.initial_pair(selected))
+    print('Registered {0} of {1} shuffled views from {2} retrieved pairs'.format(
+        len(sfm.cameras), len(images), len(selected)))
+    plot(sfm)
+
+
+def plot(sfm):
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D
+
+    points3d = sfm.tracks.points.T
+
+    fig = plt.figure()
+    fig.suptitle('3D reconstructed from {0} views'.format(len(sfm.cameras)),
+                 fontsize=16)
+    ax = fig.gca(projection='3d')
+    ax.plot(points3d[0], points3d[1], points3d[2], 'b.')
+    ax.set_xlabel('x axis')
+    ax.set_ylabel('y axis')
+    ax.set_zlabel('z axis')
+    ax.view_init(elev=135, azim=90)
+    plt.show()
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'unordered':
+        dino_unordered()
+    else:
+        dino()
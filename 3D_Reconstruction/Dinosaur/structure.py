@@ -54,6 +54,98 @@ def linear_triangulation(p1, p2, m1, m2):
     return res
 
 
+def triangulation_systems(p1, p2, m1, m2):
+    """ Build the linear triangulation systems for all n correspondences
+        at once. Row i of each system matches the per-point A matrix
+        used in linear_triangulation.
+    :param p1, p2: 2D points in homo. or catesian coordinates. Shape (3 x n)
+    :param m1, m2: Camera matrices associated with p1 and p2. Shape (3 x 4)
+    :returns: stacked systems with shape (n x 4 x 4)
+    """
+    p1 = np.asarray(p1, dtype=np.float64)
+    p2 = np.asarray(p2, dtype=np.float64)
+    m1 = np.asarray(m1, dtype=np.float64)
+    m2 = np.asarray(m2, dtype=np.float64)
+
+    A = np.empty((p1.shape[1], 4, 4))
+    A[:, 0] = p1[0, :, None] * m1[2] - m1[0]
+    A[:, 1] = p1[1, :, None] * m1[2] - m1[1]
+    A[:, 2] = p2[0, :, None] * m2[2] - m2[0]
+    A[:, 3] = p2[1, :, None] * m2[2] - m2[1]
+
+    return A
+
+
+def solve_homogeneous_systems(A, method='eigh'):
+    """ Solve a stack of homogeneous systems A X = 0 in the least square
+        sense, ie the right singular vector with the smallest singular value.
+    :param A: stacked systems with shape (n x k x 4)
+    :param method: 'svd' runs one stacked SVD on A. 'eigh' takes the
+        eigenvector of the smallest eigenvalue of the 4 x 4 normal matrices
+        A^T A, which is several times faster and accurate enough for
+        normalized image coordinates. Default: 'eigh'
+    :returns: unit solutions with shape (4 x n)
+    """
+    if method == 'svd':
+        _, _, V = np.linalg.svd(A)
+        return V[:, -1, :].T
+    elif method == 'eigh':
+        AtA = np.matmul(A.transpose(0, 2, 1), A)
+        _, V = np.linalg.eigh(AtA)  # eigenvalues in ascending order
+        return V[:, :, 0].T
+    raise ValueError('Unknown method: {0}'.format(method))
+
+
+def linear_triangulation_batch(p1, p2, m1, m2, method='eigh'):
+    """
+    Batched linear triangulation. Same result as linear_triangulation but
+    all n 4 x 4 systems are built as one (n x 4 x 4) tensor and solved in a
+    single call instead of a Python loop.
+    :param p1, p2: 2D points in homo. or catesian coordinates. Shape (3 x n)
+    :param m1, m2: Camera matrices associated with p1 and p2. Shape (3 x 4)
+    :param method: 'svd' or 'eigh'. See solve_homogeneous_systems
+    :returns: 4 x n homogenous 3d triangulated points
+    """
+    A = triangulation_systems(p1, p2, m1, m2)
+    X = solve_homogeneous_systems(A, method)
+
+    return X / X[3]
+
+
+def skew_batch(x):
+    """ Create skew symmetric matrices from n 3d vectors. Batched skew.
+    :param x: 3d vectors with shape (3 x n)
+    :returns: n x 3 x 3 skew symmetric matrices
+    """
+    x = np.asarray(x, dtype=np.float64)
+    S = np.zeros((x.shape[1], 3, 3))
+    S[:, 0, 1] = -x[2]
+    S[:, 0, 2] = x[1]
+    S[:, 1, 0] = x[2]
+    S[:, 1, 2] = -x[0]
+    S[:, 2, 0] = -x[1]
+    S[:, 2, 1] = x[0]
+
+    return S
+
+
+def reconstruct_points_batch(p1, p2, m1, m2, method='eigh'):
+    """ Batched reconstruct_points. Builds the n (6 x 4) cross product
+        systems [p1]x m1 and [p2]x m2 in one go and solves them together.
+    :param p1, p2: 2D points in homo. coordinates. Shape (3 x n)
+    :param m1, m2: Camera matrices associated with p1 and p2. Shape (3 x 4)
+    :param method: 'svd' or 'eigh'. See solve_homogeneous_systems
+    :returns: 4 x n homogenous 3d triangulated points
+    """
+    A = np.concatenate([
+        np.matmul(skew_batch(p1), np.asarray(m1, dtype=np.float64)),
+        np.matmul(skew_batch(p2), np.asarray(m2, dtype=np.float64))
+    ], axis=1)
+    X = solve_homogeneous_systems(A, method)
+
+    return X / X[3]
+
+
 def compute_epipole(F):
     """ Computes the (right) epipole from a
         fundamental matrix F.
@@ -136,6 +228,31 @@ def compute_P(p2d, p3d):
     return V[-1, :12].reshape((3, 4))
 
 
+def compute_P_linear(p2d, p3d):
+    """ Compute camera matrix from pairs of 2D-3D correspondences
+        in homog. coordinates. Same DLT as compute_P but with the 2 x 12
+        rows per point, so memory is linear in the number of points
+        instead of (3n x (12 + n)).
+    :param p2d: 2D points (3 x n)
+    :param p3d: 3D points (4 x n)
+    :returns: 3 x 4 camera matrix
+    """
+    n = p2d.shape[1]
+    if p3d.shape[1] != n:
+        raise ValueError('Number of points do not match.')
+
+    x = p2d[:2] / p2d[2]
+    X = p3d.T
+    M = np.zeros((2 * n, 12))
+    M[0::2, 0:4] = X
+    M[0::2, 8:12] = -x[0, :, None] * X
+    M[1::2, 4:8] = X
+    M[1::2, 8:12] = -x[1, :, None] * X
+
+    U, S, V = np.linalg.svd(M, full_matrices=False)
+    return V[-1].reshape((3, 4))
+
+
 def compute_P_from_fundamental(F):
     """ Compute the second camera matrix (assuming P1 = [I 0])
         from a fundamental matrix.
@@ -166,6 +283,35 @@ def compute_P_from_essential(E):
     return P2s
 
 
+def select_P_from_essential(E, p1, p2):
+    """ Pick the second camera (assuming P1 = [I 0]) out of the four
+        decompositions of E by cheirality. All points are triangulated for
+        all four candidates in one batched call and counted when they lie in
+        front of both cameras.
+    :param E: essential matrix with p1' E p2 = 0
+    :param p1, p2: corresponding normalized points K^-1 p. Shape (3 x n)
+    :returns: index of the winning candidate, its camera matrix (3 x 4),
+        its 4 x n homogenous triangulated points and the (4 x n) boolean
+        masks of points in front of both cameras for every candidate
+    """
+    n = p1.shape[1]
+    P1 = np.hstack([np.eye(3), np.zeros((3, 1))])
+    # Convert each candidate from camera view to world view
+    P2s = np.array([np.linalg.inv(np.vstack([P2, [0, 0, 0, 1]]))[:3, :4]
+                    for P2 in compute_P_from_essential(E)])
+
+    A = np.concatenate([triangulation_systems(p1, p2, P1, P2) for P2 in P2s])
+    X = solve_homogeneous_systems(A).reshape(4, 4, n).transpose(1, 0, 2)
+
+    # depth sign of homogenous X without dividing by a possibly zero w
+    d1 = X[:, 2] * X[:, 3]
+    d2 = np.einsum('ci,cin->cn', P2s[:, 2], X) * X[:, 3]
+    masks = (d1 > 0) & (d2 > 0)
+
+    ind = masks.sum(axis=1).argmax()
+    return ind, P2s[ind], X[ind] / X[ind, 3], masks
+
+
 def correspondence_matrix(p1, p2):
     p1x, p1y = p1[:2]
     p2x, p2y = p2[:2]
@@ -226,16 +372,137 @@ def scale_and_translate_points(points):
     return np.dot(norm3d, points), norm3d
 
 
-def compute_normalized_image_to_image_matrix(p1, p2, compute_essential=False):
+def compute_image_to_image_matrix_batch(x1, x2, compute_essential=False):
+    """ Batched 8 point algorithm. Solves h problems at once.
+    :param x1, x2: corresponding points with shape (h x 3 x m), m >= 8
+    :returns: h fundamental or essential matrices (h x 3 x 3)
+    """
+    h, _, m = x1.shape
+    # rows [x'*x, x'*y, x', y'*x, y'*y, y', x, y, 1] as in correspondence_matrix
+    A = np.einsum('hin,hjn->hnij', x1, x2).reshape(h, m, 9)
+    _, _, V = np.linalg.svd(A, full_matrices=m < 9)
+    F = V[:, -1].reshape(h, 3, 3)
+
+    # constrain F. Make rank 2 by zeroing out last singular value
+    U, S, V = np.linalg.svd(F)
+    S[:, -1] = 0
+    if compute_essential:
+        S[:, :2] = 1  # Force rank 2 and equal eigenvalues
+    return np.matmul(U * S[:, None, :], V)
+
+
+def sampson_distance(F, p1, p2):
+    """ Squared Sampson distance of every point pair to every matrix.
+    :param F: fundamental or essential matrices (h x 3 x 3), p1' F p2 = 0
+    :param p1, p2: corresponding points with shape 3 x n
+    :returns: squared distances (h x n)
+    """
+    Fp2 = np.matmul(F, p2)
+    Ftp1 = np.matmul(F.transpose(0, 2, 1), p1)
+    num = np.einsum('in,hin->hn', p1, Fp2) ** 2
+    den = Fp2[:, 0] ** 2 + Fp2[:, 1] ** 2 + Ftp1[:, 0] ** 2 + Ftp1[:, 1] ** 2
+
+    return num / np.maximum(den, 1e-300)
+
+
+def ransac_image_to_image_matrix(p1, p2, compute_essential=False, threshold=1.0,
+                                 confidence=0.999, max_iterations=10000,
+                                 batch_size=64, local_optimization=True,
+                                 seed=0):
+    """ Robust fundamental or essential matrix with (LO-)RANSAC.
+        Minimal 8 point hypotheses are generated and scored in batches of
+        *batch_size* with the Sampson distance over all points at once.
+        Sampling stops once *confidence* is reached for the current inlier
+        ratio. Essential matrices are scored as rank 2 matrices and only the
+        result is constrained to two equal singular values. With local optimization every new best hypothesis is refit
+        on its inliers until the inlier set stops growing.
+    :input p1, p2: corresponding points with shape 3 x n
+    :param threshold: inlier threshold on the Sampson distance, in the units
+        of p1, p2 (pixels for F, normalized coordinates for E)
+    :param confidence: probability of drawing at least one outlier free sample
+    :returns: matrix with unit norm (3 x 3) and boolean inlier mask (n)
+    """
+    n = p1.shape[1]
+    if p2.shape[1] != n:
+        raise ValueError('Number of points do not match.')
+    if n < 8:
+        raise ValueError('At least 8 points are needed, got {0}.'.format(n))
+
+    p1 = np.asarray(p1, dtype=np.float64) / p1[2]
+    p2 = np.asarray(p2, dtype=np.float64) / p2[2]
+    p1n, T1 = scale_and_translate_points(p1)
+    p2n, T2 = scale_and_translate_points(p2)
+    rng = np.random.RandomState(seed)
+    thresh2 = threshold ** 2
+
+    def fit(sample):
+        """ Normalized 8 point on the given index arrays (h x m) """
+        F = compute_image_to_image_matrix_batch(
+            p1n[:, sample].transpose(1, 0, 2),
+            p2n[:, sample].transpose(1, 0, 2))
+        F = np.matmul(T1.T, np.matmul(F, T2))
+        return F / np.linalg.norm(F, axis=(1, 2), keepdims=True)
+
+    def score(F):
+        return sampson_distance(F, p1, p2) < thresh2
+
+    best_F, best_mask, best_count = None, np.zeros(n, dtype=bool), 0
+    iterations, needed = 0, max_iterations
+    while iterations < min(needed, max_iterations):
+        h = min(batch_size, max_iterations - iterations)
+        sample = np.argpartition(rng.rand(h, n), 8, axis=1)[:, :8]
+        F = fit(sample)
+        inliers = score(F)
+        counts = inliers.sum(axis=1)
+        iterations += h
+
+        i = counts.argmax()
+        if counts[i] <= best_count:
+            continue
+        best_F, best_mask, best_count = F[i], inliers[i], counts[i]
+
+        # local optimization, refit on the inliers while they keep growing
+        while local_optimization and best_count > 8:
+            F = fit(np.nonzero(best_mask)[0][None])
+            inliers = score(F)[0]
+            if inliers.sum() <= best_count:
+                break
+            best_F, best_mask, best_count = F[0], inliers, inliers.sum()
+
+        # adaptive termination for the current inlier ratio
+        w = best_count / float(n)
+        if w >= 1:
+            break
+        needed = np.log(1 - confidence) / np.log(max(1 - w ** 8, 1e-300))
+
+    if compute_essential:
+        # Hypotheses are scored as rank 2 matrices. Projecting every minimal
+        # 8 point solution onto equal singular values is too lossy, so only
+        # the final matrix is made an essential matrix.
+        U, S, V = np.linalg.svd(best_F)
+        best_F = np.dot(U, np.dot(np.diag([1, 1, 0]), V)) / np.sqrt(2)
+
+    return best_F, best_mask
+
+
+def compute_normalized_image_to_image_matrix(p1, p2, compute_essential=False,
+                                             ransac_threshold=None):
     """ Computes the fundamental or essential matrix from corresponding points
         using the normalized 8 point algorithm.
     :input p1, p2: corresponding points with shape 3 x n
+    :param ransac_threshold: if given, reject outliers with
+        ransac_image_to_image_matrix using this Sampson distance threshold
     :returns: fundamental or essential matrix with shape 3 x 3
     """
     n = p1.shape[1]
     if p2.shape[1] != n:
         raise ValueError('Number of points do not match.')
 
+    if ransac_threshold is not None:
+        F, _ = ransac_image_to_image_matrix(
+            p1, p2, compute_essential, ransac_threshold)
+        return F / F[2, 2]
+
     # preprocess image coordinates
     p1n, T1 = scale_and_translate_points(p1)
     p2n, T2 = scale_and_translate_points(p2)
@@ -256,3 +523,16 @@ def compute_fundamental_normalized(p1, p2):
 
 def compute_essential_normalized(p1, p2):
     return compute_normalized_image_to_image_matrix(p1, p2, compute_essential=True)
+
+
+def compute_fundamental_ransac(p1, p2, threshold=1.0, **kwargs):
+    """ Fundamental matrix and inlier mask with (LO-)RANSAC.
+        Threshold is in pixels. See ransac_image_to_image_matrix """
+    return ransac_image_to_image_matrix(p1, p2, False, threshold, **kwargs)
+
+
+def compute_essential_ransac(p1, p2, threshold=1e-3, **kwargs):
+    """ Essential matrix and inlier mask with (LO-)RANSAC from normalized
+        points K^-1 p. Threshold is in normalized coordinates, ie. pixels
+        divided by the focal length. See ransac_image_to_image_matrix """
+    return ransac_image_to_image_matrix(p1, p2, True, threshold, **kwargs)
@@ -2,6 +2,18 @@
 import numpy as np
 import cv2
 
+
+def non_max_suppression(response, nhood_size):
+    """Local maxima of a thresholded response, found for all pixels at once:
+    a pixel is kept if it is nonzero and equal to the maximum of its
+    nhood_size x nhood_size neighborhood (the dilated response).
+    Returns rows of (x, y, response), strongest first."""
+    local_max = cv2.dilate(response, np.ones((nhood_size, nhood_size), np.uint8))
+    ys, xs = np.nonzero((response == local_max) & (response > 0))
+    values = response[ys, xs]
+    order = np.argsort(-values, kind="mergesort")
+    return np.column_stack((xs[order], ys[order], values[order]))
+
 # Read image
 img = cv2.imread("octagon.png")
 # print "Read image from file; size: {}x{}".format(img.shape[1], img.shape[0])  # [debug]
@@ -28,28 +40,16 @@ img_out = img.copy()
 img_out[h_selected > 0] = (0, 0, 255)  # mark pixels above threshold
 
 nhood_size = 5  # neighborhood size for non-maximal suppression (odd)
-nhood_r = int(nhood_size / 2)  # neighborhood radius = size / 2
-corners = []  # list of corner locations as (x, y, response) tuples
-for y in xrange(h_selected.shape[0]):
-    for x in xrange(h_selected.shape[1]):
-        if h_selected.item(y, x):
-            h_value = h_selected.item(y, x)  # response value at (x, y)
-            nhood = h_selected[(y - nhood_r):(y + nhood_r + 1),
-                               (x - nhood_r):(x + nhood_r + 1)]
-            if not nhood.size:
-                # skip empty neighborhoods (which can happen at edges)
-                continue
-            local_max = np.amax(nhood)  # compute neighborhood maximum
-            if h_value == local_max:
-                corners.append((x, y, h_value))  # add to list of corners
-                h_selected[(y - nhood_r):(y + nhood_r),
-                           (x - nhood_r):(x + nhood_r)] = 0  # suppress
-                # retain maxima value to suppress others
-                h_selected.itemset((y, x), h_value)
-                # draw circle highlight (optional)
-                cv2.circle(img_out, (x, y), 5, (0, 255, 0))
+# corner locations as rows of (x, y, response), strongest first
+corners = non_max_suppression(h_selected, nhood_size)
+for x, y in np.int_(corners[:, :2]):
+    cv2.circle(img_out, (x, y), 5, (0, 255, 0))  # draw circle highlight (optional)
+
+# keep only the response of the maxima
+h_selected = np.zeros_like(h_selected)
+h_selected[np.int_(corners[:, 1]), np.int_(corners[:, 0])] = corners[:, 2]
 
 cv2.imshow("Suppressed Harris response",
            np.uint8(h_selected * (255.0 / h_max)))
 cv2.imshow("Output", img_out)
-print "\n".join("{} {}".format(corner[0], corner[1]) for corner in corners)
+print "\n".join("{} {}".format(int(corner[0]), int(corner[1])) for corner in corners)
@@ -1,6 +1,10 @@
 # Dependencies
 import os
+import sys
+import time
 import datetime
+import collections
+import multiprocessing
 import numpy as np
 import cv2
 from matplotlib.delaunay import delaunay  # for triangulation
@@ -38,10 +42,8 @@ def normalizeImage(img):
 
 
 # Warping and morphing functions
-def warpTriMesh(img, pts_orig, pts, triangles, showTriangles=False):
-    """Warp using triangle mesh interpolation (piece-wise affine transform)."""
-
-    # For each triangle, compute affine transform, use it to warp source region and combine to create warped image
+def warpTriMeshFull(img, pts_orig, pts, triangles):
+    """Reference warp: each triangle warps the whole image (O(triangles x pixels))."""
     img_size = img.shape[0:2]
     img_warped = np.zeros((img_size[0], img_size[1], 3), dtype=np.uint8)
     mask = np.zeros(img_size, dtype=np.uint8)
@@ -51,7 +53,6 @@ def warpTriMesh(img, pts_orig, pts, triangles, showTriangles=False):
         tri = pts[t]
 
         # Compute affine transform and apply it
-        # TODO: Currently very inefficient as it transforms the whole image but only uses a small region (for each triangle)!
         M_aff = cv2.getAffineTransform(tri_orig, tri)
         img_aff = cv2.warpAffine(img, M_aff, (img_size[1], img_size[0]))
 
@@ -63,11 +64,181 @@ def warpTriMesh(img, pts_orig, pts, triangles, showTriangles=False):
     return img_warped
 
 
+def clipRect(rect, img_size, pad=0):
+    """Clip an (x, y, w, h) rectangle, grown by pad pixels, to the image; returns x0, y0, x1, y1."""
+    x, y, w, h = rect
+    return (max(x - pad, 0), max(y - pad, 0),
+            min(x + w + pad, img_size[1]), min(y + h + pad, img_size[0]))
+
+
+def warpTriMeshCrop(img, pts_orig, pts, triangles):
+    """Warp only the bounding rectangle of each triangle and composite it into the output."""
+    img_size = img.shape[0:2]
+    img_warped = np.zeros((img_size[0], img_size[1], 3), dtype=np.uint8)
+    for t in triangles:
+        tri_orig = np.float32(pts_orig[t])
+        tri = np.float32(pts[t])
+
+        # Target rectangle, and source rectangle padded by a pixel for interpolation
+        x0, y0, x1, y1 = clipRect(cv2.boundingRect(tri), img_size)
+        sx0, sy0, sx1, sy1 = clipRect(cv2.boundingRect(tri_orig), img_size, 1)
+        if x1 <= x0 or y1 <= y0 or sx1 <= sx0 or sy1 <= sy0:
+            continue
+
+        # Affine transform between the rectangles, applied to the source crop only
+        M_aff = cv2.getAffineTransform(tri_orig - np.float32([sx0, sy0]),
+                                       tri - np.float32([x0, y0]))
+        img_aff = cv2.warpAffine(img[sy0:sy1, sx0:sx1], M_aff, (x1 - x0, y1 - y0),
+                                 borderMode=cv2.BORDER_REFLECT_101)
+
+        # Mask out target triangle region inside the rectangle and copy it
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.fillConvexPoly(mask, np.int32(np.int_(tri) - [x0, y0]), 255)
+        roi = img_warped[y0:y1, x0:x1]
+        np.copyto(roi, img_aff, where=np.bool_(mask)[:, :, np.newaxis])
+
+    return img_warped
+
+
+def triangleIndexMap(pts, triangles, img_size):
+    """Rasterize the triangle index of each pixel (-1 where no triangle covers it)."""
+    index_map = np.full(img_size, -1, dtype=np.int32)
+    for i, t in enumerate(triangles):
+        cv2.fillConvexPoly(index_map, np.int32(np.int_(pts[t])), int(i))
+
+    return index_map
+
+
+def inverseAffineTransforms(pts_orig, pts, triangles):
+    """Affine transforms (n x 2 x 3) mapping each current triangle back to its original one."""
+    triangles = np.asarray(triangles)
+    tri = np.float64(pts)[triangles]  # n x 3 x 2
+    tri_orig = np.float64(pts_orig)[triangles]
+
+    # Solve [x y 1] A^T = [x_orig y_orig] for all triangles at once
+    D = np.concatenate((tri, np.ones(tri.shape[:2] + (1,))), axis=2)  # n x 3 x 3
+    degenerate = np.abs(np.linalg.det(D)) < 1e-9  # no pixels, any transform will do
+    D[degenerate] = np.eye(3)
+    return np.linalg.solve(D, tri_orig).transpose(0, 2, 1)
+
+
+def warpMaps(pts_orig, pts, triangles, index_map):
+    """Dense source coordinates of every pixel for cv2.remap, from a triangle index map."""
+    coeffs = inverseAffineTransforms(pts_orig, pts, triangles).reshape(-1, 6)
+    # Index -1 picks this last row, which maps uncovered pixels outside the image (black)
+    coeffs = np.float32(np.vstack((coeffs, [0, 0, -1, 0, 0, -1])))
+
+    ys, xs = np.indices(index_map.shape, dtype=np.float32)
+    c = coeffs[index_map]  # h x w x 6
+    map_x = c[..., 0] * xs + c[..., 1] * ys + c[..., 2]
+    map_y = c[..., 3] * xs + c[..., 4] * ys + c[..., 5]
+
+    return map_x, map_y
+
+
+def warpTriMeshRemap(img, pts_orig, pts, triangles, index_map=None):
+    """Warp with a single cv2.remap over a per-pixel map built from the triangle index map.
+    The index map depends only on pts, so it can be shared by warps to the same points."""
+    if index_map is None:
+        index_map = triangleIndexMap(pts, triangles, img.shape[0:2])
+    map_x, map_y = warpMaps(pts_orig, pts, triangles, index_map)
+
+    return cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+
+warp_methods = {"full": warpTriMeshFull, "crop": warpTriMeshCrop, "remap": warpTriMeshRemap}
+
+
+def warpTriMesh(img, pts_orig, pts, triangles, showTriangles=False, method="remap"):
+    """Warp using triangle mesh interpolation (piece-wise affine transform).
+
+    method: "remap" (one dense map, default), "crop" (per-triangle bounding rectangles)
+    or "full" (per-triangle full image warps, slow reference)."""
+    img_warped = warp_methods[method](img, pts_orig, pts, triangles)
+
+    if showTriangles:
+        drawTriangles(img_warped, triangles, pts)
+
+    return img_warped
+
+
+# Per-process morph state, set once per worker by initFrameRenderer() instead of pickling it with each frame
+frame_state = {}
+
+
+def initFrameRenderer(state):
+    """Store the images, points, triangles and drawing options used by renderFrame()."""
+    frame_state.clear()
+    frame_state.update(state)
+
+
+def renderFrame(t):
+    """Render the morph frame at time t (0 = src, 1 = dst) from frame_state."""
+    st = frame_state
+    pts_src, pts_dst, triangles = st["pts_src"], st["pts_dst"], st["triangles"]
+
+    # Interpolate to find points at time t
+    pts = t * pts_dst + (1.0 - t) * pts_src
+    color = np.uint8(t * np.float32(st["color_dst"]) +
+                     (1.0 - t) * np.float32(st["color_src"])).tolist()
+
+    if st["warp_method"] == "remap":
+        # Both warps target the same points: rasterize triangles once per frame
+        index_map = triangleIndexMap(pts, triangles, st["img_src"].shape[0:2])
+        img_src_warped = warpTriMeshRemap(st["img_src"], pts_src, pts, triangles, index_map)
+        img_dst_warped = warpTriMeshRemap(st["img_dst"], pts_dst, pts, triangles, index_map)
+    else:
+        img_src_warped = warpTriMesh(st["img_src"], pts_src, pts, triangles, method=st["warp_method"])
+        img_dst_warped = warpTriMesh(st["img_dst"], pts_dst, pts, triangles, method=st["warp_method"])
+
+    # Alpha-blend with alpha_dst = t, alpha_src = 1 - t
+    img_out = blend(img_dst_warped, img_src_warped, t)
+
+    if st["show_triangles"]:
+        # draw current delaunay triangulation
+        drawTriangles(img_out, triangles, pts, st["color_tri"])
+
+    if st["show_points"]:
+        # draw points with blended color
+        drawPoints(img_out, pts, color, color)
+
+    return img_out
+
+
+def renderFrames(state, times, workers=1, queue_size=8):
+    """Yield rendered frames in order of times.
+
+    With workers > 1, frames are rendered in a process pool. At most queue_size frames are
+    in flight (rendering or waiting to be consumed), so memory stays bounded when the
+    consumer, e.g. a VideoWriter, is slower than rendering."""
+    if workers is None or workers > 1:
+        pool = multiprocessing.Pool(workers, initFrameRenderer, (state,))
+        pending = collections.deque()
+        try:
+            for t in times:
+                pending.append(pool.apply_async(renderFrame, (t,)))
+                if len(pending) >= queue_size:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()  # also drops pending frames on early exit
+            pool.join()
+    else:
+        initFrameRenderer(state)
+        for t in times:
+            yield renderFrame(t)
+
+
 def morph(img_src, img_dst, pts_src, pts_dst,
           num_frames=11, animate=True, save_video=False,
           show_points=True, show_triangles=True,
-          color_src=(255, 0, 0), color_dst=(0, 0, 255), color_tri=(0, 255, 0)):
-    """Morph two images, given corresponding points."""
+          color_src=(255, 0, 0), color_dst=(0, 0, 255), color_tri=(0, 255, 0),
+          warp_method="remap", workers=1, queue_size=8, video_filename=None):
+    """Morph two images, given corresponding points.
+
+    workers > 1 renders frames in parallel processes (None: one per core), streamed in order
+    to the display and video file through a queue of at most queue_size frames."""
 
     # Check arguments
     assert img_src.shape == img_dst.shape, "Image dimensions do not match"
@@ -92,43 +263,27 @@ def morph(img_src, img_dst, pts_src, pts_dst,
     centers, edges, triangles, neighbors = delaunay(
         pts_dst[:, 0], pts_dst[:, 1])
 
+    state = dict(img_src=img_src, img_dst=img_dst, pts_src=pts_src, pts_dst=pts_dst,
+                 triangles=triangles, show_points=show_points, show_triangles=show_triangles,
+                 color_src=color_src, color_dst=color_dst, color_tri=color_tri,
+                 warp_method=warp_method)
+
     # Morph loop
+    frames = None
     try:
         if save_video:
-            video_filename = os.path.join(out_dir, "morph_{}{}".format(
-                datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), video_suffix))
+            if video_filename is None:
+                video_filename = os.path.join(out_dir, "morph_{}{}".format(
+                    datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), video_suffix))
             video_out = cv2.VideoWriter()
             if video_out.open(video_filename, video_fourcc, video_fps, (img_size[1], img_size[0])):
                 print "morph(): Writing video to file: {}".format(video_filename)
             else:
-                print >> stderr, "morph(): Unable to create video file: {}".format(video_filename)
+                print >> sys.stderr, "morph(): Unable to create video file: {}".format(video_filename)
                 save_video = False
 
-        for t in np.linspace(0.0, 1.0, num_frames):
-            # Interpolate to find points at time t
-            pts = t * pts_dst + (1.0 - t) * pts_src
-            color = np.uint8(t * np.float32(color_dst) +
-                             (1.0 - t) * np.float32(color_src)).tolist()
-
-            # Warp src
-            img_src_warped = warpTriMesh(img_src, pts_src, pts, triangles)
-            img_out = img_src_warped  # [debug]
-
-            # Warp dst
-            img_dst_warped = warpTriMesh(img_dst, pts_dst, pts, triangles)
-            img_out = img_dst_warped  # [debug]
-
-            # Alpha-blend with alpha_dst = t, alpha_src = 1 - t
-            img_out = blend(img_dst_warped, img_src_warped, t)
-
-            if show_triangles:
-                # draw current delaunay triangulation
-                drawTriangles(img_out, triangles, pts, color_tri)
-
-            if show_points:
-                # draw points with blended color
-                drawPoints(img_out, pts, color, color)
-
+        frames = renderFrames(state, np.linspace(0.0, 1.0, num_frames), workers, queue_size)
+        for img_out in frames:
             if animate:
                 cv2.imshow("Morph", img_out)
                 key = cv2.waitKey(20)
@@ -141,6 +296,9 @@ def morph(img_src, img_dst, pts_src, pts_dst,
                 video_out.write(img_out)
     except KeyboardInterrupt:
         pass  # Ctrl+C to break from terminal
+    finally:
+        if frames is not None:
+            frames.close()  # stop the worker pool
 
     if save_video:
         video_out.release()
@@ -148,6 +306,17 @@ def morph(img_src, img_dst, pts_src, pts_dst,
         print "morph(): Done writing video."
 
 
+def morphBatch(img_src, img_dst, pts_src, pts_dst, num_frames=11, video_filename=None,
+               workers=None, queue_size=8, **kwargs):
+    """Headless morph straight to a video file (no windows), rendering on all cores by default."""
+    if video_filename is None and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    t0 = time.time()
+    morph(img_src, img_dst, pts_src, pts_dst, num_frames, animate=False, save_video=True,
+          workers=workers, queue_size=queue_size, video_filename=video_filename, **kwargs)
+    print "morphBatch(): {} frames in {:.2f}s".format(num_frames, time.time() - t0)
+
+
 # Main script
 if __name__ == "__main__":
     # Read two images: We want to morph from src to dst
@@ -191,4 +360,5 @@ if __name__ == "__main__":
     # morph(img_src, img_dst, pts_src, pts_dst, num_frames, save_video=True)  # save video, showing control points and triangles
     morph(img_src, img_dst, pts_src, pts_dst, num_frames, save_video=True, show_points=False,
           show_triangles=False)  # save clean video, hiding control points and triangles
+    # morphBatch(img_src, img_dst, pts_src, pts_dst, 301, show_points=False, show_triangles=False)  # headless, all cores
     # cv2.waitKey(3000)  # wait for up to 3 secs.
@@ -0,0 +1,112 @@
+"""
+Export the landmark model for CPU inference without a TensorFlow session.
+
+The SavedModel exported by landmark.py resizes its input in a tf.map_fn loop,
+which OpenCV can not import. Here the inference graph is rebuilt from model.py
+with a fixed 128x128 input, the trained weights are restored into it and
+folded into constants. The frozen graph is loaded by cv2.dnn, the TensorFlow
+Lite model (optionally float16 or int8 quantized) by a TFLite interpreter.
+"""
+
+import argparse
+import os
+
+import tensorflow as tf
+
+from model import LandmarkModel
+
+# add arguments parser to accept user specified arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--weights", default="train", type=str,
+                    help="SavedModel directory or training model directory")
+parser.add_argument("--frozenGraph", default="landmark.pb", type=str,
+                    help="frozen graph file for cv2.dnn.readNetFromTensorflow")
+parser.add_argument("--tflite", default=None, type=str,
+                    help="TensorFlow Lite model file, not exported if not given")
+parser.add_argument("--quantize", default="none", choices=["none", "float16", "int8"],
+                    help="weight quantization of the TensorFlow Lite model")
+
+# same input as the training data, see landmark.py
+IMG_WIDTH = 128
+IMG_HEIGHT = 128
+IMG_CHANNEL = 3
+
+INPUT_NAME = "image_tensor"
+OUTPUT_NAME = "layer6/final_dense"
+
+
+def buildInferenceGraph():
+    """Placeholder for a batch of 128x128 RGB faces and the marks tensor,
+    in the default graph"""
+    imageTensor = tf.compat.v1.placeholder(
+        shape=[None, IMG_HEIGHT, IMG_WIDTH, IMG_CHANNEL], dtype=tf.float32,
+        name=INPUT_NAME)
+    logits = LandmarkModel(outputSize=68*2)(imageTensor)
+    return imageTensor, logits
+
+
+def restoreWeights(sess, weights):
+    """Restore the variables from a SavedModel or a training checkpoint.
+    Variable names are the same, as both graphs are built by LandmarkModel."""
+    if os.path.isdir(os.path.join(weights, "variables")):
+        checkpoint = os.path.join(weights, "variables", "variables")
+    else:
+        checkpoint = tf.train.latest_checkpoint(weights)
+    tf.compat.v1.train.Saver().restore(sess, checkpoint)
+
+
+def foldConstants(graphDef):
+    """Strip training and identity nodes and fold constant subgraphs"""
+    graphDef = tf.compat.v1.graph_util.remove_training_nodes(
+        graphDef, protected_nodes=[OUTPUT_NAME])
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        # graph transforms are not shipped with TensorFlow 2
+        return graphDef
+    return TransformGraph(graphDef, [INPUT_NAME], [OUTPUT_NAME], [
+        "strip_unused_nodes",
+        "fold_constants(ignore_errors=true)",
+        "fold_batch_norms",
+        "sort_by_execution_order"])
+
+
+def exportModels(weights, frozenGraph, tflite=None, quantize="none"):
+    """Freeze the landmark model into frozenGraph, and into a TensorFlow Lite
+    model if tflite is given"""
+    graph = tf.Graph()
+    with graph.as_default():
+        imageTensor, logits = buildInferenceGraph()
+        with tf.compat.v1.Session(graph=graph) as sess:
+            restoreWeights(sess, weights)
+            graphDef = tf.compat.v1.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), [OUTPUT_NAME])
+            graphDef = foldConstants(graphDef)
+            with tf.io.gfile.GFile(frozenGraph, "wb") as fid:
+                fid.write(graphDef.SerializeToString())
+            print("Frozen graph with {} nodes written to {}".format(
+                len(graphDef.node), frozenGraph))
+
+            if tflite is not None:
+                converter = tf.compat.v1.lite.TFLiteConverter.from_session(
+                    sess, [imageTensor], [logits])
+                if quantize != "none":
+                    # int8 weights, dequantized or run with int8 kernels at load time
+                    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                if quantize == "float16":
+                    converter.target_spec.supported_types = [tf.float16]
+                with tf.io.gfile.GFile(tflite, "wb") as fid:
+                    fid.write(converter.convert())
+                print("TensorFlow Lite model ({} weights) written to {}".format(
+                    "float32" if quantize == "none" else quantize, tflite))
+
+
+def main(unusedArgv):
+    """Export the trained model"""
+    args = parser.parse_args(unusedArgv[1:])
+    exportModels(args.weights, args.frozenGraph, args.tflite, args.quantize)
+
+
+if __name__ == "__main__":
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+    tf.compat.v1.app.run(main)
@@ -4,18 +4,21 @@ Human face is detected by a detector from an OpenCV DNN module.
 Then, the face box is slightly modified to suit the need of landmark detection.
 Facial landmark detection is done by a custom Convolutional Neural Network trained with TensorFlow.
 Finally, head pose is estimated by solving a PnP problem.
+By default the steps run as a pipeline of processes, see pipeline.py.
 """
 
 from argparse import ArgumentParser
 from multiprocessing import Process, Queue
+import time
 
 from cv2 import cv2
 import numpy as np
 
 from markDetector import MarkDetector
 from osDetector import detectOS
+from pipeline import HeadPosePipeline, startCapture
 from poseEstimator import PoseEstimator
-from stabilizer import Stabilizer
+from stabilizer import BatchStabilizer
 
 print("OpenCV version: {}".format(cv2.__version__))
 
@@ -30,6 +33,14 @@ parser.add_argument("--video", type=str, default=None,
                     help="Video file to be processed.")
 parser.add_argument("--cam", type=int, default=None,
                     help="The webcam index.")
+parser.add_argument("--queueSize", type=int, default=2,
+                    help="Frames queued between pipeline stages, older frames are dropped.")
+parser.add_argument("--detectInterval", type=int, default=1,
+                    help="Detect faces every N frames and track them with optical flow in between.")
+parser.add_argument("--landmarkModel", type=str, default="assets/poseModel",
+                    help="Landmark SavedModel, or frozen graph (.pb) or TensorFlow Lite model exported by export.py.")
+parser.add_argument("--sequential", action="store_true",
+                    help="Run landmark detection and pose estimation in the display loop.")
 args = parser.parse_args()
 
 
@@ -41,9 +52,8 @@ def getFace(detector, imgQueue, boxQueue):
         boxQueue.put(box)
 
 
-def main():
-    """MAIN"""
-    # video source from webcam or video file
+def openVideoSource():
+    """Open the webcam or video file given in the arguments"""
     videoSource = args.cam if args.cam is not None else args.video
     if videoSource is None:
         print("Warning: video source not assigned, default webcam will be used.")
@@ -52,10 +62,71 @@ def main():
     cap = cv2.VideoCapture(videoSource)
     if videoSource == 0:
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    return cap, videoSource
+
+
+def main():
+    """Pipelined pose estimation: capture, detection, landmarks and pose in parallel"""
+    cap, videoSource = openVideoSource()
+    _, sampleFrame = cap.read()
+
+    pipeline = HeadPosePipeline(sampleFrame.shape, queueSize=args.queueSize,
+                                detectInterval=args.detectInterval,
+                                landmarkModel=args.landmarkModel).start()
+    captureDone = startCapture(cap, pipeline, flip=videoSource == 0)
+
+    # pose estimator for drawing only, poses are solved in the pipeline
+    height, width = sampleFrame.shape[:2]
+    poseEstimator = PoseEstimator(imgSize=(height, width))
+
+    lastReport = time.time()
+    trackingStats = None
+    try:
+        while not (captureDone.is_set() and pipeline.idle()):
+            result = pipeline.get()
+            if result is None:
+                continue
+            _, slot, captureTime, data = result
+            start = time.time()
+            frame = pipeline.frames[slot].copy()
+            pipeline.release(slot, captureTime, time.time() - start)
+            trackingStats = data.get("trackingStats", trackingStats)
+
+            if data["steadyPose"] is not None:
+                steadyPose = data["steadyPose"]
+                poseEstimator.drawAnnotationBox(
+                    frame, steadyPose[0], steadyPose[1], color=(128, 255, 128))
+
+            # uncomment following line to draw the other faces too
+            # for pose in data["poses"][1:]:
+            #     poseEstimator.drawAnnotationBox(frame, pose[0], pose[1], color=(255, 128, 128))
+
+            # Show preview.
+            cv2.imshow("Preview", frame)
+            if cv2.waitKey(1) == 27:
+                break
+
+            if time.time() - lastReport > 5.0:
+                print(pipeline.report())
+                if trackingStats is not None:
+                    print(trackingStats)
+                lastReport = time.time()
+    finally:
+        captureDone.set()
+        pipeline.close()
+        print(pipeline.report())
+        if trackingStats is not None:
+            print(trackingStats)
+
+
+def mainSequential():
+    """Detection in a separate process, landmarks and pose in the display loop"""
+    # video source from webcam or video file
+    cap, videoSource = openVideoSource()
     _, sampleFrame = cap.read()
 
     # introduce markDetector to detect landmarks
-    markDetector = MarkDetector()
+    markDetector = MarkDetector(args.landmarkModel)
 
     # setup process and queues for multiprocessing
     imgQueue = Queue()
@@ -70,12 +141,13 @@ def main():
     height, width = sampleFrame.shape[:2]
     poseEstimator = PoseEstimator(imgSize=(height, width))
 
-    # introduce scalar stabilizers for pose
-    poseStabilizers = [Stabilizer(
+    # introduce scalar stabilizers for the 6 pose values
+    poseStabilizer = BatchStabilizer(
+        6,
         stateNum=2,
         measureNum=1,
         covProcess=0.1,
-        covMeasure=0.1) for _ in range(6)]
+        covMeasure=0.1)
 
     tm = cv2.TickMeter()
 
@@ -129,12 +201,8 @@ def main():
             pose = poseEstimator.solvePoseBy68Points(marks)
 
             # stabilize the pose
-            steadyPose = []
-            poseNp = np.array(pose).flatten()
-            for value, psStb in zip(poseNp, poseStabilizers):
-                psStb.update([value])
-                steadyPose.append(psStb.state[0])
-            steadyPose = np.reshape(steadyPose, (-1, 3))
+            poseStabilizer.update(np.array(pose).flatten())
+            steadyPose = np.reshape(poseStabilizer.state[:, 0], (-1, 3))
 
             # uncomment following line to draw pose annotation on frame
             # poseEstimator.drawAnnotationBox(frame, pose[0], pose[1], color=(255, 128, 128))
@@ -157,4 +225,7 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    if args.sequential:
+        mainSequential()
+    else:
+        main()
@@ -0,0 +1,200 @@
+"""
+Track-then-detect scheduling of face and landmark detection.
+The CNN face and landmark detectors run every detectInterval frames only. In
+between, the 68 marks of every face are propagated by the Lucas-Kanade tracker
+with forward-backward verification, and the face box follows the similarity
+transform of the marks. Detection runs early when tracking loses confidence.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from opticalFlowTracker import Tracker
+
+
+class TrackingStats:
+    """How often detection was triggered, and why"""
+
+    REASONS = ("start", "interval", "noFace", "lost", "confidence", "outside")
+
+    def __init__(self):
+        self.frames = 0
+        self.detections = 0
+        self.reasons = dict((reason, 0) for reason in self.REASONS)
+        self.detectTime = 0.0
+        self.trackTime = 0.0
+        self.drifts = []
+
+    def record(self, reason, busy):
+        self.frames += 1
+        if reason is None:
+            self.trackTime += busy
+        else:
+            self.detections += 1
+            self.reasons[reason] += 1
+            self.detectTime += busy
+
+    def recordDrift(self, drift):
+        self.drifts.append(drift)
+
+    def summary(self):
+        tracked = self.frames - self.detections
+        detectMs = 1000.0 * self.detectTime / self.detections if self.detections else 0.0
+        trackMs = 1000.0 * self.trackTime / tracked if tracked else 0.0
+        triggers = ", ".join("{} {}".format(reason, self.reasons[reason])
+                             for reason in self.REASONS if self.reasons[reason])
+        drift = np.mean(self.drifts) if self.drifts else 0.0
+        return ("{} frames, detection on {} ({:.1f}%): {}\n"
+                "{:.1f} ms/frame detecting, {:.1f} ms/frame tracking, "
+                "{:.1f} ms/frame overall, {:.2f} px mark drift at re-detection").format(
+                    self.frames, self.detections,
+                    100.0 * self.detections / max(self.frames, 1), triggers or "none",
+                    detectMs, trackMs,
+                    1000.0 * (self.detectTime + self.trackTime) / max(self.frames, 1), drift)
+
+
+class FaceTracker:
+    """Face boxes and marks of every frame, detected or tracked.
+
+    update(frame) returns (faceboxes, marks, detected) like
+    MarkDetector.detectFacesMarks, plus whether the CNNs ran on this frame."""
+
+    def __init__(self, markDetector, detectInterval=10, minValidRatio=0.7,
+                 maxError=1.0, refineMarks=False):
+        """
+        :param markDetector: MarkDetector used on detection frames
+        :param detectInterval: detect at least every detectInterval frames
+        :param minValidRatio: detect when fewer marks of a face are tracked
+        :param maxError: largest forward-backward error of a tracked mark, in pixels
+        :param refineMarks: run the landmark CNN on the tracked boxes of every
+            frame, so only face detection is skipped
+        """
+        self.markDetector = markDetector
+        self.detectInterval = detectInterval
+        self.minValidRatio = minValidRatio
+        self.maxError = maxError
+        self.refineMarks = refineMarks
+        self.tracker = Tracker()
+        self.stats = TrackingStats()
+
+        self.prevGray = None
+        self.faceboxes = []
+        self.marks = np.zeros((0, 68, 2), np.float32)
+        self.sinceDetection = 0
+
+    def detect(self, frame):
+        faceboxes, marks, _ = self.markDetector.detectFacesMarks(frame)
+        return faceboxes, np.float32(marks)
+
+    @staticmethod
+    def moveFacebox(box, transform, image):
+        """Box moved, scaled and kept square by a 2x3 similarity transform,
+        or None if it left the image"""
+        center = np.array([(box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0, 1.0])
+        cx, cy = transform.dot(center)
+        half = 0.5 * (box[2] - box[0]) * np.sqrt(abs(np.linalg.det(transform[:, :2])))
+        size = int(round(2 * half))
+        xLeft, yTop = int(round(cx - half)), int(round(cy - half))
+        facebox = [xLeft, yTop, xLeft + size, yTop + size]
+        rows, cols = image.shape[:2]
+        if size <= 0 or xLeft < 0 or yTop < 0 or facebox[2] > cols or facebox[3] > rows:
+            return None
+        return facebox
+
+    def track(self, gray, frame):
+        """Propagate boxes and marks to the frame.
+        Returns faceboxes, marks and the reason to detect instead, or None"""
+        numFaces, numMarks = self.marks.shape[:2]
+        points, valid, _ = self.tracker.trackPoints(
+            self.prevGray, gray, self.marks.reshape(-1, 2), self.maxError)
+        points = points.reshape(numFaces, numMarks, 2)
+        valid = valid.reshape(numFaces, numMarks)
+
+        faceboxes, marks = [], np.empty_like(self.marks)
+        for i in range(numFaces):
+            if valid[i].mean() < self.minValidRatio:
+                return None, None, "confidence"
+            transform, _ = cv2.estimateAffinePartial2D(
+                self.marks[i][valid[i]], points[i][valid[i]])
+            if transform is None:
+                return None, None, "lost"
+            facebox = self.moveFacebox(self.faceboxes[i], transform, frame)
+            if facebox is None:
+                return None, None, "outside"
+
+            # marks that failed verification follow the face motion
+            moved = cv2.transform(self.marks[i][None], transform)[0]
+            marks[i] = np.where(valid[i][:, None], points[i], moved)
+            faceboxes.append(facebox)
+
+        if self.refineMarks:
+            marks = np.float32(self.markDetector.marksToImage(
+                self.markDetector.detectMarksBatch(
+                    self.markDetector.cropFaces(frame, faceboxes)), faceboxes))
+        return faceboxes, marks, None
+
+    @staticmethod
+    def drift(trackedMarks, marks):
+        """Mean distance in pixels between tracked marks and the detected marks
+        of the closest detected face"""
+        distances = np.linalg.norm(
+            trackedMarks[:, None] - marks[None], axis=-1).mean(axis=-1)
+        return distances.min(axis=1).mean()
+
+    def update(self, frame):
+        """Face boxes and marks of the next frame"""
+        start = time.time()
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        reason = None
+        if self.prevGray is None:
+            reason = "start"
+        elif self.sinceDetection >= self.detectInterval:
+            reason = "interval"
+        elif not self.faceboxes:
+            reason = "noFace"
+        else:
+            faceboxes, marks, reason = self.track(gray, frame)
+
+        if reason is None:
+            self.sinceDetection += 1
+        else:
+            trackedMarks = None
+            if reason == "interval" and self.faceboxes and not self.refineMarks:
+                # track anyway to measure how far tracking drifted from detection
+                _, trackedMarks, _ = self.track(gray, frame)
+            faceboxes, marks = self.detect(frame)
+            self.sinceDetection = 1
+            if trackedMarks is not None and len(marks):
+                self.stats.recordDrift(self.drift(trackedMarks, marks))
+
+        self.prevGray = gray
+        self.faceboxes, self.marks = faceboxes, marks
+        self.stats.record(reason, time.time() - start)
+        return faceboxes, marks, reason is not None
+
+
+def main():
+    """Compare detection on every frame against track-then-detect on a video"""
+    import sys
+    videoSource = sys.argv[1] if len(sys.argv) > 1 else 0
+    detectInterval = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    from markDetector import MarkDetector
+    markDetector = MarkDetector()
+    for interval in (1, detectInterval):
+        cap = cv2.VideoCapture(videoSource)
+        faceTracker = FaceTracker(markDetector, detectInterval=interval)
+        while True:
+            frameGot, frame = cap.read()
+            if frameGot is False:
+                break
+            faceTracker.update(frame)
+        cap.release()
+        print("detectInterval {}: {}".format(interval, faceTracker.stats.summary()))
+
+
+if __name__ == '__main__':
+    main()
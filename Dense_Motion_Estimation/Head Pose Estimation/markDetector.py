@@ -1,8 +1,10 @@
 """Human facial landmark detector based on Convolutional Neural Network"""
 
+import os
+import time
+
 from cv2 import cv2
 import numpy as np
-import tensorflow as tf
 
 
 class FaceDetector:
@@ -63,14 +65,31 @@ class FaceDetector:
 class MarkDetector:
     """Facial landmark detector by Convolutional Neural Network"""
 
-    def __init__(self, savedModel='assets/poseModel'):
-        """Initialization"""
+    def __init__(self, savedModel='assets/poseModel', fp16=False):
+        """Initialization
+        :param savedModel: TensorFlow SavedModel directory, or a frozen graph
+            (.pb) or TensorFlow Lite model (.tflite) written by export.py of
+            Facial Landmark Detection, which run without a TensorFlow session
+        :param fp16: run the frozen graph in half precision, if OpenCV supports it
+        """
         # face detector is required for mark detection
         self.faceDetector = FaceDetector()
 
         self.cnnInputSize = 128
         self.marks = None
 
+        # runModel(faceImgs) returns the raw predictions of a batch of faces
+        if savedModel.endswith(".pb"):
+            self.runModel = self._loadFrozenGraph(savedModel, fp16)
+        elif savedModel.endswith(".tflite"):
+            self.runModel = self._loadTFLite(savedModel)
+        else:
+            self.runModel = self._loadSavedModel(savedModel)
+
+    def _loadSavedModel(self, savedModel):
+        """TensorFlow session running the SavedModel"""
+        import tensorflow as tf
+
         # get a TensorFlow session ready to do landmark detection
         # load a Tensorflow saved model into memory
         self.graph = tf.Graph()
@@ -81,6 +100,51 @@ class MarkDetector:
         # restore model from the savedModel file, that is exported by TensorFlow estimator
         tf.saved_model.loader.load(self.sess, ["serve"], savedModel)
 
+        # look up the input and result tensors once instead of on every call
+        self.imageTensor = self.graph.get_tensor_by_name('image_tensor:0')
+        self.logitsTensor = self.graph.get_tensor_by_name(
+            'layer6/final_dense:0')
+
+        return lambda faceImgs: self.sess.run(
+            self.logitsTensor, feed_dict={self.imageTensor: faceImgs})
+
+    @staticmethod
+    def _loadFrozenGraph(frozenGraph, fp16=False):
+        """OpenCV DNN network running the frozen graph"""
+        net = cv2.dnn.readNetFromTensorflow(frozenGraph)
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        if fp16 and hasattr(cv2.dnn, "DNN_TARGET_CPU_FP16"):
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU_FP16)
+        else:
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+        def runModel(faceImgs):
+            # NCHW float blob, faces are RGB already and the model takes 0-255 values
+            net.setInput(cv2.dnn.blobFromImages(list(faceImgs)))
+            return net.forward()
+        return runModel
+
+    @staticmethod
+    def _loadTFLite(modelFile):
+        """TensorFlow Lite interpreter, from tflite_runtime if installed"""
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        interpreter = Interpreter(model_path=modelFile)
+        interpreter.allocate_tensors()
+        inputIndex = interpreter.get_input_details()[0]['index']
+        outputIndex = interpreter.get_output_details()[0]['index']
+
+        def runModel(faceImgs):
+            if interpreter.get_input_details()[0]['shape'][0] != len(faceImgs):
+                interpreter.resize_tensor_input(inputIndex, [len(faceImgs), 128, 128, 3])
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(inputIndex, np.float32(faceImgs))
+            interpreter.invoke()
+            return interpreter.get_tensor(outputIndex)
+        return runModel
+
     @staticmethod
     def drawBox(image, boxes, boxColor=(255, 255, 255)):
         """Draw square boxes on image"""
@@ -138,41 +202,90 @@ class MarkDetector:
         cols = image.shape[1]
         return box[0] >= 0 and box[1] >= 0 and box[2] <= cols and box[3] <= rows
 
-    def extractCNNFacebox(self, image):
-        """Extract face area from image."""
-        _, rawBoxes = self.faceDetector.getFaceboxes(
-            image=image, threshold=0.9)
+    def extractCNNFaceboxes(self, image, threshold=0.9):
+        """Extract all face areas from image, as square boxes inside the image."""
+        return MarkDetector.squareFaceboxes(self.faceDetector, image, threshold)
 
+    @staticmethod
+    def squareFaceboxes(faceDetector, image, threshold=0.9):
+        """Square face boxes inside the image, from a FaceDetector.
+        Usable without loading the landmark model (eg. in a detection process)."""
+        _, rawBoxes = faceDetector.getFaceboxes(
+            image=image, threshold=threshold)
+
+        faceboxes = []
         for box in rawBoxes:
             # move box down
             # diffHeightWidth = (box[3] - box[1]) - (box[2] - box[0])
             yOffset = int(abs((box[3] - box[1]) * 0.1))
-            boxMoved = self.moveBox(box, [0, yOffset])
+            boxMoved = MarkDetector.moveBox(box, [0, yOffset])
 
             # make box square
-            facebox = self.getSquareBox(boxMoved)
+            facebox = MarkDetector.getSquareBox(boxMoved)
 
-            if self.boxInImage(facebox, image):
-                return facebox
+            if MarkDetector.boxInImage(facebox, image):
+                faceboxes.append(facebox)
 
-        return None
+        return faceboxes
 
-    def detectMarks(self, imageNp):
-        """Detect marks from image"""
-        # get result tensor by its name
-        logitsTensor = self.graph.get_tensor_by_name(
-            'layer6/final_dense:0')
-
-        # actual detection
-        predictions = self.sess.run(
-            logitsTensor,
-            feed_dict={'image_tensor:0': imageNp})
+    def extractCNNFacebox(self, image):
+        """Extract face area from image."""
+        faceboxes = self.extractCNNFaceboxes(image)
+        return faceboxes[0] if faceboxes else None
+
+    def cropFaces(self, image, faceboxes):
+        """Crop, resize and stack faces into one (N, size, size, 3) RGB batch"""
+        batch = np.empty((len(faceboxes), self.cnnInputSize,
+                          self.cnnInputSize, 3), dtype=np.uint8)
+        for i, box in enumerate(faceboxes):
+            faceImg = image[box[1]: box[3], box[0]: box[2]]
+            faceImg = cv2.resize(faceImg, (self.cnnInputSize, self.cnnInputSize))
+            cv2.cvtColor(faceImg, cv2.COLOR_BGR2RGB, dst=batch[i])
+        return batch
+
+    def detectMarksBatch(self, faceImgs):
+        """Detect marks of a batch of face images in a single model run.
+        Returns (N, 68, 2) marks in face image units (0 to 1)"""
+        if len(faceImgs) == 0:
+            return np.zeros((0, 68, 2), dtype=np.float32)
+
+        predictions = self.runModel(faceImgs)
 
         # convert predictions to landmarks
-        marks = np.array(predictions).flatten()[:136]
-        marks = np.reshape(marks, (-1, 2))
+        predictions = np.reshape(predictions, (len(faceImgs), -1))[:, :136]
+        return np.reshape(predictions, (len(faceImgs), -1, 2))
 
-        return marks
+    def detectMarks(self, imageNp):
+        """Detect marks from image"""
+        return self.detectMarksBatch(imageNp)[0]
+
+    @staticmethod
+    def marksToImage(marks, faceboxes):
+        """Convert (N, 68, 2) marks from face image units to image coordinates"""
+        boxes = np.asarray(faceboxes, dtype=np.float64).reshape(-1, 4)
+        sizes = (boxes[:, 2] - boxes[:, 0])[:, None, None]
+        return marks * sizes + boxes[:, None, :2]
+
+    def detectFacesMarks(self, image, faceboxes=None, poseEstimator=None):
+        """Detect the marks of every face of an image with one inference.
+        Faces are detected unless faceboxes are given. If a PoseEstimator is
+        given, the pose of each face is solved too.
+        Returns faceboxes, marks (N, 68, 2) in image coordinates, and a list of
+        (rotationVector, translationVector) poses (None without poseEstimator)"""
+        if faceboxes is None:
+            faceboxes = self.extractCNNFaceboxes(image)
+
+        marks = self.marksToImage(
+            self.detectMarksBatch(self.cropFaces(image, faceboxes)), faceboxes)
+
+        poses = None
+        if poseEstimator is not None:
+            # no warm start, the previous pose may belong to another face
+            rotationVectors, translationVectors, _ = poseEstimator.solveBatch(marks)
+            poses = [(r.reshape(3, 1), t.reshape(3, 1))
+                     for r, t in zip(rotationVectors, translationVectors)]
+
+        return faceboxes, marks, poses
 
     @staticmethod
     def drawMarks(image, marks, color=(255, 255, 255)):
@@ -180,3 +293,49 @@ class MarkDetector:
         for mark in marks:
             cv2.circle(image, (int(mark[0]), int(
                 mark[1])), 1, color, -1, cv2.LINE_AA)
+
+
+def benchmark(models, faceImgs, batchSizes=(1, 8), runs=20):
+    """Load time, latency per face and marks difference of landmark models,
+    compared to the first model. faceImgs is a (N, 128, 128, 3) RGB batch."""
+    print("{:>36} {:>8} {:>6} {:>10} {:>12} {:>12}".format(
+        "model", "load s", "batch", "ms/face", "mean diff", "max diff"))
+    reference = None
+    for model in models:
+        start = time.time()
+        markDetector = MarkDetector(model)
+        loadTime = time.time() - start
+
+        marks = markDetector.detectMarksBatch(faceImgs)
+        if reference is None:
+            reference = marks
+        # difference in pixels of the 128x128 face image
+        diff = np.abs(marks - reference) * markDetector.cnnInputSize
+
+        for batchSize in batchSizes:
+            batch = faceImgs[:batchSize]
+            markDetector.detectMarksBatch(batch)
+            start = time.time()
+            for _ in range(runs):
+                markDetector.detectMarksBatch(batch)
+            perFace = 1000.0 * (time.time() - start) / (runs * len(batch))
+            print("{:>36} {:>8.2f} {:>6} {:>10.2f} {:>12.3f} {:>12.3f}".format(
+                os.path.basename(model.rstrip("/")), loadTime, len(batch), perFace,
+                diff.mean(), diff.max()))
+
+
+if __name__ == "__main__":
+    import sys
+    # python3 markDetector.py video.mp4 assets/poseModel landmark.pb landmark.tflite
+    cap = cv2.VideoCapture(sys.argv[1])
+    detector = FaceDetector()
+    faces = []
+    while len(faces) < 64:
+        frameGot, frame = cap.read()
+        if frameGot is False:
+            break
+        faceboxes = MarkDetector.squareFaceboxes(detector, frame)
+        faces.extend(frame[b[1]:b[3], b[0]:b[2]] for b in faceboxes)
+    faceImgs = np.array([cv2.cvtColor(cv2.resize(face, (128, 128)), cv2.COLOR_BGR2RGB)
+                         for face in faces])
+    benchmark(sys.argv[2:], faceImgs)
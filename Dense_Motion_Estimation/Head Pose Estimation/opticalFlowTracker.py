@@ -23,27 +23,38 @@ class Tracker:
                                   minDistance=7,
                                   blockSize=7)
 
-    def updateTracks(self, imgOld, imgNew):
-        """Update tracks"""
-        # get old points, using the latest one.
-        pointsOld = np.float32([track[-1]
-                                for track in self.tracks]).reshape(-1, 1, 2)
+    def trackPoints(self, imgOld, imgNew, pointsOld, maxError=1.0):
+        """Track points from imgOld to imgNew, verified by back-tracking.
+        Returns the new points (N, 2), whether each point is valid and the
+        forward-backward error of each point"""
+        pointsOld = np.float32(pointsOld).reshape(-1, 1, 2)
+        if len(pointsOld) == 0:
+            return np.zeros((0, 2), np.float32), np.zeros(0, bool), np.zeros(0, np.float32)
 
         # get new points from old points.
-        pointsNew, _st, _err = cv2.calcOpticalFlowPyrLK(
+        pointsNew, statusNew, _err = cv2.calcOpticalFlowPyrLK(
             imgOld, imgNew, pointsOld, None, **self.lkParams)
 
         # get inferred old points from new points.
-        pointsOldInferred, _st, _err = cv2.calcOpticalFlowPyrLK(
+        pointsOldInferred, statusOld, _err = cv2.calcOpticalFlowPyrLK(
             imgNew, imgOld, pointsNew, None, **self.lkParams)
 
         # compare between old points and inferred old points
         errorTerm = abs(
             pointsOld - pointsOldInferred).reshape(-1, 2).max(-1)
-        pointValid = errorTerm < 1
+        pointValid = (errorTerm < maxError) & (statusNew.ravel() == 1) & (statusOld.ravel() == 1)
+        return pointsNew.reshape(-1, 2), pointValid, errorTerm
+
+    def updateTracks(self, imgOld, imgNew):
+        """Update tracks"""
+        # get old points, using the latest one.
+        pointsOld = np.float32([track[-1]
+                                for track in self.tracks]).reshape(-1, 1, 2)
+
+        pointsNew, pointValid, _error = self.trackPoints(imgOld, imgNew, pointsOld)
 
         newTracks = []
-        for track, (x, y), goodFlag in zip(self.tracks, pointsNew.reshape(-1, 2), pointValid):
+        for track, (x, y), goodFlag in zip(self.tracks, pointsNew, pointValid):
             # is track good?
             if not goodFlag:
                 continue
@@ -0,0 +1,346 @@
+"""
+Pipelined head pose estimation.
+Capture, face detection, landmark detection and pose estimation run as separate
+stages connected by bounded queues, so a slow stage no longer stalls the others.
+When a queue is full the oldest frame in it is dropped: the latest frame wins.
+Frames are passed between processes through slots of a shared memory buffer,
+only the slot index and the small per-frame results are pickled.
+"""
+
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import Array, Event, Process, Queue, RawArray, Value
+
+from cv2 import cv2
+import numpy as np
+
+
+class FrameBuffer:
+    """Ring of frame slots in shared memory.
+    Free slot indices are handed out through a queue. A slot is owned by the
+    frame written to it until that frame is displayed or dropped. The slots in
+    use are counted in shared memory, as Queue.qsize() is not available on
+    every platform."""
+
+    def __init__(self, frameShape, numSlots=8):
+        self.frameShape = tuple(frameShape)
+        self.numSlots = numSlots
+        self.buffer = RawArray('B', int(numSlots * np.prod(self.frameShape)))
+        self.freeSlots = Queue(numSlots)
+        for slot in range(numSlots):
+            self.freeSlots.put(slot)
+        self.inUse = Value('i', 0)
+
+    def frames(self):
+        """(numSlots, height, width, 3) view on the shared buffer"""
+        return np.frombuffer(self.buffer, dtype=np.uint8).reshape(
+            (self.numSlots,) + self.frameShape)
+
+    def acquire(self):
+        """A free slot index, or None if all slots are in use"""
+        try:
+            slot = self.freeSlots.get_nowait()
+        except queue.Empty:
+            return None
+        with self.inUse.get_lock():
+            self.inUse.value += 1
+        return slot
+
+    def release(self, slot):
+        with self.inUse.get_lock():
+            self.inUse.value -= 1
+        self.freeSlots.put(slot)
+
+    def framesInUse(self):
+        return self.inUse.value
+
+
+class StageStats:
+    """Counters of a stage, shared between processes: processed and dropped
+    frames, busy time and latency since capture"""
+
+    PROCESSED, BUSY, DROPPED, LATENCY = range(4)
+
+    def __init__(self, name):
+        self.name = name
+        self.values = Array('d', 4)
+
+    def record(self, busy, latency):
+        with self.values.get_lock():
+            self.values[self.PROCESSED] += 1
+            self.values[self.BUSY] += busy
+            self.values[self.LATENCY] += latency
+
+    def drop(self):
+        with self.values.get_lock():
+            self.values[self.DROPPED] += 1
+
+    def summary(self, elapsed):
+        with self.values.get_lock():
+            processed, busy, dropped, latency = self.values[:]
+        perFrame = 1000.0 * busy / processed if processed else 0.0
+        meanLatency = 1000.0 * latency / processed if processed else 0.0
+        return "{:<10} {:6.1f} fps {:7.1f} ms/frame {:7.1f} ms latency {:6d} dropped".format(
+            self.name, processed / max(elapsed, 1e-9), perFrame, meanLatency, int(dropped))
+
+
+def putLatest(outQueue, item, frameBuffer, stats):
+    """Put item on a bounded queue, dropping the oldest queued frames to make room"""
+    while True:
+        try:
+            outQueue.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                dropped = outQueue.get_nowait()
+            except queue.Empty:
+                continue
+            frameBuffer.release(dropped[1])
+            stats.drop()
+
+
+class StageError(RuntimeError):
+    """Exception raised in a stage process, re-raised by HeadPosePipeline.get()"""
+
+
+def runStage(setup, setupArgs, frameBuffer, inQueue, outQueue, stats, stop, errors):
+    """Stage process loop: take a frame item, process it, pass it on.
+    Items are (frameId, slot, captureTime, data) tuples, data is a dict of results.
+    An exception releases the slot of the frame, stops the stage and is sent
+    to the errors queue with its traceback."""
+    slot = None
+    try:
+        process = setup(*setupArgs)
+        frames = frameBuffer.frames()
+        while not stop.is_set():
+            try:
+                frameId, slot, captureTime, data = inQueue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            start = time.time()
+            data = process(frames[slot], data)
+            now = time.time()
+            stats.record(now - start, now - captureTime)
+            putLatest(outQueue, (frameId, slot, captureTime, data), frameBuffer, stats)
+            slot = None
+    except Exception:
+        if slot is not None:
+            frameBuffer.release(slot)
+        errors.put("{} stage failed:\n{}".format(stats.name, traceback.format_exc()))
+
+
+# Stage setups, run inside the stage process. Each returns process(frame, data) -> data.
+
+def setupFaceDetection():
+    from markDetector import FaceDetector, MarkDetector
+    faceDetector = FaceDetector()
+
+    def process(frame, data):
+        data["faceboxes"] = MarkDetector.squareFaceboxes(faceDetector, frame)
+        return data
+    return process
+
+
+def setupLandmarks(landmarkModel):
+    from markDetector import MarkDetector
+    markDetector = MarkDetector(landmarkModel)
+
+    def process(frame, data):
+        faceboxes = data["faceboxes"]
+        faces = markDetector.cropFaces(frame, faceboxes)
+        data["marks"] = markDetector.marksToImage(
+            markDetector.detectMarksBatch(faces), faceboxes)
+        return data
+    return process
+
+
+def setupTracking(detectInterval, landmarkModel):
+    """Face and landmark detection every detectInterval frames, tracking in between"""
+    from faceTracker import FaceTracker
+    from markDetector import MarkDetector
+    faceTracker = FaceTracker(MarkDetector(landmarkModel), detectInterval=detectInterval)
+
+    def process(frame, data):
+        data["faceboxes"], data["marks"], detected = faceTracker.update(frame)
+        if detected:
+            data["trackingStats"] = faceTracker.stats.summary()
+        return data
+    return process
+
+
+def setupPose(imgSize, maxError=10.0):
+    """Poses of all faces, solved from scratch: the detector does not keep
+    faces in the same order, so the last pose of a face index may belong to
+    another face. Solves with an RMS reprojection error above maxError pixels
+    are not used for the steady pose"""
+    from poseEstimator import PoseEstimator
+    from stabilizer import BatchStabilizer
+    poseEstimator = PoseEstimator(imgSize=imgSize)
+
+    # scalar stabilizers for the 6 pose values of the first face
+    poseStabilizer = BatchStabilizer(
+        6,
+        stateNum=2,
+        measureNum=1,
+        covProcess=0.1,
+        covMeasure=0.1)
+
+    def process(frame, data):
+        marks = data["marks"]
+        rotationVectors, translationVectors, errors = poseEstimator.solveBatch(
+            marks, maxError=maxError)
+        poses = [(r.reshape(3, 1), t.reshape(3, 1))
+                 for r, t in zip(rotationVectors, translationVectors)]
+        data["poses"] = poses
+        data["poseErrors"] = errors
+
+        data["steadyPose"] = None
+        if poses and errors[0] <= maxError:
+            poseStabilizer.update(np.array(poses[0]).flatten())
+            data["steadyPose"] = np.reshape(poseStabilizer.state[:, 0], (-1, 3))
+        return data
+    return process
+
+
+class HeadPosePipeline:
+    """Face detection, landmark detection and pose estimation processes
+    connected by bounded queues of at most queueSize frames each.
+
+    submit() frames from the capture loop, get() results in the display loop and
+    release() their slot once the frame has been used."""
+
+    def __init__(self, frameShape, queueSize=2, numSlots=None, stages=None, detectInterval=1,
+                 landmarkModel='assets/poseModel'):
+        """
+        :param frameShape: (height, width, 3) of the frames
+        :param stages: list of (name, setup, setupArgs), defaults to detection,
+            landmarks and pose
+        :param detectInterval: if above 1, default stages detect faces and marks
+            every detectInterval frames only and track them in between
+        :param landmarkModel: SavedModel, frozen graph or TensorFlow Lite model
+            of the landmark CNN, see MarkDetector
+        """
+        if stages is None and detectInterval > 1:
+            stages = [("track", setupTracking, (detectInterval, landmarkModel)),
+                      ("pose", setupPose, (tuple(frameShape[:2]),))]
+        elif stages is None:
+            stages = [("detect", setupFaceDetection, ()),
+                      ("landmarks", setupLandmarks, (landmarkModel,)),
+                      ("pose", setupPose, (tuple(frameShape[:2]),))]
+        if numSlots is None:
+            # every queue full, every stage busy, plus the frames in capture and display
+            numSlots = (len(stages) + 1) * queueSize + len(stages) + 2
+
+        self.frameBuffer = FrameBuffer(frameShape, numSlots)
+        self.frames = self.frameBuffer.frames()
+        self.queues = [Queue(queueSize) for _ in range(len(stages) + 1)]
+        self.stop = Event()
+        self.errors = Queue()
+        self.captureStats = StageStats("capture")
+        self.displayStats = StageStats("display")
+        self.stageStats = [StageStats(name) for name, _, _ in stages]
+        self.processes = [
+            Process(target=runStage, daemon=True,
+                    args=(setup, setupArgs, self.frameBuffer, self.queues[i],
+                          self.queues[i + 1], self.stageStats[i], self.stop, self.errors))
+            for i, (_, setup, setupArgs) in enumerate(stages)]
+        self.frameId = 0
+        self.startTime = None
+
+    def start(self):
+        self.startTime = time.time()
+        for process in self.processes:
+            process.start()
+        return self
+
+    def submit(self, frame, captureTime=None):
+        """Copy a frame into shared memory and queue it for detection.
+        Returns False if the frame was dropped because every slot is in use."""
+        start = time.time()
+        captureTime = start if captureTime is None else captureTime
+        slot = self.frameBuffer.acquire()
+        if slot is None:
+            self.captureStats.drop()
+            return False
+        self.frames[slot] = frame
+        self.frameId += 1
+        putLatest(self.queues[0], (self.frameId, slot, captureTime, {}),
+                  self.frameBuffer, self.captureStats)
+        self.captureStats.record(time.time() - start, time.time() - captureTime)
+        return True
+
+    def get(self, timeout=0.1):
+        """Next finished (frameId, slot, captureTime, data), or None.
+        The frame is self.frames[slot] until release(slot).
+        Raises StageError if a stage failed or its process died."""
+        self.checkStages()
+        try:
+            return self.queues[-1].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def checkStages(self):
+        """Raise StageError if a stage reported an exception or its process
+        is gone, as the frames it holds would never come out of the pipeline"""
+        if self.stop.is_set():
+            return
+        message = None
+        if not self.errors.empty():
+            message = self.errors.get()
+        for process, stats in zip(self.processes, self.stageStats):
+            if message is None and not process.is_alive():
+                # the error of a failed stage may still be in flight
+                try:
+                    message = self.errors.get(timeout=1.0)
+                except queue.Empty:
+                    message = "{} stage process exited with code {}".format(
+                        stats.name, process.exitcode)
+        if message is not None:
+            raise StageError(message)
+
+    def release(self, slot, captureTime=None, busy=0.0):
+        if captureTime is not None:
+            self.displayStats.record(busy, time.time() - captureTime)
+        self.frameBuffer.release(slot)
+
+    def idle(self):
+        """True if no frame is in the pipeline"""
+        return self.frameBuffer.framesInUse() == 0
+
+    def report(self):
+        """Per-stage FPS, processing time, latency since capture and dropped frames"""
+        elapsed = time.time() - self.startTime
+        stats = [self.captureStats] + self.stageStats + [self.displayStats]
+        return "\n".join(s.summary(elapsed) for s in stats)
+
+    def close(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join(timeout=1.0)
+            if process.is_alive():
+                process.terminate()
+
+
+def captureLoop(cap, pipeline, done, flip=False):
+    """Capture stage: read frames as fast as the source delivers them"""
+    while not done.is_set():
+        frameGot, frame = cap.read()
+        if frameGot is False:
+            break
+        captureTime = time.time()
+        if flip:
+            # if frame comes from webcam, flip it so it looks like a mirror
+            frame = cv2.flip(frame, 2)
+        pipeline.submit(frame, captureTime)
+    done.set()
+
+
+def startCapture(cap, pipeline, flip=False):
+    """Run the capture stage in a thread. Returns the event set when capture ends."""
+    done = threading.Event()
+    thread = threading.Thread(target=captureLoop, args=(cap, pipeline, done, flip))
+    thread.daemon = True
+    thread.start()
+    return done
@@ -32,12 +32,17 @@ class PoseEstimator:
         # assuming no lens distortion
         self.distCoeefs = np.zeros((4, 1))
 
-        # rotation vector and translation vector
-        self.rotVec = np.array([[0.01891013], [0.08560084], [-3.14392813]])
-        self.transVec = np.array(
-            [[-14.97821226], [-10.62040383], [-2053.03596872]])
-        # self.rotVec = None
-        # self.transVec = None
+        # last good (rotationVector, translationVector) of each tracked face
+        self.lastPoses = {}
+
+        # PnP method of solve() without a previous pose: SQPnP (OpenCV 4.5.3+)
+        # finds the global optimum without an initial guess, several times faster
+        self.coldStartFlags = getattr(cv2, "SOLVEPNP_SQPNP", cv2.SOLVEPNP_ITERATIVE)
+
+        # iterative PnP from the last pose only pays off without SQPnP: it keeps
+        # the iterative solution from flipping, but takes ~0.3 ms per face
+        # against ~0.1 ms for a SQPnP solve from scratch
+        self.warmStart = self.coldStartFlags == cv2.SOLVEPNP_ITERATIVE
 
     def _getFullModelPoints(self, filename='assets/model.txt'):
         """Get all 68 3D model points from file"""
@@ -69,47 +74,150 @@ class PoseEstimator:
         pyplot.ylabel("y")
         pyplot.show()
 
+    def _modelPointsFor(self, imagePoints):
+        """The 6 or 68 model points matching the image points"""
+        for modelPoints in (self.modelPoints68, self.modelPoints):
+            if len(imagePoints) == len(modelPoints):
+                return modelPoints
+        raise AssertionError("3D points and 2D points should be of same number")
+
     def solvePose(self, imagePoints):
         """
-        Solve pose from image points
+        Solve pose from 6 or 68 image points
         Return (rotation vector, translation vector) as pose
         """
-        assert imagePoints.shape[0] == self.modelPoints68.shape[0], "3D points and 2D points should be of same number"
+        imagePoints = np.asarray(imagePoints, dtype=np.float64).reshape(-1, 2)
         (_, rotationVector, translationVector) = cv2.solvePnP(
-            self.modelPoints, imagePoints, self.cameraMatrix, self.distCoeefs)
-
-        # (success, rotationVector, translationVector) = cv2.solvePnP(
-        #     self.modelPoints,
-        #     imagePoints,
-        #     self.cameraMatrix,
-        #     self.distCoeefs,
-        #     rvec=self.rotVec,
-        #     tvec=self.transVec,
-        #     useExtrinsicGuess=True)
+            self._modelPointsFor(imagePoints), imagePoints, self.cameraMatrix, self.distCoeefs)
         return (rotationVector, translationVector)
 
     def solvePoseBy68Points(self, imagePoints):
         """
-        Solve pose from all the 68 image points
+        Solve pose from all the 68 image points, starting from the last pose
         Return (rotationVector, translationVector) as pose
         """
+        rotationVector, translationVector, _ = self.solve(imagePoints, faceId=0)
+        return (rotationVector, translationVector)
 
-        if self.rotVec is None:
-            (_, rotationVector, translationVector) = cv2.solvePnP(
-                self.modelPoints68, imagePoints, self.cameraMatrix, self.distCoeefs)
-            self.rotVec = rotationVector
-            self.transVec = translationVector
+    def solve(self, imagePoints, faceId=None, ransac=False, maxError=None,
+              reprojectionThreshold=8.0):
+        """
+        Solve the pose of a face from 6 or 68 image points.
+        With a faceId and warmStart, iterative PnP starts from the last good
+        pose of that face, which keeps the solution from flipping between
+        frames. Other poses are solved from scratch with coldStartFlags.
+        warmStart is only on by default without SQPnP, which is faster.
+        With ransac, marks further than reprojectionThreshold pixels from
+        the reprojected model are ignored as outliers.
+        Return (rotationVector, translationVector, error), error is the RMS
+        reprojection error in pixels (of the inliers with ransac). A pose with
+        error above maxError is not kept as the next starting point, and a
+        warm started solve above maxError is retried from scratch.
+        """
+        imagePoints = np.asarray(imagePoints, dtype=np.float64).reshape(-1, 2)
+        modelPoints = self._modelPointsFor(imagePoints)
 
-        (_, rotationVector, translationVector) = cv2.solvePnP(
-            self.modelPoints68,
-            imagePoints,
-            self.cameraMatrix,
-            self.distCoeefs,
-            rvec=self.rotVec,
-            tvec=self.transVec,
-            useExtrinsicGuess=True)
+        guess = self.lastPoses.get(faceId) if faceId is not None and self.warmStart else None
 
-        return (rotationVector, translationVector)
+        rotationVector, translationVector, error = self._solve(
+            modelPoints, imagePoints, guess, ransac, reprojectionThreshold)
+        if guess is not None and maxError is not None and not error <= maxError:
+            rotationVector, translationVector, error = self._solve(
+                modelPoints, imagePoints, None, ransac, reprojectionThreshold)
+
+        if faceId is not None and (maxError is None or error <= maxError):
+            self.lastPoses[faceId] = (rotationVector, translationVector)
+        return rotationVector, translationVector, error
+
+    def _solve(self, modelPoints, imagePoints, guess, ransac, reprojectionThreshold):
+        rotationVector = translationVector = None
+        if guess is not None:
+            rotationVector, translationVector = (v.copy() for v in guess)
+        useGuess = guess is not None
+
+        if ransac:
+            (success, rotationVector, translationVector, inliers) = cv2.solvePnPRansac(
+                modelPoints, imagePoints, self.cameraMatrix, self.distCoeefs,
+                rvec=rotationVector, tvec=translationVector, useExtrinsicGuess=useGuess,
+                reprojectionError=reprojectionThreshold)
+            if not success or inliers is None:
+                return rotationVector, translationVector, np.inf
+            inliers = inliers.ravel()
+            modelPoints, imagePoints = modelPoints[inliers], imagePoints[inliers]
+        else:
+            (success, rotationVector, translationVector) = cv2.solvePnP(
+                modelPoints, imagePoints, self.cameraMatrix, self.distCoeefs,
+                rvec=rotationVector, tvec=translationVector, useExtrinsicGuess=useGuess,
+                flags=cv2.SOLVEPNP_ITERATIVE if useGuess else self.coldStartFlags)
+            if not success:
+                return rotationVector, translationVector, np.inf
+
+        projected, _ = cv2.projectPoints(
+            modelPoints, rotationVector, translationVector, self.cameraMatrix, self.distCoeefs)
+        error = np.sqrt(np.square(projected.reshape(-1, 2) - imagePoints).sum(axis=1).mean())
+        return rotationVector, translationVector, error
+
+    def solveBatch(self, marks, faceIds=None, ransac=False, maxError=None):
+        """
+        Solve the poses of many faces, marks is (N, 68, 2) or (N, 6, 2).
+        faceIds (one per face) enable warm starts as in solve().
+        Return rotation vectors (N, 3), translation vectors (N, 3) and RMS
+        reprojection errors (N), so bad solves can be skipped with
+        errors <= maxError
+        """
+        marks = np.asarray(marks, dtype=np.float64)
+        count = len(marks)
+        rotationVectors = np.zeros((count, 3))
+        translationVectors = np.zeros((count, 3))
+        errors = np.full(count, np.inf)
+        for i in range(count):
+            faceId = None if faceIds is None else faceIds[i]
+            rotationVector, translationVector, errors[i] = self.solve(
+                marks[i], faceId, ransac, maxError)
+            if rotationVector is not None:
+                rotationVectors[i] = rotationVector.ravel()
+                translationVectors[i] = translationVector.ravel()
+        return rotationVectors, translationVectors, errors
+
+    def forgetFaces(self, faceIds=None):
+        """Drop the last poses of the given faces, or of all faces"""
+        if faceIds is None:
+            self.lastPoses.clear()
+        for faceId in faceIds or []:
+            self.lastPoses.pop(faceId, None)
+
+    @staticmethod
+    def rotationMatrices(rotationVectors):
+        """Rodrigues formula for (N, 3) rotation vectors, returns (N, 3, 3)"""
+        rotationVectors = np.asarray(rotationVectors, dtype=np.float64).reshape(-1, 3)
+        theta = np.linalg.norm(rotationVectors, axis=1)
+        axis = rotationVectors / np.maximum(theta, 1e-12)[:, None]
+        x, y, z = axis.T
+        zero = np.zeros_like(x)
+        cross = np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis=1).reshape(-1, 3, 3)
+        sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+        return (np.eye(3) + sin * cross
+                + (1 - cos) * np.matmul(cross, cross))
+
+    def projectBatch(self, rotationVectors, translationVectors, modelPoints=None):
+        """Project the model points (68 by default) with N poses at once,
+        returns (N, points, 2). Assumes no lens distortion, as this estimator does"""
+        if modelPoints is None:
+            modelPoints = self.modelPoints68
+        rotations = self.rotationMatrices(rotationVectors)
+        translations = np.asarray(translationVectors, dtype=np.float64).reshape(-1, 1, 3)
+        cameraPoints = np.matmul(np.asarray(modelPoints, np.float64), rotations.transpose(0, 2, 1)) \
+            + translations
+        imagePoints = np.matmul(cameraPoints, self.cameraMatrix.T)
+        return imagePoints[..., :2] / imagePoints[..., 2:]
+
+    def reprojectionErrors(self, rotationVectors, translationVectors, marks, modelPoints=None):
+        """RMS distance in pixels between (N, points, 2) marks and the model
+        reprojected with the N poses"""
+        if modelPoints is None:
+            modelPoints = self._modelPointsFor(marks[0]) if len(marks) else self.modelPoints68
+        projected = self.projectBatch(rotationVectors, translationVectors, modelPoints)
+        return np.sqrt(np.square(projected - marks).sum(axis=2).mean(axis=1))
 
     def drawAnnotationBox(self, image, rotationVector, translationVector, color=(255, 255, 255), lineWidth=2):
         """Draw a 3D box as annotation of pose"""
@@ -176,3 +284,66 @@ class PoseEstimator:
         poseMarks.append(marks[48])    # mouth left corner
         poseMarks.append(marks[54])    # mouth right corner
         return poseMarks
+
+
+def benchmark(frames=300, noise=1.0, outliers=0.1, seed=0):
+    """Cold against warm started and RANSAC PnP on a synthetic head moving in
+    front of the camera, with noisy marks and a fraction of gross outliers"""
+    import time
+    rng = np.random.RandomState(seed)
+    estimator = PoseEstimator()
+    t = np.arange(frames) / 30.0
+    rotationVectors = np.stack([0.2 * np.sin(t), 0.4 * np.sin(0.7 * t), 0.1 * np.cos(t)], axis=1)
+    translationVectors = np.stack([20 * np.sin(t), 10 * np.cos(t), 600 + 50 * np.sin(0.5 * t)], axis=1)
+    truth = estimator.projectBatch(rotationVectors, translationVectors)
+    trueRotations = estimator.rotationMatrices(rotationVectors)
+
+    def angleErrors(solved):
+        relative = np.matmul(estimator.rotationMatrices(solved), trueRotations.transpose(0, 2, 1))
+        cos = (np.trace(relative, axis1=1, axis2=2) - 1) / 2
+        return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+    def cold(marks):
+        return np.array([estimator.solvePose(m)[0].ravel() for m in marks])
+
+    def coldStart(marks):
+        return np.array([estimator.solve(m)[0].ravel() for m in marks])
+
+    def warm(marks, ransac=False):
+        estimator.forgetFaces()
+        estimator.warmStart = True
+        solved = np.array([estimator.solve(m, faceId=0, ransac=ransac)[0].ravel() for m in marks])
+        estimator.warmStart = estimator.coldStartFlags == cv2.SOLVEPNP_ITERATIVE
+        return solved
+
+    def batch(marks):
+        return estimator.solveBatch(marks)[0]
+
+    print("{:>10} {:>20} {:>10} {:>12} {:>12}".format(
+        "marks", "method", "ms/face", "median deg", "95% deg"))
+    for name, outlierRatio in (("clean", 0.0), ("outliers", outliers)):
+        marks = truth + rng.normal(0, noise, truth.shape)
+        bad = rng.rand(*marks.shape[:2]) < outlierRatio
+        marks[bad] += rng.uniform(-40, 40, (bad.sum(), 2))
+        runs = [("solvePose", cold),
+                ("cold start", coldStart),
+                ("batch (cold start)", batch),
+                ("warm start", warm),
+                ("warm start + RANSAC", lambda m: warm(m, ransac=True))]
+        for method, func in runs:
+            start = time.time()
+            solved = func(marks)
+            seconds = time.time() - start
+            errors = angleErrors(solved)
+            print("{:>10} {:>20} {:>10.3f} {:>12.2f} {:>12.2f}".format(
+                name, method, 1000 * seconds / frames, np.median(errors), np.percentile(errors, 95)))
+
+        rotations, translations, reprojection = estimator.solveBatch(marks)
+        start = time.time()
+        estimator.reprojectionErrors(rotations, translations, marks)
+        print("{:>10} {:>20} {:>10.3f} (mean {:.2f} px)".format(
+            name, "reprojection errors", 1000 * (time.time() - start) / frames, reprojection.mean()))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -101,6 +101,108 @@ class Stabilizer:
                                                         [0, 1]], np.float32) * covMeasure
 
 
+class BatchStabilizer:
+    """Many independent Kalman filters of the same kind as Stabilizer, updated
+    together with array operations instead of one cv2.KalmanFilter each.
+    The states are a (count, stateNum) array, the error covariances a
+    (count, stateNum, stateNum) array."""
+
+    def __init__(self,
+                 count,
+                 stateNum=4,
+                 measureNum=2,
+                 covProcess=0.0001,
+                 covMeasure=0.1):
+        """Initialization, same parameters as Stabilizer for count filters"""
+        assert stateNum == 4 or stateNum == 2, "only scalar and point supported, check stateNum please."
+
+        self.count = count
+        self.stateNum = stateNum
+        self.measureNum = measureNum
+
+        # same model as Stabilizer
+        if self.measureNum == 1:
+            self.transitionMatrix = np.array([[1, 1],
+                                              [0, 1]], np.float64)
+            self.measurementMatrix = np.array([[1, 1]], np.float64)
+        else:
+            self.transitionMatrix = np.array([[1, 0, 1, 0],
+                                              [0, 1, 0, 1],
+                                              [0, 0, 1, 0],
+                                              [0, 0, 0, 1]], np.float64)
+            self.measurementMatrix = np.array([[1, 0, 0, 0],
+                                               [0, 1, 0, 0]], np.float64)
+        self.setQR(covProcess, covMeasure)
+
+        # states and error covariances start at zero, as in cv2.KalmanFilter
+        self.state = np.zeros((count, stateNum))
+        self.prediction = np.zeros((count, stateNum))
+        self.errorCov = np.zeros((count, stateNum, stateNum))
+
+    def update(self, measurement, mask=None):
+        """Update the filters with (count,) scalars or (count, 2) points.
+        If a boolean mask is given, only the filters where it is True are
+        updated, the others keep their state."""
+        measurement = np.asarray(measurement, np.float64).reshape(self.count, self.measureNum)
+        F, H = self.transitionMatrix, self.measurementMatrix
+        state, errorCov = self.state, self.errorCov
+        if mask is not None:
+            state, errorCov, measurement = state[mask], errorCov[mask], measurement[mask]
+
+        # predict: x = F x, P = F P F' + Q
+        prediction = state.dot(F.T)
+        errorCovPre = np.matmul(np.matmul(F, errorCov), F.T) + self.processNoiseCov
+
+        # correct: K = P H' (H P H' + R)^-1, x += K (z - H x), P -= K H P
+        PHt = np.matmul(errorCovPre, H.T)
+        innovationCov = np.matmul(H, PHt) + self.measurementNoiseCov
+        gain = np.matmul(PHt, np.linalg.inv(innovationCov))
+        residual = measurement - prediction.dot(H.T)
+        state = prediction + np.matmul(gain, residual[:, :, None])[:, :, 0]
+        errorCov = errorCovPre - np.matmul(gain, np.matmul(H, errorCovPre))
+
+        if mask is None:
+            self.prediction, self.state, self.errorCov = prediction, state, errorCov
+        else:
+            self.prediction[mask], self.state[mask], self.errorCov[mask] = prediction, state, errorCov
+
+    def setQR(self, covProcess=0.1, covMeasure=0.001):
+        """Set new value for processNoiseCov and measurementNoiceCov"""
+        self.processNoiseCov = np.eye(self.stateNum) * covProcess
+        self.measurementNoiseCov = np.eye(self.measureNum) * covMeasure
+
+
+def benchmark(frames=300, seed=0):
+    """Compare Stabilizer objects against BatchStabilizer, for the 6 pose
+    values as scalars and for 68 marks as points"""
+    import time
+    rng = np.random.RandomState(seed)
+    print("{:>18} {:>12} {:>12} {:>9} {:>10}".format(
+        "filters", "objects ms", "batch ms", "speedup", "max diff"))
+    for count, stateNum, measureNum, covProcess in ((6, 2, 1, 0.1), (68, 4, 2, 0.0001)):
+        walk = np.cumsum(rng.normal(0, 1, (frames, count, measureNum)), axis=0)
+        measurements = walk + rng.normal(0, 3, walk.shape)
+
+        stabilizers = [Stabilizer(stateNum, measureNum, covProcess, 0.1) for _ in range(count)]
+        start = time.time()
+        for measurement in measurements:
+            for value, stb in zip(measurement, stabilizers):
+                stb.update(value)
+        objectTime = time.time() - start
+        objectState = np.array([stb.state[:, 0] for stb in stabilizers])
+
+        batch = BatchStabilizer(count, stateNum, measureNum, covProcess, 0.1)
+        start = time.time()
+        for measurement in measurements:
+            batch.update(measurement)
+        batchTime = time.time() - start
+
+        name = "{} {}".format(count, "scalars" if measureNum == 1 else "points")
+        print("{:>18} {:>12.3f} {:>12.3f} {:>8.1f}x {:>10.2e}".format(
+            name, 1000 * objectTime / frames, 1000 * batchTime / frames,
+            objectTime / batchTime, np.abs(objectState - batch.state).max()))
+
+
 def main():
     """Test code"""
     global mp
@@ -132,4 +234,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    import sys
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        main()
@@ -1,6 +1,10 @@
 from __future__ import print_function
 
 # Dependencies
+import multiprocessing
+import os
+import sys
+import time
 import cv2
 import numpy as np
 
@@ -8,58 +12,172 @@ import numpy as np
 MAX_MATCHES = 500
 GOOD_MATCH_PERCENT = 0.15
 
-# Alignment function
+# Alignment functions
 
 
-def alignImages(im1, im2):
+def detectFeatures(im, maxFeatures=MAX_MATCHES):
+    """ORB keypoint coordinates (N x 2 float32), keypoints and descriptors of a BGR or grayscale image."""
+    imGray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
+    orb = cv2.ORB_create(maxFeatures)
+    keypoints, descriptors = orb.detectAndCompute(imGray, None)
+    points = cv2.KeyPoint_convert(keypoints).reshape(-1, 2) if keypoints else \
+        np.zeros((0, 2), dtype=np.float32)
+    return points, keypoints, descriptors
 
-    # convert images to grayscale
-    im1Gray = cv2.cvtColor(im1, cv2.COLOR_BGR2GRAY)
-    im2Gray = cv2.cvtColor(im2, cv2.COLOR_BGR2GRAY)
 
-    # detect ORB features & compute descriptors
-    orb = cv2.ORB_create(MAX_MATCHES)
-    keypoints1, descriptors1 = orb.detectAndCompute(im1Gray, None)
-    keypoints2, descriptors2 = orb.detectAndCompute(im2Gray, None)
+class Reference(object):
+    """Features of a reference (template) image, computed once and reused to register many images."""
+
+    def __init__(self, im, maxFeatures=MAX_MATCHES):
+        self.shape = im.shape
+        self.points, self.keypoints, self.descriptors = detectFeatures(im, maxFeatures)
+
+    def __getstate__(self):
+        # cv2.KeyPoint cannot be pickled (eg. to send the reference to worker processes)
+        state = dict(self.__dict__)
+        state["keypoints"] = None
+        return state
+
+
+def registerImage(im1, reference, maxFeatures=MAX_MATCHES, goodMatchPercent=GOOD_MATCH_PERCENT,
+                  matchesFilename=None, im2=None):
+    """Estimate the homography mapping im1 onto the reference.
+    Returns the homography (None if it could not be estimated), the number of
+    RANSAC inliers and the number of good matches. If matchesFilename is set,
+    the top matches with the reference image im2 are drawn to that file."""
+    points1, keypoints1, descriptors1 = detectFeatures(im1, maxFeatures)
+
+    if descriptors1 is None or reference.descriptors is None:
+        return None, 0, 0
 
     # match features
     matcher = cv2.DescriptorMatcher_create(
         cv2.DESCRIPTOR_MATCHER_BRUTEFORCE_HAMMING)
-    matches = matcher.match(descriptors1, descriptors2, None)
+    matches = matcher.match(descriptors1, reference.descriptors, None)
 
     # sort matches by score
-    matches.sort(key=lambda x: x.distance, reverse=False)
+    matches = sorted(matches, key=lambda x: x.distance)
 
     # remove not so good matches
-    numGoodMatches = int(len(matches) * GOOD_MATCH_PERCENT)
+    numGoodMatches = int(len(matches) * goodMatchPercent)
     matches = matches[:numGoodMatches]
 
-    # draw top matches
-    imMatches = cv2.drawMatches(
-        im1, keypoints1, im2, keypoints2, matches, None)
-    cv2.imwrite("matches.jpg", imMatches)
+    if matchesFilename is not None:
+        # draw top matches
+        imMatches = cv2.drawMatches(
+            im1, keypoints1, im2, reference.keypoints, matches, None)
+        cv2.imwrite(matchesFilename, imMatches)
 
     # extract location of good matches
-    points1 = np.zeros((len(matches), 2), dtype=np.float32)
-    points2 = np.zeros((len(matches), 2), dtype=np.float32)
-
-    for i, match in enumerate(matches):
-        points1[i, :] = keypoints1[match.queryIdx].pt
-        points2[i, :] = keypoints2[match.trainIdx].pt
-
-        # find homography
-        h, mask = cv2.findHomography(points1, points2, cv2.RANSAC)
-
-        # use homography
-        height, width, channels = im2.shape
-        im1Reg = cv2.warpPerspective(im1, h, (width, height))
-
-        return im1Reg, h
+    queryIdx = np.array([m.queryIdx for m in matches], dtype=int)
+    trainIdx = np.array([m.trainIdx for m in matches], dtype=int)
+    points1 = points1[queryIdx]
+    points2 = reference.points[trainIdx]
+    if numGoodMatches < 4:
+        return None, 0, numGoodMatches
+
+    # find homography
+    h, mask = cv2.findHomography(points1, points2, cv2.RANSAC)
+    numInliers = int(mask.sum()) if mask is not None else 0
+    return h, numInliers, numGoodMatches
+
+
+def alignImages(im1, im2, matchesFilename=None):
+    """Align im1 onto im2. Returns the registered image and the homography
+    (None, None if no homography was found)."""
+    reference = Reference(im2)
+    h, _, _ = registerImage(im1, reference, matchesFilename=matchesFilename, im2=im2)
+    if h is None:
+        return None, None
+
+    # use homography
+    height, width, channels = im2.shape
+    im1Reg = cv2.warpPerspective(im1, h, (width, height))
+
+    return im1Reg, h
+
+
+# Per-process reference, installed once per worker by initWorker()
+workerReference = []
+
+
+def initWorker(reference):
+    cv2.setNumThreads(1)  # one OpenCV thread per worker process
+    workerReference[:] = [reference]
+
+
+def alignFile(args):
+    """Register one image file against the worker reference; optionally write the aligned image."""
+    filename, outFilename = args
+    reference = workerReference[0]
+    start = time.time()
+    im = cv2.imread(filename, cv2.IMREAD_COLOR)
+    if im is None:
+        return dict(filename=filename, h=None, inliers=0, matches=0,
+                    seconds=time.time() - start, error="unreadable image")
+
+    h, numInliers, numGoodMatches = registerImage(im, reference)
+    if h is not None and outFilename is not None:
+        height, width = reference.shape[:2]
+        cv2.imwrite(outFilename, cv2.warpPerspective(im, h, (width, height)))
+
+    return dict(filename=filename, h=h, inliers=numInliers, matches=numGoodMatches,
+                seconds=time.time() - start, error=None if h is not None else "no homography")
+
+
+def alignBatch(filenames, imReference, outDir=None, workers=None, verbose=True):
+    """Register many images against one reference image in a pool of worker processes.
+    The reference features are computed once. Aligned images are written to outDir
+    (if given) under their own file names; nothing else is written.
+    Returns one dict per image, in order: filename, h, inliers, matches, seconds, error."""
+    reference = Reference(imReference)
+    if outDir is not None and not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    jobs = [(f, None if outDir is None else os.path.join(outDir, os.path.basename(f)))
+            for f in filenames]
+
+    start = time.time()
+    results = []
+    if workers is not None and workers <= 1:
+        initWorker(reference)
+        stream = (alignFile(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initWorker, (reference,))
+        stream = pool.imap(alignFile, jobs)
+    try:
+        for result in stream:
+            results.append(result)
+            if verbose:
+                print("{:<40} {:>6} inliers / {:>4} matches {:>8.1f} ms {}".format(
+                    os.path.basename(result["filename"]), result["inliers"], result["matches"],
+                    1000 * result["seconds"], result["error"] or ""))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if verbose and results:
+        elapsed = time.time() - start
+        print("Aligned {} of {} images in {:.2f} s ({:.1f} images/s, {:.1f} ms per image per worker)".format(
+            sum(r["h"] is not None for r in results), len(results), elapsed,
+            len(results) / elapsed, 1000 * np.mean([r["seconds"] for r in results])))
+
+    return results
 
 
 # Driver function
 if __name__ == "__main__":
 
+    if len(sys.argv) > 2:
+        # batch mode: python align.py reference.jpg scans_dir [out_dir]
+        imReference = cv2.imread(sys.argv[1], cv2.IMREAD_COLOR)
+        scanDir = sys.argv[2]
+        filenames = sorted(os.path.join(scanDir, f) for f in os.listdir(scanDir)
+                           if f.lower().endswith((".jpg", ".jpeg", ".png", ".tif", ".tiff")))
+        alignBatch(filenames, imReference, sys.argv[3] if len(sys.argv) > 3 else None)
+        sys.exit(0)
+
     # read reference image
     refFilename = "form.jpg"
     print("Reading reference image : ", refFilename)
@@ -74,7 +192,8 @@ if __name__ == "__main__":
 
     # registered image will be restored in imReg
     # estimated homography will be stored in h
-    imReg, h = alignImages(im, imReference)
+    # (top matches are drawn to matches.jpg)
+    imReg, h = alignImages(im, imReference, "matches.jpg")
 
     # write aligned image to disk
     outFilename = "aligned.jpg"
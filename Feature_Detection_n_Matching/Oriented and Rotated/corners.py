@@ -0,0 +1,200 @@
+#!/use/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import time
+import cv2
+import numpy as np
+
+
+def harris_response(gray, block_size=2, ksize=3, k=0.04):
+    """ Harris corner response of a grayscale image (float32) """
+    return cv2.cornerHarris(np.float32(gray), block_size, ksize, k)
+
+
+def non_max_suppression(response, threshold=0.01, nhood_size=5, relative=True):
+    """ Threshold and non-maximal suppression of a corner response.
+        A pixel is kept if it is above the threshold and equal to the
+        maximum of its nhood_size x nhood_size neighborhood, which is found
+        for all pixels at once by dilating the response. Pixels of a flat
+        maximum (exactly equal responses) are all kept.
+    :param response: corner response (h x w)
+    :param threshold: minimum response, relative to the maximum response
+        if relative (default), absolute otherwise
+    :param nhood_size: neighborhood size (odd)
+    :returns: corners (N x 3) as x, y, response, strongest first
+    """
+    response = np.float32(response)
+    if relative:
+        threshold = threshold * response.max()
+
+    kernel = np.ones((nhood_size, nhood_size), np.uint8)
+    local_max = cv2.dilate(response, kernel)
+    ys, xs = np.nonzero((response == local_max) & (response > threshold))
+
+    values = response[ys, xs]
+    order = np.argsort(-values, kind='mergesort')
+    return np.column_stack((xs[order], ys[order], values[order])).astype(np.float32)
+
+
+def top_k(corners, k):
+    """ The k strongest corners (corners are sorted strongest first) """
+    return corners[:k]
+
+
+def grid_select(corners, shape, grid=(8, 8), max_corners=None, per_cell=None):
+    """ Bucket corners into a grid over the image and keep the strongest
+        per_cell corners of each cell, so corners spread over the image
+        instead of clustering in high contrast regions.
+    :param shape: image shape (h, w)
+    :param grid: number of cells (rows, cols)
+    :param max_corners: total number of corners, spread evenly over the
+        cells if per_cell is not given
+    :returns: selected corners (M x 3), strongest first
+    """
+    rows, cols = grid
+    if per_cell is None:
+        per_cell = len(corners) if max_corners is None else \
+            int(np.ceil(max_corners / float(rows * cols)))
+
+    cell_y = np.minimum(np.int_(corners[:, 1]) * rows // shape[0], rows - 1)
+    cell_x = np.minimum(np.int_(corners[:, 0]) * cols // shape[1], cols - 1)
+    cell = cell_y * cols + cell_x
+
+    # rank of each corner within its cell (corners are sorted strongest first)
+    order = np.argsort(cell, kind='mergesort')
+    sorted_cell = cell[order]
+    first = np.searchsorted(sorted_cell, sorted_cell)
+    rank = np.empty(len(corners), dtype=np.int64)
+    rank[order] = np.arange(len(corners)) - first
+
+    selected = corners[rank < per_cell]
+    return selected if max_corners is None else selected[:max_corners]
+
+
+def suppression_radii(corners, robust=0.9, chunk_size=1024):
+    """ Adaptive non-maximal suppression radius of each corner: the distance
+        to the nearest corner that is sufficiently stronger,
+        response < robust * response of the other corner (Brown et al. 2005).
+        The strongest corner has an infinite radius.
+    :param corners: corners (N x 3), strongest first
+    :returns: radii (N)
+    """
+    x, y = np.float32(corners[:, 0]), np.float32(corners[:, 1])
+    values = np.float64(corners[:, 2])
+    # corners j < stronger[i] are the ones with robust * values[j] > values[i]
+    stronger = np.searchsorted(-robust * values, -values, side='left')
+
+    radii = np.full(len(corners), np.inf)
+    for start in range(0, len(corners), chunk_size):
+        stop = min(start + chunk_size, len(corners))
+        limit = stronger[start:stop]
+        n = limit.max()
+        if n == 0:
+            continue
+        d2 = np.square(x[start:stop, None] - x[None, :n])
+        d2 += np.square(y[start:stop, None] - y[None, :n])
+        d2[np.arange(n) >= limit[:, None]] = np.inf
+        radii[start:stop] = np.sqrt(d2.min(axis=1))
+
+    return radii
+
+
+def anms(corners, max_corners, robust=0.9, candidates=10):
+    """ Adaptive non-maximal suppression: the max_corners corners with the
+        largest suppression radii, strongest first. Only the strongest
+        candidates * max_corners corners are considered, as the radii take
+        quadratic time in the number of corners. """
+    if len(corners) <= max_corners:
+        return corners
+    if candidates is not None:
+        corners = corners[:candidates * max_corners]
+    radii = suppression_radii(corners, robust)
+    keep = np.sort(np.argsort(-radii, kind='mergesort')[:max_corners])
+    return corners[keep]
+
+
+def extract_corners(response, threshold=0.01, nhood_size=5, relative=True,
+                    max_corners=None, selection='top', grid=(8, 8)):
+    """ Threshold, non-maximal suppression and optional selection of corners.
+    :param selection: how to keep max_corners corners, 'top' (strongest),
+        'anms' (adaptive non-maximal suppression) or 'grid' (strongest per
+        grid cell)
+    :returns: corners (N x 3) as x, y, response, strongest first
+    """
+    corners = non_max_suppression(response, threshold, nhood_size, relative)
+    if max_corners is None:
+        return corners
+    if selection == 'top':
+        return top_k(corners, max_corners)
+    if selection == 'anms':
+        return anms(corners, max_corners)
+    if selection == 'grid':
+        return grid_select(corners, response.shape, grid, max_corners)
+    raise ValueError('Unknown selection: {0}'.format(selection))
+
+
+def draw_corners(image, corners, radius=5, color=(0, 255, 0), thickness=1):
+    """ Draw a circle on each corner, in place """
+    for x, y in np.int_(corners[:, :2]):
+        cv2.circle(image, (int(x), int(y)), radius, color, thickness)
+    return image
+
+
+def non_max_suppression_loop(response, threshold=0.01, nhood_size=5):
+    """ Pixel by pixel suppression as in the original harris_corners.py,
+        kept as a reference for the benchmark """
+    h_thresh = threshold * response.max()
+    _, h_selected = cv2.threshold(response, h_thresh, 1, cv2.THRESH_TOZERO)
+    nhood_r = int(nhood_size / 2)
+    corners = []
+    for y in range(h_selected.shape[0]):
+        for x in range(h_selected.shape[1]):
+            if h_selected.item(y, x):
+                h_value = h_selected.item(y, x)
+                nhood = h_selected[(y - nhood_r):(y + nhood_r + 1),
+                                   (x - nhood_r):(x + nhood_r + 1)]
+                if not nhood.size:
+                    continue
+                if h_value == np.amax(nhood):
+                    corners.append((x, y, h_value))
+                    h_selected[(y - nhood_r):(y + nhood_r),
+                               (x - nhood_r):(x + nhood_r)] = 0
+                    h_selected[y, x] = h_value
+
+    return np.float32(corners).reshape(-1, 3)
+
+
+def benchmark(shape=(3000, 4000), seed=0):
+    """ Compare the pixel loop against the vectorized extraction on a
+        synthetic image (default 12MP) """
+    rng = np.random.RandomState(seed)
+    gray = cv2.GaussianBlur(np.uint8(rng.randint(0, 256, shape)), (0, 0), 3)
+    gray = cv2.resize(cv2.resize(gray, (shape[1] // 8, shape[0] // 8)),
+                      (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    response = harris_response(gray)
+
+    runs = [
+        ('loop', lambda: non_max_suppression_loop(response)),
+        ('dilate', lambda: extract_corners(response)),
+        ('dilate + top 2000', lambda: extract_corners(response, max_corners=2000)),
+        ('dilate + grid 2000', lambda: extract_corners(
+            response, max_corners=2000, selection='grid')),
+        ('dilate + anms 2000', lambda: extract_corners(
+            response, max_corners=2000, selection='anms')),
+    ]
+    print('{0}x{1} image'.format(shape[1], shape[0]))
+    print('{0:>20} {1:>10} {2:>10} {3:>10}'.format(
+        'method', 'corners', 'seconds', 'speedup'))
+    loop_time = None
+    for name, func in runs:
+        start = time.time()
+        corners = func()
+        seconds = time.time() - start
+        loop_time = loop_time or seconds
+        print('{0:>20} {1:>10} {2:>10.3f} {3:>9.1f}x'.format(
+            name, len(corners), seconds, loop_time / seconds))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,363 @@
+#!/use/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import collections
+import multiprocessing
+import os
+import time
+import cv2
+import numpy as np
+
+from corners import harris_response, extract_corners
+
+
+def _xfeatures2d(name):
+    """ Factory of the opencv-contrib module """
+    module = getattr(cv2, 'xfeatures2d', None)
+    if not hasattr(module, name):
+        raise AttributeError('{0} requires opencv-contrib-python'.format(name))
+    return getattr(module, name)
+
+
+def _sift_create(**params):
+    # SIFT moved from xfeatures2d to the main module in OpenCV 4.4
+    if hasattr(cv2, 'SIFT_create'):
+        return cv2.SIFT_create(**params)
+    return _xfeatures2d('SIFT_create')(**params)
+
+
+def _surf_create(hessianThreshold=800, **params):
+    return _xfeatures2d('SURF_create')(hessianThreshold, **params)
+
+
+class HarrisDetector(object):
+    """ Harris corners as keypoints, with the detect() interface of the
+        OpenCV feature detectors """
+
+    def __init__(self, threshold=0.01, nhood_size=5, max_corners=None,
+                 selection='top', block_size=2, ksize=3, k=0.04):
+        self.threshold = threshold
+        self.nhood_size = nhood_size
+        self.max_corners = max_corners
+        self.selection = selection
+        self.block_size = block_size
+        self.ksize = ksize
+        self.k = k
+
+    def corners(self, gray):
+        """ Corners as an (N x 3) array of x, y, response """
+        response = harris_response(gray, self.block_size, self.ksize, self.k)
+        return extract_corners(response, self.threshold, self.nhood_size,
+                               max_corners=self.max_corners,
+                               selection=self.selection)
+
+    def detect(self, gray, mask=None):
+        corners = self.corners(gray)
+        if mask is not None:
+            corners = corners[mask[np.int_(corners[:, 1]), np.int_(corners[:, 0])] > 0]
+        size = 2.0 * self.nhood_size
+        return [cv2.KeyPoint(float(x), float(y), size, -1, float(r))
+                for x, y, r in corners]
+
+
+# name -> factory of the detector, and name of its default descriptor
+DETECTORS = {
+    'harris': (HarrisDetector, None),
+    'fast': (cv2.FastFeatureDetector_create, None),
+    'orb': (cv2.ORB_create, 'orb'),
+    'sift': (_sift_create, 'sift'),
+    'surf': (_surf_create, 'surf'),
+}
+
+# name -> factory of the descriptor extractor
+DESCRIPTORS = {
+    'brief': lambda **params: _xfeatures2d('BriefDescriptorExtractor_create')(**params),
+    'orb': cv2.ORB_create,
+    'sift': _sift_create,
+    'surf': _surf_create,
+}
+
+# descriptor name -> dtype of its descriptors (binary descriptors are uint8)
+DESCRIPTOR_DTYPES = {'brief': np.uint8, 'orb': np.uint8,
+                     'sift': np.float32, 'surf': np.float32}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.pgm', '.ppm', '.tif', '.tiff')
+
+
+class Features(collections.namedtuple(
+        'Features', 'points size angle response octave descriptors offsets')):
+    """ Structure of arrays of the keypoints and descriptors of one or more
+        images. The features of image i are rows offsets[i]:offsets[i + 1].
+    :points: keypoint coordinates (N x 2) float32
+    :size, angle, response: (N) float32
+    :octave: (N) int32
+    :descriptors: (N x d) uint8 for binary descriptors, float32 otherwise,
+        None for detectors only
+    :offsets: (num_images + 1) int64
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_features(self):
+        return int(self.offsets[-1])
+
+    def image(self, i):
+        """ Features of image i """
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return Features(self.points[start:stop], self.size[start:stop],
+                        self.angle[start:stop], self.response[start:stop],
+                        self.octave[start:stop],
+                        None if self.descriptors is None else self.descriptors[start:stop],
+                        np.array([0, stop - start], dtype=np.int64))
+
+    def keypoints(self, i=0):
+        """ cv2.KeyPoint list of image i, eg. for cv2.drawKeypoints """
+        f = self.image(i)
+        return [cv2.KeyPoint(float(x), float(y), float(s), float(a), float(r), int(o))
+                for (x, y), s, a, r, o in zip(f.points, f.size, f.angle,
+                                              f.response, f.octave)]
+
+
+def keypoints_to_features(keypoints, descriptors=None, descriptor_dtype=np.float32,
+                          descriptor_size=0):
+    """ Convert a list of cv2.KeyPoint and their descriptors to Features """
+    n = len(keypoints)
+    if descriptors is None and descriptor_size:
+        descriptors = np.zeros((0, descriptor_size), dtype=descriptor_dtype)
+    if descriptors is not None:
+        descriptors = np.asarray(descriptors, dtype=descriptor_dtype)
+    return Features(
+        points=np.float32([k.pt for k in keypoints]).reshape(n, 2),
+        size=np.float32([k.size for k in keypoints]),
+        angle=np.float32([k.angle for k in keypoints]),
+        response=np.float32([k.response for k in keypoints]),
+        octave=np.int32([k.octave for k in keypoints]),
+        descriptors=descriptors,
+        offsets=np.array([0, n], dtype=np.int64))
+
+
+def concatenate(features):
+    """ Stack the Features of several images into one Features """
+    features = list(features)
+    if not features:
+        return keypoints_to_features([])
+    counts = [f.num_features for f in features]
+    descriptors = None
+    if features[0].descriptors is not None:
+        descriptors = np.concatenate([f.descriptors for f in features])
+    return Features(
+        points=np.concatenate([f.points for f in features]),
+        size=np.concatenate([f.size for f in features]),
+        angle=np.concatenate([f.angle for f in features]),
+        response=np.concatenate([f.response for f in features]),
+        octave=np.concatenate([f.octave for f in features]),
+        descriptors=descriptors,
+        offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+
+
+def sift_octave(octave):
+    """ Octave of SIFT keypoints, which pack the octave (signed, -1 for the
+        upsampled image), the layer and the scale into KeyPoint.octave """
+    octave = np.asarray(octave, dtype=np.int32) & 255
+    return np.where(octave >= 128, octave - 256, octave).astype(np.int32)
+
+
+def to_gray(image):
+    """ Grayscale uint8 image from an image path, a BGR or a gray image """
+    if isinstance(image, str):
+        gray = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise IOError('Could not read image: {0}'.format(image))
+        return gray
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+class FeatureExtractor(object):
+    """ Detect keypoints and compute their descriptors with any of the
+        DETECTORS and DESCRIPTORS through one interface.
+        Eg. FeatureExtractor('fast', 'brief') or FeatureExtractor('orb', nfeatures=1000) """
+
+    def __init__(self, detector='orb', descriptor='default', **params):
+        """
+        :param detector: name in DETECTORS
+        :param descriptor: name in DESCRIPTORS, 'default' for the detector's
+            own descriptor (if any) or None for keypoints only
+        :param params: keyword arguments of the detector factory
+        """
+        if detector not in DETECTORS:
+            raise ValueError('Unknown detector: {0}'.format(detector))
+        create, default = DETECTORS[detector]
+        if descriptor == 'default':
+            descriptor = default
+        if descriptor is not None and descriptor not in DESCRIPTORS:
+            raise ValueError('Unknown descriptor: {0}'.format(descriptor))
+
+        self.detector_name = detector
+        self.descriptor_name = descriptor
+        self.params = params
+        self.detector = create(**params)
+        if descriptor is None:
+            self.extractor = None
+        elif descriptor == default:
+            self.extractor = self.detector  # detectAndCompute in one pass
+        else:
+            self.extractor = DESCRIPTORS[descriptor]()
+
+    @property
+    def name(self):
+        return self.detector_name if self.descriptor_name in (None, self.detector_name) \
+            else '{0}+{1}'.format(self.detector_name, self.descriptor_name)
+
+    def detect(self, image, mask=None):
+        """ Keypoints of an image as Features without descriptors """
+        return keypoints_to_features(self.detector.detect(to_gray(image), mask))
+
+    def describe(self, image, features):
+        """ Compute descriptors for the keypoints of Features of a single image.
+            Keypoints the descriptor cannot describe (eg. too close to the
+            border) are dropped. """
+        if self.extractor is None:
+            raise ValueError('{0} has no descriptor'.format(self.name))
+        keypoints, descriptors = self.extractor.compute(to_gray(image),
+                                                        self._foreign_keypoints(features))
+        return keypoints_to_features(keypoints, descriptors,
+                                     DESCRIPTOR_DTYPES[self.descriptor_name],
+                                     self.extractor.descriptorSize())
+
+    def _foreign_keypoints(self, features):
+        """ Keypoints of the detector with their octave as the descriptor
+            reads it. ORB describes a keypoint on the pyramid level given by
+            its octave, which is garbage for packed SIFT octaves. """
+        octave = features.octave
+        if self.detector_name == 'sift' and self.descriptor_name != 'sift':
+            octave = sift_octave(octave)
+        if self.descriptor_name == 'orb' and self.extractor is not self.detector:
+            octave = np.clip(octave, 0, self.extractor.getNLevels() - 1)
+        return Features(features.points, features.size, features.angle, features.response,
+                        octave, features.descriptors, features.offsets).keypoints()
+
+    def extract(self, image, mask=None):
+        """ Detect and describe the keypoints of an image """
+        gray = to_gray(image)
+        if self.extractor is None:
+            return self.detect(gray, mask)
+        if self.extractor is self.detector:
+            keypoints, descriptors = self.detector.detectAndCompute(gray, mask)
+            return keypoints_to_features(keypoints, descriptors,
+                                         DESCRIPTOR_DTYPES[self.descriptor_name],
+                                         self.extractor.descriptorSize())
+        return self.describe(gray, self.detect(gray, mask))
+
+    def extract_batch(self, images, workers=1, queue_size=32):
+        """ Features of a sequence of images, see extract_batch() """
+        return extract_batch(images, self.detector_name, self.descriptor_name,
+                             workers, queue_size, **self.params)
+
+
+# Per-process extractor, created once per worker by _init_worker()
+_worker_extractor = []
+
+
+def _init_worker(detector, descriptor, params):
+    # OpenCV detectors cannot be pickled, every worker builds its own
+    cv2.setNumThreads(1)
+    _worker_extractor[:] = [FeatureExtractor(detector, descriptor, **params)]
+
+
+def _extract(image):
+    return _worker_extractor[0].extract(image)
+
+
+def iter_features(images, detector='orb', descriptor='default', workers=1,
+                  queue_size=32, **params):
+    """ Yield the Features of each image of an iterable of image paths or
+        arrays, in order. With workers > 1 (None: one per core) the images
+        are processed in a process pool, with at most queue_size images in
+        flight, so streams (eg. video frames) are not read ahead unbounded. """
+    if workers is not None and workers <= 1:
+        extractor = FeatureExtractor(detector, descriptor, **params)
+        for image in images:
+            yield extractor.extract(image)
+        return
+
+    pool = multiprocessing.Pool(workers, _init_worker, (detector, descriptor, params))
+    pending = collections.deque()
+    try:
+        for image in images:
+            pending.append(pool.apply_async(_extract, (image,)))
+            if len(pending) >= queue_size:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def extract_batch(images, detector='orb', descriptor='default', workers=1,
+                  queue_size=32, **params):
+    """ Features of all images, stacked into one structure of arrays
+        (see Features.offsets) """
+    return concatenate(iter_features(images, detector, descriptor, workers,
+                                     queue_size, **params))
+
+
+def list_images(directory, extensions=IMAGE_EXTENSIONS):
+    """ Sorted paths of the images in a directory """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(extensions))
+
+
+def extract_directory(directory, detector='orb', descriptor='default', workers=None,
+                      **params):
+    """ Features of every image of a directory, by default on all cores.
+    :returns: image paths and their Features
+    """
+    paths = list_images(directory)
+    return paths, extract_batch(paths, detector, descriptor, workers, **params)
+
+
+def available_detectors():
+    """ Names of the DETECTORS supported by the installed OpenCV, with the
+        brief descriptor paired with fast as in the brief example """
+    names = []
+    for name, descriptor in [('harris', None), ('fast', None), ('fast', 'brief'),
+                             ('orb', 'default'), ('sift', 'default'), ('surf', 'default')]:
+        try:
+            FeatureExtractor(name, descriptor)
+        except (AttributeError, TypeError, cv2.error):
+            continue  # not in this OpenCV build, eg. SURF is patented (non-free)
+        names.append((name, descriptor))
+    return names
+
+
+def benchmark(images=None, workers=(1, None), num_images=32, shape=(480, 640)):
+    """ Throughput of every available detector in images/s, on the given
+        image paths or on synthetic images """
+    if images is None:
+        rng = np.random.RandomState(0)
+        images = [cv2.GaussianBlur(np.uint8(rng.randint(0, 256, shape)), (0, 0), 2)
+                  for _ in range(num_images)]
+
+    print('{0:>14} {1:>8} {2:>10} {3:>12} {4:>10}'.format(
+        'detector', 'workers', 'images', 'features', 'images/s'))
+    for detector, descriptor in available_detectors():
+        for w in workers:
+            start = time.time()
+            features = extract_batch(images, detector, descriptor, w)
+            seconds = time.time() - start
+            name = FeatureExtractor(detector, descriptor).name
+            print('{0:>14} {1:>8} {2:>10} {3:>12} {4:>10.1f}'.format(
+                name, w or multiprocessing.cpu_count(), len(features),
+                features.num_features, len(features) / seconds))
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(list_images(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -7,6 +7,19 @@ import numpy as np
 import cv2
 
 
+def extract_corners(dst, threshold, nhood_size=5):
+    """ Corners of a Harris response: the pixels above threshold * dst.max()
+        that are also the maximum of their nhood_size x nhood_size
+        neighborhood (non-maximal suppression by dilation).
+    :returns: corners (N x 3) as x, y, response, strongest first
+    """
+    local_max = cv2.dilate(dst, np.ones((nhood_size, nhood_size), np.uint8))
+    ys, xs = np.nonzero((dst == local_max) & (dst > threshold * dst.max()))
+    values = dst[ys, xs]
+    order = np.argsort(-values, kind='mergesort')
+    return np.column_stack((xs[order], ys[order], values[order]))
+
+
 # Read in the image
 image = cv2.imread('images/waffle.jpg')
 
@@ -28,26 +41,26 @@ gray = np.float32(gray)
 # Detect corners
 dst = cv2.cornerHarris(gray, 2, 3, 0.04)
 
-# Dilate corner image to enhance corner points
-dst = cv2.dilate(dst, None)
-
-plt.imshow(dst, cmap='gray')
+# Dilate corner image to enhance corner points (for display only, corners
+# are extracted from the raw response below)
+plt.imshow(cv2.dilate(dst, None), cmap='gray')
 
 
 # ### Extract and display strong corners
 
 # This value vary depending on the image and how many corners you want to detect
 # Try changing this free parameter, 0.1, to be larger or smaller and see what happens
-thresh = 0.1*dst.max()
+# (the threshold is relative to dst.max())
+# Only the local maxima above the threshold are kept, one pixel per corner.
+# Earlier versions drew every pixel above the threshold, so each corner was
+# a blob of pixels and there are now far fewer (but better localized) points.
+corners = extract_corners(dst, 0.1)
 
 # Create an image copy to draw corners on
 corner_image = np.copy(image_copy)
 
-# Iterate through all the corners and draw them on the image (if they pass the threshold)
-for j in range(0, dst.shape[0]):
-    for i in range(0, dst.shape[1]):
-        if(dst[j, i] > thresh):
-            # image, center pt, radius, color, thickness
-            cv2.circle(corner_image, (i, j), 1, (0, 255, 0), 1)
+# Draw all the corners on the image: center pt, radius, color, thickness
+for x, y in np.int_(corners[:, :2]):
+    cv2.circle(corner_image, (int(x), int(y)), 1, (0, 255, 0), 1)
 
 plt.imshow(corner_image)
@@ -0,0 +1,276 @@
+#!/use/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import time
+import cv2
+import numpy as np
+
+# Largest Hamming distance of a missing neighbor (no candidate found)
+NO_MATCH = np.iinfo(np.int32).max
+
+
+def pack(descriptors):
+    """ Pack binary descriptors (N x bytes uint8, eg. ORB, BRIEF) into
+        N x words uint64, zero padded to a multiple of 8 bytes. Packed
+        descriptors are passed through unchanged. None (no keypoints, as
+        returned by OpenCV) packs to an empty array. """
+    if descriptors is None:
+        return np.zeros((0, 4), dtype=np.uint64)
+    descriptors = np.asarray(descriptors)
+    if descriptors.dtype == np.uint64:
+        return descriptors
+    if descriptors.dtype != np.uint8:
+        raise ValueError('Binary descriptors must be uint8, got {0}'.format(descriptors.dtype))
+    if descriptors.ndim == 1:
+        descriptors = descriptors[None]
+    padded = np.zeros((len(descriptors), -(-descriptors.shape[1] // 8) * 8), np.uint8)
+    padded[:, :descriptors.shape[1]] = descriptors
+    return padded.view(np.uint64)
+
+
+_M1, _M2, _M4 = np.uint64(0x5555555555555555), np.uint64(0x3333333333333333), \
+    np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(x):
+    """ Number of set bits of each element of a uint64 array """
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(x)
+    # SWAR popcount, all elements at once
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def hamming_distances(query, train, tile_size=(128, 4096)):
+    """ Hamming distances between all query and train descriptors
+        (nq x nt int32), computed in tiles to bound the temporaries """
+    query, train = pack(query), pack(train)
+    dist = np.empty((len(query), len(train)), dtype=np.int32)
+    for q0, t0, d in _tiles(query, train, tile_size):
+        dist[q0:q0 + d.shape[0], t0:t0 + d.shape[1]] = d
+    return dist
+
+
+def _tiles(query, train, tile_size):
+    """ Yield (query start, train start, distances) for tiles of
+        tile_size = (query rows, train columns) of the distance matrix.
+        Distances are accumulated one 64 bit word at a time, which keeps
+        the temporaries 2D and small enough for the cache. """
+    rows, cols = tile_size
+    train_words = np.ascontiguousarray(train.T)  # words x nt
+    for q0 in range(0, len(query), rows):
+        q = query[q0:q0 + rows]
+        for t0 in range(0, len(train), cols):
+            t = train_words[:, t0:t0 + cols]
+            d = np.zeros((len(q), t.shape[1]), dtype=np.uint16)
+            for w in range(query.shape[1]):
+                d += popcount(q[:, w, None] ^ t[w, None, :])
+            yield q0, t0, d.astype(np.int32)
+
+
+def knn(query, train, k=2, tile_size=(128, 4096)):
+    """ k nearest train descriptors of each query descriptor by brute force.
+    :returns: indices and distances (nq x k), nearest first. Missing
+        neighbors (k > nt) have index -1 and distance NO_MATCH
+    """
+    query, train = pack(query), pack(train)
+    nq = len(query)
+    # rank by distance, then by train index on ties as cv2.BFMatcher does
+    best = np.full((nq, k), (NO_MATCH << 32) | 0xffffffff, dtype=np.int64)
+    for q0, t0, d in _tiles(query, train, tile_size):
+        q1 = q0 + d.shape[0]
+        # merge the tile into the running k best of its queries
+        keys = (d.astype(np.int64) << 32) + (t0 + np.arange(d.shape[1]))
+        keys = np.hstack((best[q0:q1], keys))
+        if keys.shape[1] > k:
+            keys = np.partition(keys, k - 1, axis=1)
+        best[q0:q1] = keys[:, :k]
+
+    best.sort(axis=1)
+    dist = (best >> 32).astype(np.int32)
+    idx = np.where(dist < NO_MATCH, best & 0xffffffff, -1)
+    return idx, dist
+
+
+def ratio_test(idx, dist, ratio=0.8):
+    """ Lowe's ratio test on 2 nearest neighbors.
+    :returns: query indices, train indices and distances of the matches
+    """
+    good = (idx[:, 0] >= 0) & (dist[:, 0] < ratio * np.float64(dist[:, 1]))
+    query_idx = np.nonzero(good)[0]
+    return query_idx, idx[good, 0], dist[good, 0]
+
+
+def cross_check(query, train, tile_size=(128, 4096)):
+    """ Mutual nearest neighbors.
+    :returns: query indices, train indices and distances of the matches
+    """
+    idx12, dist12 = knn(query, train, 1, tile_size)
+    idx21, _ = knn(train, query, 1, tile_size)
+    query_idx = np.nonzero(idx12[:, 0] >= 0)[0]
+    query_idx = query_idx[idx21[idx12[query_idx, 0], 0] == query_idx]
+    return query_idx, idx12[query_idx, 0], dist12[query_idx, 0]
+
+
+def match(query, train, cross_check_matches=True, ratio=None, top_k=None, tile_size=(128, 4096)):
+    """ Match binary descriptors, like cv2.BFMatcher(NORM_HAMMING) followed
+        by sorting the matches by distance, but with arrays instead of DMatch.
+    :param cross_check_matches: keep mutual nearest neighbors only
+    :param ratio: Lowe's ratio test instead of cross check, eg. 0.8
+    :param top_k: keep only the top_k best matches
+    :returns: query indices, train indices and distances, best first
+    """
+    if ratio is not None:
+        q, t, d = ratio_test(*knn(query, train, 2, tile_size), ratio=ratio)
+    elif cross_check_matches:
+        q, t, d = cross_check(query, train, tile_size)
+    else:
+        idx, dist = knn(query, train, 1, tile_size)
+        q = np.nonzero(idx[:, 0] >= 0)[0]
+        t, d = idx[q, 0], dist[q, 0]
+
+    order = np.argsort(d, kind='mergesort')[:top_k]
+    return q[order], t[order], d[order]
+
+
+def to_dmatches(query_idx, train_idx, distances):
+    """ cv2.DMatch list of matches, eg. for cv2.drawMatches """
+    return [cv2.DMatch(int(q), int(t), float(d))
+            for q, t, d in zip(query_idx, train_idx, distances)]
+
+
+class LSHIndex(object):
+    """ Multi-probe locality sensitive hashing index of binary descriptors
+        for large galleries (Lv et al. 2007). Each of the num_tables hash
+        tables keys the descriptors by key_bits random bits. A query looks
+        up its own bucket and, with probes=1, the key_bits buckets whose key
+        differs in one bit, then ranks the candidates by exact Hamming
+        distance. Buckets are kept as sorted key arrays and looked up with
+        searchsorted, for all queries at once. """
+
+    def __init__(self, num_tables=8, key_bits=16, probes=1, seed=0):
+        self.num_tables = num_tables
+        self.key_bits = key_bits
+        self.probes = probes
+        self.seed = seed
+        self.train = None
+        self.bits = []     # bit positions of the key of each table
+        self.keys = []     # sorted keys of each table
+        self.order = []    # train indices in the order of the sorted keys
+
+    def _keys(self, packed, bits):
+        words = packed[:, bits // 64]
+        shifts = (bits % 64).astype(np.uint64)
+        key_bits = (words >> shifts) & np.uint64(1)
+        return (key_bits << np.arange(len(bits), dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+
+    def fit(self, train):
+        """ Index the train descriptors (uint8 or packed) """
+        train = np.asarray(train)
+        self.train = pack(train)
+        rng = np.random.RandomState(self.seed)
+        # draw key bits from the descriptor bits, not the padding
+        total_bits = train.shape[1] * (64 if train.dtype == np.uint64 else 8)
+        self.bits, self.keys, self.order = [], [], []
+        for _ in range(self.num_tables):
+            bits = np.sort(rng.choice(total_bits, self.key_bits, replace=False))
+            keys = self._keys(self.train, bits)
+            order = np.argsort(keys, kind='mergesort')
+            self.bits.append(bits)
+            self.keys.append(keys[order])
+            self.order.append(order)
+        return self
+
+    def _probe_masks(self):
+        masks = [np.uint64(0)]
+        if self.probes >= 1:
+            masks += [np.uint64(1) << np.uint64(b) for b in range(self.key_bits)]
+        return masks
+
+    def candidates(self, query):
+        """ Unique (query index, train index) candidate pairs of packed queries """
+        pairs = []
+        for bits, keys, order in zip(self.bits, self.keys, self.order):
+            query_keys = self._keys(query, bits)
+            for mask in self._probe_masks():
+                probe = query_keys ^ mask
+                left = np.searchsorted(keys, probe, side='left')
+                counts = np.searchsorted(keys, probe, side='right') - left
+                total = counts.sum()
+                if total == 0:
+                    continue
+                # expand the bucket ranges [left, left + count) of all queries
+                query_idx = np.repeat(np.arange(len(query)), counts)
+                starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+                pairs.append(query_idx * len(self.train) + order[starts + np.arange(total)])
+        if not pairs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pairs = np.unique(np.concatenate(pairs))
+        return pairs // len(self.train), pairs % len(self.train)
+
+    def knn(self, query, k=2, chunk_size=4096):
+        """ Approximate k nearest neighbors, as knn() """
+        query = pack(query)
+        best_idx = np.full((len(query), k), -1, dtype=np.int64)
+        best_dist = np.full((len(query), k), NO_MATCH, dtype=np.int32)
+        for q0 in range(0, len(query), chunk_size):
+            chunk = query[q0:q0 + chunk_size]
+            q, t = self.candidates(chunk)
+            d = popcount(chunk[q] ^ self.train[t]).sum(axis=1, dtype=np.int32)
+
+            # k best candidates per query: sort by query then distance
+            order = np.lexsort((d, q))
+            q, t, d = q[order], t[order], d[order]
+            rank = np.arange(len(q)) - np.searchsorted(q, q)
+            keep = rank < k
+            best_idx[q0 + q[keep], rank[keep]] = t[keep]
+            best_dist[q0 + q[keep], rank[keep]] = d[keep]
+
+        return best_idx, best_dist
+
+    def match(self, query, ratio=0.8):
+        """ Ratio test matches, as ratio_test() """
+        return ratio_test(*self.knn(query, 2), ratio=ratio)
+
+
+def benchmark(num_query=2000, num_train=(2000, 50000), num_bytes=32, seed=0):
+    """ Compare cv2.BFMatcher with sorted DMatch lists against brute force
+        popcount matching and the LSH index, on synthetic ORB-like
+        descriptors where each query is a noisy copy of a train descriptor """
+    rng = np.random.RandomState(seed)
+    print('{0:>8} {1:>28} {2:>10} {3:>10} {4:>10}'.format(
+        'train', 'method', 'seconds', 'matches', 'recall'))
+    for nt in num_train:
+        train = np.uint8(rng.randint(0, 256, (nt, num_bytes)))
+        truth = rng.randint(0, nt, num_query)
+        noise = np.packbits(rng.rand(num_query, num_bytes * 8) < 0.05, axis=1)
+        query = train[truth] ^ noise
+
+        def opencv():
+            bf = cv2.BFMatcher(cv2.NORM_HAMMING)
+            matches = [m for m, n in bf.knnMatch(query, train, k=2)
+                       if m.distance < 0.8 * n.distance]
+            matches = sorted(matches, key=lambda x: x.distance)
+            return np.int64([m.queryIdx for m in matches]), np.int64([m.trainIdx for m in matches])
+
+        index = LSHIndex().fit(train)
+        runs = [
+            ('BFMatcher + sorted DMatch', opencv),
+            ('popcount brute force', lambda: match(query, train, ratio=0.8)[:2]),
+            ('LSH index (query only)', lambda: index.match(query)[:2]),
+        ]
+        for name, func in runs:
+            start = time.time()
+            q, t = func()
+            seconds = time.time() - start
+            recall = np.mean(truth[q] == t) * len(q) / float(num_query)
+            print('{0:>8} {1:>28} {2:>10.3f} {3:>10} {4:>10.3f}'.format(
+                nt, name, seconds, len(q), recall))
+
+
+if __name__ == '__main__':
+    benchmark()
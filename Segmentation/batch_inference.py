@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import time
+import cv2
+import os
+
+from postprocess import classMap
+
+# Input size of the ENet cityscapes model (width, height)
+INPUT_SIZE = (1024, 512)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+
+def readImages(directory):
+    """Yield (name, image) of the images of a directory, sorted by name"""
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(os.path.join(directory, name))
+            if image is not None:
+                yield os.path.splitext(name)[0], image
+
+
+def readVideo(path):
+    """Yield (name, frame) of the frames of a video, named by frame index"""
+    vs = cv2.VideoCapture(path)
+    index = 0
+    while True:
+        (grabbed, frame) = vs.read()
+        if not grabbed:
+            break
+        yield "{:06d}".format(index), frame
+        index += 1
+    vs.release()
+
+
+def readInput(path):
+    """Images of a directory or frames of a video"""
+    return readImages(path) if os.path.isdir(path) else readVideo(path)
+
+
+def batches(items, batchSize):
+    """Group an iterable into lists of batchSize items (the last may be shorter)"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def forwardBatch(net, images, size=INPUT_SIZE):
+    """One forward pass over a batch of images of any size.
+    Returns the (N, numClasses, height, width) scores."""
+    blob = cv2.dnn.blobFromImages(
+        images, 1/255.0, size, 0, swapRB=True, crop=False)
+    net.setInput(blob)
+    return net.forward()
+
+
+def classMaps(output, shapes=None):
+    """uint8 class ID map of each image of a batch, resized to the (h, w)
+    image shapes if given (nearest neighbor, so IDs are kept)"""
+    if shapes is None:
+        return [classMap(scores) for scores in output]
+    return [classMap(scores, shape) for scores, shape in zip(output, shapes)]
+
+
+def segmentBatch(net, images, size=INPUT_SIZE):
+    """Class maps of a batch of images, at the size of each image"""
+    return classMaps(forwardBatch(net, images, size), [image.shape for image in images])
+
+
+def benchmarkBatchSizes(net, images, batchSizes=(1, 2, 4, 8), size=INPUT_SIZE):
+    """ms/frame of the forward pass and of the whole segmentation (blob,
+    forward and class maps) for each batch size, on the same images.
+    Returns a list of (batchSize, forward ms/frame, total ms/frame)."""
+    # warm up, the first forward pass allocates the network buffers
+    forwardBatch(net, images[:1], size)
+
+    results = []
+    for batchSize in batchSizes:
+        forwardTime = totalTime = 0.0
+        for batch in batches(images, batchSize):
+            start = time.time()
+            blob = cv2.dnn.blobFromImages(
+                batch, 1/255.0, size, 0, swapRB=True, crop=False)
+            net.setInput(blob)
+            forwardStart = time.time()
+            output = net.forward()
+            forwardTime += time.time() - forwardStart
+            classMaps(output, [image.shape for image in batch])
+            totalTime += time.time() - start
+        results.append((batchSize, 1000.0 * forwardTime / len(images),
+                        1000.0 * totalTime / len(images)))
+    return results
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import numpy as np
+import argparse
+import time
+import zlib
+import cv2
+import os
+
+from postprocess import classCounts
+
+# A store is two files: the encoded class maps of all frames one after the
+# other (path), and an index (path + ".idx.npz") with the offset, size and
+# shape of each frame and its pixel count per class, so any frame can be
+# read with one seek and the class areas need no decoding at all.
+ENCODINGS = ("png", "rle")
+
+
+def indexPath(path):
+    return path + ".idx.npz"
+
+
+def encodeRLE(classMap):
+    """Run-length encoding of the row-major class map: the run count, the
+    uint8 class of each run and the uint32 length of each run, deflated"""
+    flat = classMap.ravel()
+    starts = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1])
+    lengths = np.diff(np.append(starts, flat.size)).astype("<u4")
+    runs = np.uint32(len(starts)).astype("<u4").tobytes()
+    return zlib.compress(runs + flat[starts].tobytes() + lengths.tobytes(), 1)
+
+
+def decodeRLE(data, shape):
+    data = zlib.decompress(data)
+    runs = int(np.frombuffer(data[:4], dtype="<u4")[0])
+    values = np.frombuffer(data[4:4 + runs], dtype="uint8")
+    lengths = np.frombuffer(data[4 + runs:4 + 5 * runs], dtype="<u4")
+    return np.repeat(values, lengths).reshape(shape)
+
+
+def encodeMap(classMap, encoding):
+    if encoding == "rle":
+        return encodeRLE(classMap)
+    (ok, data) = cv2.imencode(".png", classMap, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise IOError("could not encode class map as PNG")
+    return data.tobytes()
+
+
+def decodeMap(data, shape, encoding):
+    if encoding == "rle":
+        return decodeRLE(data, shape)
+    return cv2.imdecode(np.frombuffer(data, dtype="uint8"), cv2.IMREAD_UNCHANGED)
+
+
+class ClassMapWriter:
+    """Append the uint8 class maps of a video or image sequence to a store.
+    The index is written on close(), also when used as a context manager,
+    so close it in a finally block to keep the store readable if a run is
+    interrupted."""
+
+    def __init__(self, path, numClasses, encoding="rle"):
+        if encoding not in ENCODINGS:
+            raise ValueError("unknown encoding {}, expected one of {}".format(encoding, ENCODINGS))
+        self.path = path
+        self.numClasses = numClasses
+        self.encoding = encoding
+        self.file = open(path, "wb")
+        self.offsets = []
+        self.sizes = []
+        self.shapes = []
+        self.counts = []
+        self.names = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def write(self, classMap, name=None):
+        """Append the class map of the next frame, with an optional name.
+        Raises ValueError for class IDs the store has no count for."""
+        if classMap.size and classMap.max() >= self.numClasses:
+            raise ValueError("class ID {} in a store of {} classes".format(
+                classMap.max(), self.numClasses))
+        data = encodeMap(classMap, self.encoding)
+        self.offsets.append(self.file.tell())
+        self.sizes.append(len(data))
+        self.shapes.append(classMap.shape[:2])
+        self.counts.append(classCounts(classMap, self.numClasses))
+        self.names.append("{:06d}".format(len(self.names)) if name is None else name)
+        self.file.write(data)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        np.savez(indexPath(self.path), encoding=self.encoding, numClasses=self.numClasses,
+                 offsets=np.array(self.offsets, dtype="int64"),
+                 sizes=np.array(self.sizes, dtype="int64"),
+                 shapes=np.array(self.shapes, dtype="int32").reshape(-1, 2),
+                 counts=np.array(self.counts, dtype="int64").reshape(-1, self.numClasses),
+                 names=np.array(self.names))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ClassMapReader:
+    """Random access to the class maps of a store: reader[k] decodes frame k
+    only, and the class areas come from the index"""
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(indexPath(path)) as index:
+            self.encoding = str(index["encoding"])
+            self.numClasses = int(index["numClasses"])
+            self.offsets = index["offsets"]
+            self.sizes = index["sizes"]
+            self.shapes = index["shapes"]
+            self.counts = index["counts"]
+            self.names = [str(name) for name in index["names"]]
+        self.file = open(path, "rb")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("frame {} out of range, the store has {} frames".format(k, len(self)))
+        self.file.seek(int(self.offsets[k]))
+        data = self.file.read(int(self.sizes[k]))
+        return decodeMap(data, tuple(self.shapes[k]), self.encoding)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def areas(self, normalize=True):
+        """(frames, numClasses) area time series of every class, as a
+        fraction of the frame or in pixels"""
+        if not normalize:
+            return self.counts
+        return self.counts / self.shapes.prod(axis=1, keepdims=True).astype(float)
+
+    def exportAreas(self, csvPath, classNames=None, normalize=True):
+        """Write the area time series as CSV, a row per frame and a column per class"""
+        classNames = classNames or ["class{}".format(c) for c in range(self.numClasses)]
+        areas = self.areas(normalize)
+        with open(csvPath, "w") as f:
+            f.write(",".join(["frame"] + list(classNames[:self.numClasses])) + "\n")
+            fmt = "{:.6f}" if normalize else "{:d}"
+            for (name, row) in zip(self.names, areas):
+                f.write(",".join([name] + [fmt.format(a) for a in row]) + "\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def benchmark(classMaps, numClasses, directory="."):
+    """Size and speed of each encoding against raw uint8 maps, on the same
+    class maps, and the time to read the middle frame back"""
+    raw = sum(classMap.nbytes for classMap in classMaps)
+    print("[INFO] {} class maps, {:.1f} KB raw".format(len(classMaps), raw / 1024.0))
+    for encoding in ENCODINGS:
+        path = os.path.join(directory, "benchmark-{}.maps".format(encoding))
+        start = time.time()
+        with ClassMapWriter(path, numClasses, encoding) as writer:
+            for classMap in classMaps:
+                writer.write(classMap)
+        writeTime = time.time() - start
+        size = os.path.getsize(path) + os.path.getsize(indexPath(path))
+
+        with ClassMapReader(path) as reader:
+            start = time.time()
+            same = all(np.array_equal(a, b) for a, b in zip(reader, classMaps))
+            readTime = time.time() - start
+            start = time.time()
+            reader[len(reader) // 2]
+            seekTime = time.time() - start
+        print("[INFO] {}: {:8.1f} KB ({:5.1f}x smaller), write {:.2f} ms/frame, "
+              "read {:.2f} ms/frame, frame {} in {:.2f} ms, lossless: {}".format(
+                  encoding, size / 1024.0, raw / float(size), 1000.0 * writeTime / len(classMaps),
+                  1000.0 * readTime / len(classMaps), len(classMaps) // 2, 1000.0 * seekTime, same))
+        os.remove(path)
+        os.remove(indexPath(path))
+
+
+if __name__ == "__main__":
+    # Construct argument parse & parse arguments
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument("store", nargs="?",
+                          help="path to class map store")
+    argParse.add_argument("-f", "--frame", type=int, default=None,
+                          help="frame to extract")
+    argParse.add_argument("-o", "--output", type=str, default=None,
+                          help="path to PNG image of the extracted frame")
+    argParse.add_argument("-a", "--areas", type=str, default=None,
+                          help="path to CSV file of per-class areas per frame")
+    argParse.add_argument("-c", "--classes", type=str, default=None,
+                          help="path to .txt file containing class labels")
+    argParse.add_argument("--pixels", action="store_true",
+                          help="areas in pixels instead of fractions of the frame")
+    argParse.add_argument("--benchmark", action="store_true",
+                          help="compare the encodings on the store frames, or on random maps")
+    args = vars(argParse.parse_args())
+
+    if args["benchmark"]:
+        if args["store"]:
+            with ClassMapReader(args["store"]) as reader:
+                benchmark(list(reader), reader.numClasses)
+        else:
+            # smooth random scores, so classes form regions as in a real segmentation
+            rng = np.random.RandomState(0)
+            maps = [np.argmax([cv2.resize(rng.rand(8, 16), (500, 250)) for _ in range(20)],
+                              axis=0).astype("uint8") for _ in range(30)]
+            benchmark(maps, 20)
+    elif args["store"]:
+        with ClassMapReader(args["store"]) as reader:
+            print("[INFO] {} frames, {} classes, {} encoding".format(
+                len(reader), reader.numClasses, reader.encoding))
+            if args["frame"] is not None:
+                classMap = reader[args["frame"]]
+                print("[INFO] frame {} ({}): {}x{}, classes {}".format(
+                    args["frame"], reader.names[args["frame"]], classMap.shape[1],
+                    classMap.shape[0], np.unique(classMap).tolist()))
+                if args["output"]:
+                    cv2.imwrite(args["output"], classMap)
+            if args["areas"]:
+                classNames = None
+                if args["classes"]:
+                    classNames = open(args["classes"]).read().strip().split("\n")
+                reader.exportAreas(args["areas"], classNames, normalize=not args["pixels"])
+                print("[INFO] class areas written to {}".format(args["areas"]))
+    else:
+        argParse.error("a store or --benchmark is required")
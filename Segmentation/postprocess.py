@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import numpy as np
+import time
+import cv2
+
+
+def nearestIndices(srcSize, dstSize):
+    """Source index of each destination index, as picked by cv2.resize
+    with INTER_NEAREST. OpenCV scales by the inverse of dst / src, which
+    rounds differently from src / dst for some sizes"""
+    scale = 1.0 / (dstSize / float(srcSize))
+    indices = np.floor(np.arange(dstSize) * scale).astype(np.intp)
+    return np.minimum(indices, srcSize - 1)
+
+
+def classMap(scores, shape=None):
+    """uint8 class ID map of (numClasses, height, width) scores.
+    If the (h, w) shape is given, the map is resized to it by nearest
+    neighbor. When shrinking, the scores are sampled at the pixels the resize
+    would keep before the argmax, so the argmax runs at the output size only."""
+    (numClasses, height, width) = scores.shape
+    if shape is None or (shape[0], shape[1]) == (height, width):
+        return np.argmax(scores, axis=0).astype("uint8")
+    if shape[0] <= height and shape[1] <= width:
+        ys = nearestIndices(height, shape[0])
+        xs = nearestIndices(width, shape[1])
+        sampled = np.take(np.take(scores, ys, axis=1), xs, axis=2)
+        return np.argmax(sampled, axis=0).astype("uint8")
+    return cv2.resize(np.argmax(scores, axis=0).astype("uint8"), (shape[1], shape[0]),
+                      interpolation=cv2.INTER_NEAREST)
+
+
+def colorLUT(colors):
+    """(256, 1, 3) uint8 lookup table from class ID to color, for cv2.LUT"""
+    lut = np.zeros((256, 1, 3), dtype="uint8")
+    lut[:len(colors), 0] = colors
+    return lut
+
+
+def colorize(classMap, lut):
+    """Color mask of a uint8 class map with a colorLUT"""
+    return cv2.LUT(cv2.merge([classMap, classMap, classMap]), lut)
+
+
+def blend(image, mask, alpha=0.4):
+    """alpha * image + (1 - alpha) * mask, in uint8 (rounded)"""
+    return cv2.addWeighted(image, alpha, mask, 1.0 - alpha, 0)
+
+
+def classCounts(classMap, numClasses):
+    """Number of pixels of each class, in a single pass over the map"""
+    return np.bincount(classMap.ravel(), minlength=numClasses)
+
+
+def classMasks(classMap, classIDs):
+    """(len(classIDs), h, w) binary masks (0 or 255) of the given classes,
+    computed with one broadcast comparison"""
+    classIDs = np.asarray(classIDs, dtype="uint8")
+    return (classMap[None] == classIDs[:, None, None]).view("uint8") * np.uint8(255)
+
+
+def postprocess(scores, image, lut, alpha=0.4):
+    """Class map at the image size, blended visualization and pixel count
+    of each class, from the (numClasses, height, width) scores of an image"""
+    classIDs = classMap(scores, image.shape)
+    output = blend(image, colorize(classIDs, lut), alpha)
+    return classIDs, output, classCounts(classIDs, scores.shape[0])
+
+
+def postprocessReference(scores, image, colors, alpha=0.4):
+    """Post-processing as the scripts did it before, kept for the benchmark"""
+    classIDs = np.argmax(scores, axis=0)
+    mask = colors[classIDs]
+    mask = cv2.resize(
+        mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+    classIDs = cv2.resize(
+        classIDs, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+    classOutputs = [(mask == colors[classID]).astype("uint8")[:, :, 0] * 255
+                    for classID in np.unique(classIDs)]
+    output = ((alpha * image) + ((1 - alpha) * mask)).astype("uint8")
+    return classIDs, output, classOutputs
+
+
+def benchmark(numClasses=20, scoreSize=(512, 1024), imageSize=(250, 500), runs=10, seed=0):
+    """Compare the reference post-processing with the LUT one on random scores"""
+    rng = np.random.RandomState(seed)
+    # smooth scores, so classes form regions as in a real segmentation
+    scores = np.float32([cv2.resize(rng.rand(scoreSize[0] // 32, scoreSize[1] // 32),
+                                    (scoreSize[1], scoreSize[0])) for _ in range(numClasses)])
+    image = np.uint8(rng.randint(0, 256, imageSize + (3,)))
+    colors = np.uint8(rng.randint(0, 256, (numClasses, 3)))
+    lut = colorLUT(colors)
+
+    def fast():
+        classIDs, output, counts = postprocess(scores, image, lut)
+        return classIDs, output, classMasks(classIDs, np.nonzero(counts)[0])
+
+    for name, func in (("reference", lambda: postprocessReference(scores, image, colors)),
+                       ("LUT + bincount", fast)):
+        func()
+        start = time.time()
+        for _ in range(runs):
+            classIDs, output, masks = func()
+        print("[INFO] {:<16} {:8.2f} ms/frame".format(name, 1000.0 * (time.time() - start) / runs))
+
+    referenceIDs, referenceOutput, _ = postprocessReference(scores, image, colors)
+    fastIDs, fastOutput, _ = fast()
+    print("[INFO] same class maps: {}, blend max difference: {}".format(
+        np.array_equal(referenceIDs, fastIDs),
+        np.abs(referenceOutput.astype(int) - fastOutput).max()))
+
+
+if __name__ == "__main__":
+    benchmark()
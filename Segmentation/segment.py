@@ -8,6 +8,8 @@ import imutils
 import time
 import cv2
 
+import postprocess
+
 # Construct argument parse & parse arguments
 argParse = argparse.ArgumentParser()
 argParse.add_argument("-m", "--model", required=True,
@@ -74,35 +76,31 @@ print("[INFO] inference took {:.4f} seconds".format(end - start))
 # Infer total number of classes with spatial dimensions of mask image via shape of output array
 (numClasses, height, width) = output.shape[1:4]
 
-# Find class label with largest probability for each (x, y)-coordinate in image
-# ... note - output class ID map is num_classes x height x wisth in size
-classMap = np.argmax(output[0], axis=0)
+# Find class label with largest probability for each (x, y)-coordinate in image,
+# ... at the size of the input image (note - output is num_classes x height x width)
+classMap = postprocess.classMap(output[0], image.shape)
 
-# Map each class ID to its corresponding color
-mask = COLORS[classMap]
+# Map each class ID to its corresponding color through a lookup table
+mask = postprocess.colorize(classMap, postprocess.colorLUT(COLORS))
 
-# Resize mask & class map (for dimensions to match original size of input)
-mask = cv2.resize(
-    mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
-classMap = cv2.resize(
-    classMap, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+# Count pixels of every class & build the binary masks of the classes present
+counts = postprocess.classCounts(classMap, numClasses)
+classIDs = np.nonzero(counts)[0]
+classMasks = postprocess.classMasks(classMap, classIDs)
 
 # Loop over each individual class IDs in image
-for classID in np.unique(classMap):
-    # build binary mask for current class
-    # ... then use mask to visualize all pixels in image belonging to class
-    print("[INFO] class: {}".format(CLASSES[classID]))
-    classMask = (mask == COLORS[classID]).astype("uint8") * 255
-    classMask = classMask[:, :, 0]
+for (classID, classMask) in zip(classIDs, classMasks):
+    # use mask to visualize all pixels in image belonging to class
+    print("[INFO] class: {} ({} pixels)".format(CLASSES[classID], counts[classID]))
     classOutput = cv2.bitwise_and(image, image, mask=classMask)
-    classMask = np.hstack([image, classOutput])
+    classVis = np.hstack([image, classOutput])
 
     # show output class visualization
-    cv2.imshow("Class Vis", classMask)
+    cv2.imshow("Class Vis", classVis)
     cv2.waitKey(0)
 
 # Perform weighted combination of input image with mask (to form output visualizetion)
-output = ((0.4 * image) + (0.6 * mask)).astype("uint8")
+output = postprocess.blend(image, mask, 0.4)
 
 # Show input & output images
 cv2.imshow("Legend", legend)
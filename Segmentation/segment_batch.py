@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+from itertools import islice
+import argparse
+import imutils
+import time
+import cv2
+import os
+
+from classmap_store import ClassMapWriter, ENCODINGS
+from batch_inference import batches, benchmarkBatchSizes, classMaps, forwardBatch, readInput
+
+# Construct argument parse & parse arguments
+argParse = argparse.ArgumentParser()
+argParse.add_argument("-m", "--model", required=True,
+                      help="path to deep learning segmentation model")
+argParse.add_argument("-i", "--input", required=True,
+                      help="path to input image directory or video file")
+argParse.add_argument("-o", "--output", type=str, default=None,
+                      help="path to output directory of class maps")
+argParse.add_argument("--maps", type=str, default=None,
+                      help="path to class map store, instead of or along with the PNG directory")
+argParse.add_argument("--encoding", type=str, default="rle", choices=ENCODINGS,
+                      help="encoding of the frames of the class map store")
+argParse.add_argument("-b", "--batch", type=int, default=4,
+                      help="frames per forward pass")
+argParse.add_argument("-w", "--width", type=int, default=500,
+                      help="desired width (in pixels) of input image")
+argParse.add_argument("--benchmark", type=str, default=None,
+                      help="comma separated batch sizes to time on the first frames, eg. 1,2,4,8")
+
+args = vars(argParse.parse_args())
+if not args["output"] and not args["maps"]:
+    argParse.error("an output directory (-o) or a class map store (--maps) is required")
+
+# Load serialized model from disk
+print("[INFO] loading model...")
+net = cv2.dnn.readNet(args["model"])
+
+if args["output"] and not os.path.isdir(args["output"]):
+    os.makedirs(args["output"])
+
+
+def resized(items):
+    for (name, image) in items:
+        yield name, imutils.resize(image, width=args["width"])
+
+
+# Compare batch sizes on the first frames
+if args["benchmark"]:
+    batchSizes = [int(b) for b in args["benchmark"].split(",")]
+    images = [image for (_, image) in islice(resized(readInput(args["input"])), max(batchSizes) * 2)]
+    print("[INFO] {} frames, ms/frame by batch size".format(len(images)))
+    for (batchSize, forwardTime, totalTime) in benchmarkBatchSizes(net, images, batchSizes):
+        print("[INFO] batch {:3d}: forward {:8.1f} ms/frame, total {:8.1f} ms/frame".format(
+            batchSize, forwardTime, totalTime))
+
+# Segment all frames, a batch per forward pass, and write the class maps of
+# each batch as PNG images of class IDs and/or to the class map store
+start = time.time()
+total = 0
+store = None
+try:
+    for batch in batches(resized(readInput(args["input"])), args["batch"]):
+        names = [name for (name, _) in batch]
+        images = [image for (_, image) in batch]
+        output = forwardBatch(net, images)
+        maps = classMaps(output, [image.shape for image in images])
+        # the store counts the pixels of every class of the model
+        if args["maps"] and store is None:
+            store = ClassMapWriter(args["maps"], output.shape[1], args["encoding"])
+        for (name, classMap) in zip(names, maps):
+            if args["output"]:
+                cv2.imwrite(os.path.join(args["output"], name + ".png"), classMap)
+            if store is not None:
+                store.write(classMap, name)
+        total += len(batch)
+finally:
+    # write the store index even if the run is interrupted
+    if store is not None:
+        store.close()
+        print("[INFO] {} class maps written to {}".format(len(store), args["maps"]))
+
+elapsed = time.time() - start
+print("[INFO] {} frames in {:.2f} seconds, {:.1f} ms/frame (batch {})".format(
+    total, elapsed, 1000.0 * elapsed / max(total, 1), args["batch"]))
@@ -5,9 +5,13 @@
 import numpy as np
 import argparse
 import imutils
-import time
 import cv2
 
+from classmap_store import ClassMapWriter, ENCODINGS
+from temporal_reuse import TemporalSegmenter
+from video_pipeline import runPipeline
+import postprocess
+
 # Construct argument parse & parse arguments
 argParse = argparse.ArgumentParser()
 argParse.add_argument("-m", "--model", required=True,
@@ -24,6 +28,22 @@ argParse.add_argument("-l", "--colors", type=str,
                       help="path to .txt file containing colors for labels")
 argParse.add_argument("-w", "--width", type=int, default=500,
                       help="desired width (in pixels) of input image")
+argParse.add_argument("-q", "--queue", type=int, default=4,
+                      help="frames queued between pipeline stages")
+argParse.add_argument("-k", "--keyframes", type=int, default=0,
+                      help="run the model at least every k frames only, reusing class maps in between (0: every frame)")
+argParse.add_argument("--no-flow", action="store_true",
+                      help="reuse class maps as is instead of warping them by optical flow")
+argParse.add_argument("--diff-threshold", type=float, default=6.0,
+                      help="frame difference (gray levels) that triggers a keyframe")
+argParse.add_argument("--flow-threshold", type=float, default=30.0,
+                      help="motion since the keyframe (pixels) that triggers a keyframe")
+argParse.add_argument("--validate", type=int, default=0,
+                      help="also run the model on every n-th reused frame to measure drift")
+argParse.add_argument("--maps", type=str, default=None,
+                      help="path to class map store of the raw class IDs (see classmap_store.py)")
+argParse.add_argument("--encoding", type=str, default="rle", choices=ENCODINGS,
+                      help="encoding of the frames of the class map store")
 
 args = vars(argParse.parse_args())
 
@@ -43,6 +63,9 @@ else:
     COLORS = np.random.randint(0, 255, size=(len(CLASSES)-1, 3), dtype="uint8")
     COLORS = np.vstack([[0, 0, 0], COLORS]).astype("uint8")
 
+# Lookup table from class ID to color
+LUT = postprocess.colorLUT(COLORS)
+
 # Load serialized model from disk
 print("[INFO] loading model...")
 net = cv2.dnn.readNet(args["model"])
@@ -51,49 +74,71 @@ net = cv2.dnn.readNet(args["model"])
 vs = cv2.VideoCapture(args["video"])
 writer = None
 
+# Optionally keep the class IDs of every frame, with random access and class areas
+store = None
+if args["maps"]:
+    store = ClassMapWriter(args["maps"], len(COLORS), args["encoding"])
+
 # Try to determine total number of frames in video file
 try:
     prop = cv2.cv.CV_CAP_PROP_FRAME_COUNT if imutils.is_cv2() else cv2.CAP_PROP_FRAME_COUNT
+    total = int(vs.get(prop))
 except:
     print("[INFO] could not determine # of frames in video")
     total = -1
 
-# Loop over frames from video file stream
-while True:
-    # read next frame from file
-    (grabbed, frame) = vs.read()
-
-    # if frmae was not grabbed, we have reached end of stream
-    if not grabbed:
-        break
 
-    # construct a blob from frame & perform forward pass
-    frame = imutils.resize(frame, width=args["width"])
-    blob = cv2.dnn.blobFromImage(
+# Decode, inference and post-process/write run as pipeline stages in separate
+# threads, so decoding and encoding overlap with the forward pass
+def makeBlob(frame):
+    return cv2.dnn.blobFromImage(
         frame, 1/255.0, (1024, 512), 0, swapRB=True, crop=False)
 
-    # Perform forward pass using segmentation model
-    net.setInput(blob)
-    start = time.time()
-    output = net.forward()
-    end = time.time()
 
-    # Infer total number of classes with spatial dimensions of mask image via shape of output array
-    (numClasses, height, width) = output.shape[1:4]
+def segmentFrame(frame, blob=None):
+    """Forward pass & class label with largest probability for each (x, y)-coordinate,
+    at the frame size"""
+    net.setInput(makeBlob(frame) if blob is None else blob)
+    return postprocess.classMap(net.forward()[0], frame.shape)
+
 
-    # Find class label with largest probability for each (x, y)-coordinate in image
-    # ... note - output class ID map is num_classes x height x wisth in size
-    classMap = np.argmax(output[0], axis=0)
+# In keyframe mode the network runs on keyframes only, see temporal_reuse.py
+temporal = None
+if args["keyframes"] > 0:
+    temporal = TemporalSegmenter(
+        segmentFrame, len(COLORS), keyInterval=args["keyframes"],
+        diffThreshold=args["diff_threshold"], useFlow=not args["no_flow"],
+        flowThreshold=args["flow_threshold"], validateEvery=args["validate"])
 
-    # Map each class ID to its corresponding color
-    mask = COLORS[classMap]
 
-    # Resize mask & class map (for dimensions to match original size of input)
-    mask = cv2.resize(
-        mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST)
+def prepare(frame):
+    """Reader stage: resize the frame & construct a blob from it"""
+    frame = imutils.resize(frame, width=args["width"])
+    # blobs of keyframes are built when needed
+    blob = makeBlob(frame) if temporal is None else None
+    return frame, blob
+
 
-    # Perform weighted combination of input frame with mask (to form output visualizetion)
-    output = ((0.3 * frame) + (0.7 * mask)).astype("uint8")
+def infer(item):
+    """Inference stage: class map of the frame, from the segmentation model
+    or reused from the last keyframe"""
+    (frame, blob) = item
+    if temporal is not None:
+        (classMap, _) = temporal.update(frame)
+    else:
+        classMap = segmentFrame(frame, blob)
+    return frame, classMap
+
+
+def finish(item):
+    """Post-process & writer stage, in the main thread for cv2.imshow"""
+    global writer
+    (frame, classMap) = item
+    if store is not None:
+        store.write(classMap)
+
+    # colorize the class map through a lookup table and blend with the frame
+    output = postprocess.blend(frame, postprocess.colorize(classMap, LUT), 0.3)
 
     # check if video writer is None
     if writer is None:
@@ -102,12 +147,6 @@ while True:
         writer = cv2.VideoWriter(
             args["output"], fourcc, 30, (output.shape[1], output.shape[0]), True)
 
-        # processing single frames
-        if total > 0:
-            elap = (end - start)
-            print("[INFO] single frame {:.4f} seconds".format(elap))
-            print("[INFO] estimated total time: {:.4f}".format(elap * total))
-
     # write output frame to disk
     writer.write(output)
 
@@ -116,11 +155,31 @@ while True:
         cv2.imshow("Frame", output)
         key = cv2.waitKey(1) & 0xFF
 
-        # if "q" key is pressed, break from loop
+        # if "q" key is pressed, stop the pipeline
         if key == ord("q"):
-            break
+            return False
+    return True
+
+
+# Loop over frames from video file stream, and write the class map store
+# index even if the run is interrupted
+try:
+    stats = runPipeline(vs, prepare, infer, finish, queueSize=args["queue"])
+finally:
+    if store is not None:
+        store.close()
+        print("[INFO] {} class maps written to {}".format(len(store), args["maps"]))
+
+# processing speed of each stage
+print(stats.summary())
+if temporal is not None:
+    print(temporal.stats.summary())
+if total > 0 and stats.stages[-1].frames:
+    print("[INFO] estimated total time: {:.4f}".format(
+        stats.elapsed / stats.stages[-1].frames * total))
 
 # Release file pointers
 print("[INFO] cleaning up...")
-writer.release()
+if writer is not None:
+    writer.release()
 vs.release()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import numpy as np
+import time
+import cv2
+
+
+def agreement(classMap, reference, numClasses):
+    """Pixel accuracy and mean IoU (over the classes present in either map)
+    of a class map against a reference one, from a single bincount"""
+    confusion = np.bincount(
+        reference.ravel().astype(np.intp) * numClasses + classMap.ravel(),
+        minlength=numClasses * numClasses).reshape(numClasses, numClasses)
+    correct = np.diag(confusion)
+    union = confusion.sum(axis=0) + confusion.sum(axis=1) - correct
+    present = union > 0
+    return correct.sum() / float(reference.size), (correct[present] / union[present].astype(float)).mean()
+
+
+class ReuseStats:
+    """Keyframes, skipped frames and drift of the reused class maps"""
+
+    REASONS = ("first", "interval", "difference", "motion")
+
+    def __init__(self):
+        self.frames = 0
+        self.reasons = dict((reason, 0) for reason in self.REASONS)
+        self.keyTime = 0.0
+        self.skipTime = 0.0
+        self.accuracies = []
+        self.ious = []
+
+    @property
+    def keyframes(self):
+        return sum(self.reasons.values())
+
+    def record(self, reason, seconds):
+        self.frames += 1
+        if reason is None:
+            self.skipTime += seconds
+        else:
+            self.reasons[reason] += 1
+            self.keyTime += seconds
+
+    def recordDrift(self, accuracy, iou):
+        self.accuracies.append(accuracy)
+        self.ious.append(iou)
+
+    def summary(self):
+        skipped = self.frames - self.keyframes
+        lines = ["[INFO] {} frames, {} keyframes, {:.1f}% of inferences skipped ({})".format(
+            self.frames, self.keyframes, 100.0 * skipped / max(self.frames, 1),
+            ", ".join("{} {}".format(r, self.reasons[r]) for r in self.REASONS if self.reasons[r])),
+            "[INFO] {:.1f} ms/keyframe, {:.1f} ms/skipped frame".format(
+                1000.0 * self.keyTime / max(self.keyframes, 1), 1000.0 * self.skipTime / max(skipped, 1))]
+        if self.accuracies:
+            lines.append("[INFO] drift against full inference on {} frames: "
+                         "{:.2f}% pixel agreement (worst {:.2f}%), {:.3f} mean IoU".format(
+                             len(self.accuracies), 100.0 * np.mean(self.accuracies),
+                             100.0 * np.min(self.accuracies), np.mean(self.ious)))
+        return "\n".join(lines)
+
+
+class TemporalSegmenter:
+    """Run the segmentation network on keyframes only, and reuse the last
+    class map on the frames in between.
+
+    A frame is a keyframe every keyInterval frames, or when the mean absolute
+    difference between the (small, gray) frame and its prediction exceeds
+    diffThreshold gray levels. Without flow, the prediction is the last
+    keyframe and the class map is reused as is, which suits static scenes.
+    With flow, dense optical flow between consecutive frames warps the class
+    map and the previous frame forward, and a keyframe is also forced when the
+    motion accumulated since the last keyframe exceeds flowThreshold pixels.
+
+    segment(frame) must return the uint8 class map of the frame at its size.
+    """
+
+    def __init__(self, segment, numClasses, keyInterval=10, diffThreshold=6.0,
+                 useFlow=True, flowThreshold=30.0, flowWidth=256, validateEvery=0):
+        """
+        :param flowWidth: width of the frames the motion is measured on
+        :param validateEvery: also run the network on every validateEvery-th
+            skipped frame, to measure the drift of the reused class maps
+        """
+        self.segment = segment
+        self.numClasses = numClasses
+        self.keyInterval = keyInterval
+        self.diffThreshold = diffThreshold
+        self.useFlow = useFlow
+        self.flowThreshold = flowThreshold
+        self.flowWidth = flowWidth
+        self.validateEvery = validateEvery
+        self.stats = ReuseStats()
+
+        self.classMap = None
+        self.keyGray = None     # small gray keyframe, or previous frame with flow
+        self.sinceKeyframe = 0
+        self.motion = 0.0       # flow accumulated since the keyframe, in frame pixels
+        self.skipped = 0
+
+    def smallGray(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height = max(1, int(round(frame.shape[0] * self.flowWidth / float(frame.shape[1]))))
+        return cv2.resize(gray, (self.flowWidth, height), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def warp(image, flow, interpolation):
+        """Warp image by a backward flow (position in image of each output pixel)"""
+        (height, width) = flow.shape[:2]
+        grid = np.mgrid[0:height, 0:width].astype(np.float32)
+        mapX = grid[1] + flow[..., 0]
+        mapY = grid[0] + flow[..., 1]
+        return cv2.remap(image, mapX, mapY, interpolation, borderMode=cv2.BORDER_REPLICATE)
+
+    def propagate(self, gray, frameShape):
+        """Class map of the frame from the last one. Returns the class map,
+        the difference between the frame and its prediction and the flow
+        magnitude of the frame, in frame pixels"""
+        if not self.useFlow:
+            return self.classMap, cv2.absdiff(gray, self.keyGray).mean(), 0.0
+
+        # backward flow: for each pixel of this frame, where it was in the last one
+        flow = cv2.calcOpticalFlowFarneback(
+            gray, self.keyGray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+        difference = cv2.absdiff(gray, self.warp(self.keyGray, flow, cv2.INTER_LINEAR)).mean()
+
+        # flow of the frame size, in frame pixels
+        scale = frameShape[1] / float(gray.shape[1])
+        flow = cv2.resize(flow, (frameShape[1], frameShape[0])) * scale
+        classMap = self.warp(self.classMap, flow, cv2.INTER_NEAREST)
+        magnitude = np.sqrt(np.square(flow).sum(axis=2)).mean()
+        return classMap, difference, magnitude
+
+    def update(self, frame):
+        """Class map of the next frame, and whether the network ran on it"""
+        start = time.time()
+        gray = self.smallGray(frame)
+
+        reason = None
+        if self.classMap is None:
+            reason = "first"
+        elif self.sinceKeyframe >= self.keyInterval:
+            reason = "interval"
+        else:
+            (classMap, difference, magnitude) = self.propagate(gray, frame.shape)
+            if difference > self.diffThreshold:
+                reason = "difference"
+            elif self.motion + magnitude > self.flowThreshold:
+                reason = "motion"
+
+        if reason is None:
+            self.classMap = classMap
+            self.motion += magnitude
+            self.sinceKeyframe += 1
+            if self.useFlow:
+                self.keyGray = gray
+        else:
+            self.classMap = self.segment(frame)
+            self.keyGray = gray
+            self.motion = 0.0
+            self.sinceKeyframe = 1
+        self.stats.record(reason, time.time() - start)
+
+        if reason is None and self.validateEvery:
+            self.skipped += 1
+            if self.skipped % self.validateEvery == 0:
+                self.stats.recordDrift(*agreement(
+                    self.classMap, self.segment(frame), self.numClasses))
+
+        return self.classMap, reason is not None
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dependencies
+import threading
+import queue
+import time
+
+
+class StageStats:
+    """Frames processed by a pipeline stage and the time spent on them"""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+
+    def add(self, seconds):
+        self.frames += 1
+        self.busy += seconds
+
+    def summary(self, elapsed):
+        perFrame = 1000.0 * self.busy / self.frames if self.frames else 0.0
+        return "[INFO] {:<10} {:6d} frames {:8.1f} ms/frame {:6.1f}% busy".format(
+            self.name, self.frames, perFrame, 100.0 * self.busy / max(elapsed, 1e-9))
+
+
+class PipelineStats:
+    """Stats of all stages and the wall time of the run"""
+
+    def __init__(self, names):
+        self.stages = [StageStats(name) for name in names]
+        self.start = time.time()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def summary(self):
+        frames = self.stages[-1].frames
+        lines = ["[INFO] {} frames in {:.2f} seconds, {:.2f} frames/second".format(
+            frames, self.elapsed, frames / max(self.elapsed, 1e-9))]
+        lines += [stage.summary(self.elapsed) for stage in self.stages]
+        # without the pipeline each frame would take the sum of the stages
+        sequential = sum(s.busy / s.frames for s in self.stages if s.frames)
+        if frames:
+            lines.append("[INFO] {:.1f} ms/frame sequential, {:.1f} ms/frame pipelined".format(
+                1000.0 * sequential, 1000.0 * self.elapsed / frames))
+        return "\n".join(lines)
+
+
+# Marks the end of the stream in a queue
+_END = object()
+
+
+class _Failure:
+    """Exception raised in a stage thread, passed down to the main thread"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(outQueue, item, stop):
+    """Blocking put that gives up once the pipeline is stopped"""
+    while not stop.is_set():
+        try:
+            outQueue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(inQueue, stop):
+    while not stop.is_set():
+        try:
+            return inQueue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _readStage(capture, prepare, outQueue, stop, stats):
+    """Decode frames and prepare them (eg. resize and build the blob)"""
+    try:
+        while not stop.is_set():
+            start = time.time()
+            (grabbed, frame) = capture.read()
+            if not grabbed:
+                break
+            item = prepare(frame)
+            stats.add(time.time() - start)
+            if not _put(outQueue, item, stop):
+                return
+    except Exception as error:
+        _put(outQueue, _Failure(error), stop)
+        return
+    _put(outQueue, _END, stop)
+
+
+def _workStage(process, inQueue, outQueue, stop, stats):
+    """Apply process to every item, in order"""
+    while True:
+        item = _get(inQueue, stop)
+        if item is _END or isinstance(item, _Failure):
+            _put(outQueue, item, stop)
+            return
+        start = time.time()
+        try:
+            item = process(item)
+        except Exception as error:
+            _put(outQueue, _Failure(error), stop)
+            return
+        stats.add(time.time() - start)
+        if not _put(outQueue, item, stop):
+            return
+
+
+def runPipeline(capture, prepare, infer, finish, queueSize=4):
+    """Run a video through three stages connected by bounded queues:
+    decoding and prepare(frame) in a reader thread, infer(item) in an
+    inference thread and finish(item) (post-processing, writing, display)
+    in the calling thread, so it may use cv2.imshow. OpenCV releases the GIL
+    while decoding, running the network and encoding, so the stages overlap.
+    Frames stay in order, as every stage is a single thread.
+    finish returns False to stop early.
+
+    :returns: PipelineStats of the run
+    """
+    stats = PipelineStats(["read", "inference", "write"])
+    readQueue = queue.Queue(maxsize=queueSize)
+    inferQueue = queue.Queue(maxsize=queueSize)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=_readStage,
+                         args=(capture, prepare, readQueue, stop, stats.stages[0])),
+        threading.Thread(target=_workStage,
+                         args=(infer, readQueue, inferQueue, stop, stats.stages[1])),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = _get(inferQueue, stop)
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            start = time.time()
+            keepGoing = finish(item)
+            stats.stages[2].add(time.time() - start)
+            if keepGoing is False:
+                break
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        stats.finish()
+
+    return stats